@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark of the smali patch engine against the previous line by line loop on a synthetic large smali file.
+
+The engine side runs the same steps of the signature spoofing patch, with its variants table and its injection code.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+__author__ = "ale5000"
+__copyright__ = "Copyright (C) 2016-2017, ale5000"
+__license__ = "GPLv3"
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "libraries"))
+sys.path.insert(0, SCRIPT_DIR)
+if "BasePatch" not in sys.__dict__:
+    sys.BasePatch = object  # Set by main.py, only the module level code of the patch is used here
+import smalipatcher  # noqa: E402
+from patches import sig_spoof  # noqa: E402
+
+VARIANTS = sig_spoof.GENERATE_PACKAGE_INFO_VARIANTS
+
+
+def generate_smali(filename, methods_count, variant):
+    fo = open(filename, "w")
+    try:
+        fo.write(".class public Landroid/content/pm/PackageParser;\n.super Ljava/lang/Object;\n\n")
+        for index in range(methods_count):
+            if index == methods_count // 2:
+                fo.write(".method "+variant[0]+" "+variant[1]+"\n    .registers 20\n\n")
+                fo.write("    .line 100\n    new-instance v9, Landroid/content/pm/PackageInfo;\n\n")
+                fo.write("    invoke-direct {v9}, Landroid/content/pm/PackageInfo;-><init>()V\n\n")
+                fo.write("    .line 101\n    const/4 v3, 0x0\n\n")
+                fo.write("    invoke-static {v1, v3, v2, v3, v4}, Ljava/lang/System;->arraycopy(Ljava/lang/Object;ILjava/lang/Object;II)V\n\n")
+                fo.write("    return-object v9\n.end method\n\n")
+            fo.write(".method private method"+str(index)+"(I)I\n    .registers 4\n\n")
+            for line in range(12):
+                fo.write("    .line "+str(line)+"\n    add-int/lit8 v0, p1, 0x"+str(line)+"\n\n")
+            fo.write("    return v0\n.end method\n\n")
+    finally:
+        fo.close()
+
+
+def legacy_patch(to_patch):
+    """The previous implementation: read every line and test every signature on each of them."""
+    f = open(to_patch, "r")
+    old_contents = f.readlines()
+    f.close()
+
+    i = 0
+    contents = []
+    already_patched = False
+    in_function = False
+    right_line = False
+    start_of_line = None
+    done_patching = False
+    stored_register = "v11"
+    while i < len(old_contents):
+        if ";->fillinsig" in old_contents[i]:
+            already_patched = True
+        for modifiers, signature, __ in VARIANTS:
+            if ".method "+modifiers+" "+signature in old_contents[i]:
+                in_function = True
+        if ".end method" in old_contents[i]:
+            in_function = False
+        if in_function and ".line" in old_contents[i]:
+            start_of_line = i + 1
+        if in_function and "arraycopy" in old_contents[i]:
+            right_line = True
+        if in_function and "Landroid/content/pm/PackageInfo;-><init>()V" in old_contents[i]:
+            stored_register = old_contents[i].split("{")[1].split("}")[0]
+        if not already_patched and in_function and right_line and not done_patching:
+            contents = contents[:start_of_line]
+            contents.append("move-object/from16 v0, p0\n")
+            contents.append("invoke-static {" + stored_register + ", v0}, Landroid/content/pm/PackageParser;->fillinsig(Landroid/content/pm/PackageInfo;Landroid/content/pm/PackageParser$Package;)V\n")
+            done_patching = True
+        else:
+            contents.append(old_contents[i])
+        i = i + 1
+    contents.append(sig_spoof.read_fillinsig())
+
+    f = open(to_patch+".legacy", "w")
+    f.write("".join(contents))
+    f.close()
+
+
+def engine_patch(to_patch):
+    """The steps of Patch.apply() in patches/sig_spoof.py."""
+    smali = smalipatcher.SmaliFile(to_patch)
+    try:
+        if smali.contains(";->fillinsig"):
+            raise RuntimeError("The synthetic file is already patched")
+        replacements = []
+        for method, __ in smali.match_methods(smalipatcher.MethodMatcher(VARIANTS)):
+            if not replacements:
+                new_lines = sig_spoof.inject_fillinsig_call(smali.get_lines(method))
+                if new_lines is not None:
+                    replacements.append((method, new_lines))
+        if not replacements:
+            raise RuntimeError("The injection point has not been found")
+        smali.write(to_patch+".engine", replacements, sig_spoof.read_fillinsig())
+    finally:
+        smali.close()
+
+
+def read_output(filename):
+    f = open(filename, "rb")
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def measure(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def main():
+    methods_count = 40000
+    if len(sys.argv) > 1:
+        methods_count = int(sys.argv[1])
+    tmp_dir = tempfile.mkdtemp(prefix="tingle-bench-")
+    result = 0
+    try:
+        for variant in VARIANTS:
+            smali_file = os.path.join(tmp_dir, "PackageParser.smali")
+            generate_smali(smali_file, methods_count, variant)
+            print(variant[2]+" - synthetic file: "+str(methods_count + 1)+" methods, "+str(os.path.getsize(smali_file) // 1024)+" KiB")
+
+            legacy_time = min([measure(legacy_patch, smali_file) for __ in range(3)])
+            engine_time = min([measure(engine_patch, smali_file) for __ in range(3)])
+            same_output = read_output(smali_file+".legacy") == read_output(smali_file+".engine")
+
+            print("  Line by line loop: {0:.3f} s".format(legacy_time))
+            print("  Patch engine:      {0:.3f} s ({1:.1f}x)".format(engine_time, legacy_time / max(engine_time, 0.000001)))
+            print("  Same output:       "+str(same_output))
+            if not same_output:
+                result = 1
+    finally:
+        shutil.rmtree(tmp_dir, True)
+    return result
+
+
+if __name__ == "__main__":
+    sys.exit(main())
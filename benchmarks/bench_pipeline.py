@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark of the whole pipeline on synthetic framework.jar files, no real firmware is needed.
+
+The fixtures are generated from smali sources (with the bundled smali.jar), one for every variant of
+generatePackageInfo recognised by the signature spoofing patch. Each run is a normal execution of main.py in mode 2 with the
+caches disabled, the time of the stages is read from its trace. The results are appended to a history
+file and compared with the previous run of the same benchmark.
+"""
+
+import os
+import sys
+import ast
+import json
+import time
+import shutil
+import hashlib
+import zipfile
+import tempfile
+import subprocess
+
+__author__ = "ale5000"
+__copyright__ = "Copyright (C) 2016-2017, ale5000"
+__license__ = "GPLv3"
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_DIR = os.path.dirname(BENCH_DIR)
+GENERATOR_VERSION = 2  # Increase it when the generated fixtures change
+STAGES = ("decompress", "locate", "disassemble", "patch", "reassemble", "recompress")
+SCENARIOS = {
+    # Methods are per dex (secondary_methods_count for the dex after the first), the class to patch is always in classes.dex
+    "small": {"dex_count": 1, "classes_count": 200, "methods_count": 2000, "sdk": "26"},
+    "multidex": {"dex_count": 3, "classes_count": 1500, "methods_count": 30000, "sdk": "26"},
+    # classes.dex is over the limit of the planner (65536 - 256 of margin - the ids added by the patch) but still valid,
+    # so the planned rebalance must move some packages to classes2.dex, that has room for them
+    "near-64k": {"dex_count": 2, "classes_count": 2000, "methods_count": 65400, "secondary_methods_count": 20000, "sdk": "26", "expect_rebalance": True},
+}
+CLASSES_PER_PACKAGE = 25
+TARGET_CLASSES = {
+    "android/content/pm/PackageParser": "Landroid/content/pm/PackageParser;",
+    "com/android/server/pm/PackageManagerService": "Lcom/android/server/pm/PackageManagerService;",
+}
+
+
+def load_variants():
+    """Read GENERATE_PACKAGE_INFO_VARIANTS from the patch (it cannot be imported outside of main.py)."""
+    fo = open(os.path.join(SCRIPT_DIR, "patches", "sig_spoof.py"), "r")
+    try:
+        tree = ast.parse(fo.read())
+    finally:
+        fo.close()
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and getattr(node.targets[0], "id", None) == "GENERATE_PACKAGE_INFO_VARIANTS":
+            return ast.literal_eval(node.value)
+    raise RuntimeError("GENERATE_PACKAGE_INFO_VARIANTS not found in patches/sig_spoof.py")
+
+
+def get_target_class(signature):
+    # The variants that take a PackageSetting are methods of PackageManagerService
+    if "Lcom/android/server/pm/" in signature:
+        return "com/android/server/pm/PackageManagerService"
+    return "android/content/pm/PackageParser"
+
+
+def write_file(filename, text):
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    fo = open(filename, "w")
+    try:
+        fo.write(text)
+    finally:
+        fo.close()
+
+
+def generate_target_smali(smali_dir, variant):
+    modifiers, signature, __ = variant
+    class_path = get_target_class(signature)
+    lines = [".class public " + TARGET_CLASSES[class_path], ".super Ljava/lang/Object;", ""]
+    lines.append(".method " + modifiers + " " + signature)
+    lines.append("    .registers 20")
+    lines.append("")
+    lines.append("    .line 100")
+    lines.append("    new-instance v9, Landroid/content/pm/PackageInfo;")
+    lines.append("")
+    lines.append("    invoke-direct {v9}, Landroid/content/pm/PackageInfo;-><init>()V")
+    lines.append("")
+    lines.append("    .line 101")
+    lines.append("    const/4 v3, 0x0")
+    lines.append("")
+    lines.append("    invoke-static {v1, v3, v2, v3, v4}, Ljava/lang/System;->arraycopy(Ljava/lang/Object;ILjava/lang/Object;II)V")
+    lines.append("")
+    lines.append("    .line 102")
+    lines.append("    return-object v9")
+    lines.append(".end method")
+    write_file(os.path.join(smali_dir, class_path + ".smali"), "\n".join(lines) + "\n")
+    return 1
+
+
+def generate_filler_smali(smali_dir, dex_index, classes_count, methods_count):
+    """Write classes_count classes with methods_count methods in total, every method calls the previous one."""
+    classes_count = max(classes_count, 1)
+    for class_index in range(classes_count):
+        methods_per_class = max(methods_count // classes_count + (1 if class_index < methods_count % classes_count else 0), 1)
+        package = "com/tingle/bench/d" + str(dex_index) + "/p" + str(class_index // CLASSES_PER_PACKAGE)
+        class_name = package + "/C" + str(class_index)
+        lines = [".class public L" + class_name + ";", ".super Ljava/lang/Object;", ""]
+        lines.append(".field public static value:I")
+        lines.append("")
+        for method_index in range(methods_per_class):
+            lines.append(".method public static m" + str(method_index) + "(I)I")
+            lines.append("    .registers 2")
+            lines.append("")
+            if method_index > 0:
+                lines.append("    invoke-static {p0}, L" + class_name + ";->m" + str(method_index - 1) + "(I)I")
+                lines.append("")
+            lines.append("    sget v0, L" + class_name + ";->value:I")
+            lines.append("")
+            lines.append("    add-int/2addr v0, p0")
+            lines.append("")
+            lines.append("    return v0")
+            lines.append(".end method")
+            lines.append("")
+        write_file(os.path.join(smali_dir, class_name + ".smali"), "\n".join(lines))
+
+
+def get_java():
+    if "which" in shutil.__dict__:
+        return shutil.which("java")
+    for directory in os.environ.get("PATH", "").split(os.pathsep):  # Python 2
+        for filename in ("java", "java.exe"):
+            path = os.path.join(directory, filename)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path
+    return None
+
+
+def generate_fixture(fixture_dir, variant, params):
+    """Create framework.jar and build.prop in fixture_dir."""
+    java = get_java()
+    if java is None:
+        raise RuntimeError("Java is required to generate the fixtures (and to run the benchmark)")
+    work_dir = tempfile.mkdtemp(prefix="tingle-fixture-")
+    try:
+        dex_files = []
+        for dex_index in range(params["dex_count"]):
+            smali_dir = os.path.join(work_dir, "smali" + str(dex_index))
+            methods_count = params["methods_count"]
+            if dex_index == 0:
+                methods_count -= generate_target_smali(smali_dir, variant)
+            else:
+                methods_count = params.get("secondary_methods_count", methods_count)
+            generate_filler_smali(smali_dir, dex_index, params["classes_count"], methods_count)
+            dex_filename = "classes" + (str(dex_index + 1) if dex_index else "") + ".dex"
+            subprocess.check_call([java, "-Xmx1024m", "-jar", os.path.join(SCRIPT_DIR, "tools", "smali.jar"), "assemble", "-a", params["sdk"],
+                                   "-o", os.path.join(work_dir, dex_filename), smali_dir])
+            dex_files.append(dex_filename)
+
+        if not os.path.exists(fixture_dir):
+            os.makedirs(fixture_dir)
+        archive = zipfile.ZipFile(os.path.join(fixture_dir, "framework.jar"), "w", zipfile.ZIP_DEFLATED)
+        try:
+            archive.writestr("META-INF/MANIFEST.MF", "Manifest-Version: 1.0\r\nCreated-By: tingle-bench\r\n\r\n")
+            for dex_filename in dex_files:
+                archive.write(os.path.join(work_dir, dex_filename), dex_filename)
+        finally:
+            archive.close()
+        write_file(os.path.join(fixture_dir, "build.prop"), "ro.build.version.sdk=" + params["sdk"] + "\n")
+    finally:
+        shutil.rmtree(work_dir, True)
+
+
+def get_fixture(fixtures_dir, variant, params):
+    """Return the folder of the fixture, it is generated only the first time."""
+    key = json.dumps([GENERATOR_VERSION, variant, params], sort_keys=True)
+    fixture_dir = os.path.join(fixtures_dir, hashlib.md5(key.encode("utf-8")).hexdigest())
+    if not os.path.exists(os.path.join(fixture_dir, "build.prop")):
+        shutil.rmtree(fixture_dir, True)
+        print("Generating fixture: " + variant[2] + " " + json.dumps(params, sort_keys=True))
+        generate_fixture(fixture_dir, variant, params)
+    return fixture_dir
+
+
+def run_once(fixture_dir, work_dir):
+    """Run main.py on the fixture and return its trace."""
+    output_dir = os.path.join(work_dir, "output")
+    trace_file = os.path.join(work_dir, "trace.json")
+    log_file = os.path.join(work_dir, "log.txt")
+    fo = open(log_file, "wb")
+    try:
+        returncode = subprocess.call([sys.executable, os.path.join(SCRIPT_DIR, "main.py"), "--mode", "2", "--input-dir", fixture_dir,
+                                      "--output-dir", output_dir, "--trace", trace_file, "--no-cache"], stdout=fo, stderr=subprocess.STDOUT)
+    finally:
+        fo.close()
+    if returncode != 0:
+        fo = open(log_file, "r")
+        try:
+            log = fo.read()
+        finally:
+            fo.close()
+        raise RuntimeError("main.py has failed with code " + str(returncode) + ":\n" + log[-2000:])
+    fo = open(trace_file, "r")
+    try:
+        return json.load(fo)
+    finally:
+        fo.close()
+
+
+def check_rebalance(trace):
+    """Raise RuntimeError if the packages have not been moved by the planned rebalance."""
+    for event in trace["stages"]:
+        if event["name"] == "rebalance" and event.get("args", {}).get("planned"):
+            return
+    raise RuntimeError("The planned rebalance has not been done, the fixture does not exercise the 64K planner")
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def get_stage_times(trace):
+    times = dict([(stage, 0.0) for stage in STAGES])
+    for event in trace["stages"]:
+        if event["name"] in times:
+            times[event["name"]] += event["wall_time"]
+    return times
+
+
+def run_benchmark(fixtures_dir, scenario, variant, params, repeat):
+    fixture_dir = get_fixture(fixtures_dir, variant, params)
+    traces = []
+    for __ in range(repeat):
+        work_dir = tempfile.mkdtemp(prefix="tingle-bench-")
+        try:
+            traces.append(run_once(fixture_dir, work_dir))
+            if params.get("expect_rebalance"):
+                check_rebalance(traces[-1])
+        finally:
+            shutil.rmtree(work_dir, True)
+    stage_times = [get_stage_times(trace) for trace in traces]
+    return {
+        "name": scenario + " / " + variant[2],
+        "params": params,
+        "repeat": repeat,
+        "stages": dict([(stage, round(median([times[stage] for times in stage_times]), 4)) for stage in STAGES]),
+        "total": round(median([trace["wall_time"] for trace in traces]), 4),
+        "children_cpu_time": round(median([trace["children_cpu_time"] for trace in traces]), 3),
+        "max_rss": max([trace["max_rss"] or 0 for trace in traces]) or None,
+    }
+
+
+def get_revision():
+    try:
+        fo = open(os.devnull, "wb")
+        try:
+            return subprocess.check_output(["git", "-C", SCRIPT_DIR, "describe", "--always", "--dirty"], stderr=fo).decode("utf-8").strip()
+        finally:
+            fo.close()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(results_file):
+    history = []
+    if not os.path.exists(results_file):
+        return history
+    fo = open(results_file, "r")
+    try:
+        for line in fo:
+            if line.strip():
+                history.append(json.loads(line))
+    finally:
+        fo.close()
+    return history
+
+
+def find_previous(history, result):
+    for record in reversed(history):
+        if record["name"] == result["name"] and record["params"] == result["params"]:
+            return record
+    return None
+
+
+def is_regression(value, previous, threshold):
+    # The stages that take a few milliseconds are ignored, their changes are only noise
+    return bool(previous) and (value - previous) * 100.0 / previous > threshold and value - previous > 0.05
+
+
+def show_result(result, previous, threshold):
+    regressions = 0
+    print(result["name"] + (" - compared with " + str(previous["revision"]) if previous else ""))
+    for stage in STAGES + ("total", ):
+        if stage == "total":
+            value, old_value = result["total"], previous["total"] if previous else None
+        else:
+            value, old_value = result["stages"][stage], previous["stages"].get(stage) if previous else None
+        change = ""
+        if old_value:
+            change = " ({0:+.1f}%)".format((value - old_value) * 100.0 / old_value)
+            if is_regression(value, old_value, threshold):
+                change += "  REGRESSION"
+                regressions += 1
+        print("    {0:<12}{1:>9.3f} s{2}".format(stage, value, change))
+    return regressions
+
+
+def main():
+    from optparse import OptionParser
+
+    variants = load_variants()
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--scenario", action="append", choices=sorted(SCENARIOS), help="scenario to run, it can be repeated (default: small)")
+    parser.add_option("--variant", action="append", type="int", help="index of the variant of generatePackageInfo, it can be repeated (default: all)")
+    parser.add_option("--dex", type="int", help="override the number of dex files")
+    parser.add_option("--classes", type="int", help="override the number of classes per dex")
+    parser.add_option("--methods", type="int", help="override the number of methods per dex")
+    parser.add_option("--repeat", type="int", default=3, help="runs for every benchmark, the median is taken (default: %default)")
+    parser.add_option("--fixtures-dir", default=os.path.join(BENCH_DIR, "fixtures"), help="where the generated fixtures are kept")
+    parser.add_option("--results", default=os.path.join(BENCH_DIR, "results.jsonl"), help="history of the results (default: %default)")
+    parser.add_option("--threshold", type="float", default=10.0, help="slowdown (percent) reported as a regression (default: %default)")
+    parser.add_option("--check", action="store_true", default=False, help="exit with code 2 if there are regressions")
+    options = parser.parse_args()[0]
+
+    history = load_history(options.results)
+    revision = get_revision()
+    regressions = 0
+    for scenario in options.scenario or ["small"]:
+        params = dict(SCENARIOS[scenario])
+        for key, value in (("dex_count", options.dex), ("classes_count", options.classes), ("methods_count", options.methods)):
+            if value is not None:
+                params[key] = value
+        for variant_index in options.variant or range(len(variants)):
+            try:
+                result = run_benchmark(options.fixtures_dir, scenario, variants[variant_index], params, options.repeat)
+            except (RuntimeError, subprocess.CalledProcessError):
+                print("ERROR: " + str(sys.exc_info()[1]))
+                return 1
+            result.update({"time": time.time(), "revision": revision, "python": sys.version.split()[0], "platform": sys.platform})
+            regressions += show_result(result, find_previous(history, result), options.threshold)
+
+            fo = open(options.results, "a")
+            try:
+                fo.write(json.dumps(result, sort_keys=True) + "\n")
+            finally:
+                fo.close()
+            history.append(result)
+
+    if regressions:
+        print(str(regressions) + " regression(s) over " + str(options.threshold) + "%")
+        if options.check:
+            return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark of the startup time: main.py --check-deps against an empty run of the same interpreter.
+
+The time of the interpreter itself is subtracted, so the target is about the startup of Tingle
+(imports, compatibility layer, dependency resolution) and it does not depend much on the machine.
+Exit with code 1 if the warm startup is slower than the target.
+"""
+
+import os
+import sys
+import time
+import shutil
+import subprocess
+
+__author__ = "ale5000"
+__copyright__ = "Copyright (C) 2016-2017, ale5000"
+__license__ = "GPLv3"
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STARTUP_CACHE_FILE = os.path.join(SCRIPT_DIR, "cache", "startup.json")
+TARGET = 0.15  # Seconds over the bare interpreter
+
+
+def measure(cmd):
+    devnull = open(os.devnull, "wb")
+    try:
+        start = time.time()
+        returncode = subprocess.call(cmd, stdout=devnull, stderr=devnull)
+        elapsed = time.time() - start
+    finally:
+        devnull.close()
+    if returncode not in (0, 65):  # 65 means that some dependencies are missing, the startup is measured anyway
+        raise RuntimeError("The command has failed with code "+str(returncode)+": "+" ".join(cmd))
+    return elapsed
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    runs = 15
+    target = TARGET
+    if len(sys.argv) > 1:
+        target = float(sys.argv[1])
+    tingle_cmd = [sys.executable, os.path.join(SCRIPT_DIR, "main.py"), "--check-deps"]
+
+    # Cold: without the startup cache (it is restored at the end)
+    backup_file = STARTUP_CACHE_FILE+".bench-backup"
+    if os.path.exists(STARTUP_CACHE_FILE):
+        shutil.move(STARTUP_CACHE_FILE, backup_file)
+    try:
+        cold_time = measure(tingle_cmd)
+    finally:
+        if os.path.exists(backup_file):
+            if os.path.exists(STARTUP_CACHE_FILE):
+                os.remove(STARTUP_CACHE_FILE)
+            shutil.move(backup_file, STARTUP_CACHE_FILE)
+
+    measure(tingle_cmd)  # Make sure that the cache is filled
+    interpreter_time = median([measure([sys.executable, "-c", "pass"]) for __ in range(runs)])
+    warm_time = median([measure(tingle_cmd) for __ in range(runs)])
+    overhead = warm_time - interpreter_time
+
+    print("Interpreter:    {0:.3f} s".format(interpreter_time))
+    print("Cold startup:   {0:.3f} s".format(cold_time))
+    print("Warm startup:   {0:.3f} s".format(warm_time))
+    print("Overhead:       {0:.3f} s (target: {1:.3f} s)".format(overhead, target))
+    if overhead > target:
+        print("The startup is slower than the target")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
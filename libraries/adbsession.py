@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""AdbSession - Persistent adb shell channel with framed output and per-command timeouts."""
+
+import os
+import re
+import sys
+import time
+import binascii
+import threading
+import subprocess
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # Python 2
+
+__author__ = "ale5000"
+__copyright__ = "Copyright (C) 2016-2017, ale5000"
+__license__ = "GPLv3"
+
+SENTINEL_PREFIX = "TINGLE-END-"
+START_TIMEOUT = 15
+
+
+class AdbSessionError(Exception):
+    """Raised when the session is not usable (the command may be executed with a new adb process instead)."""
+
+
+class AdbSessionTimeout(AdbSessionError):
+    """Raised when a command does not end in time, the session is closed."""
+
+
+class AdbSession(object):
+    """Keep a single adb shell open for a device and run commands through it.
+
+    The end of every command is marked by a random sentinel followed by its exit code,
+    the input of the commands is redirected from /dev/null so they cannot consume the next ones.
+    """
+
+    def __init__(self, adb_path, serial):
+        self.adb_path = adb_path
+        self.serial = serial
+        self.process = None
+        self._lines = None
+        self.commands_count = 0
+        self.starts_count = 0
+
+    def _read_lines(self, stdout, lines):
+        for line in iter(stdout.readline, b""):
+            lines.put(line)
+        lines.put(None)
+
+    def _start(self):
+        try:
+            self.process = subprocess.Popen([self.adb_path, "-s", self.serial, "shell"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError:
+            e = sys.exc_info()[1]
+            raise AdbSessionError(str(e))
+        self.starts_count += 1
+        self._lines = queue.Queue()
+        reader = threading.Thread(target=self._read_lines, args=(self.process.stdout, self._lines))
+        reader.daemon = True
+        reader.start()
+        # Old versions of adb always allocate a terminal, disable the echo and the prompts
+        try:
+            self.process.stdin.write(b"stty -echo 2>/dev/null; PS1=''; PS2=''; export PS1 PS2\n")
+        except (IOError, OSError):
+            self.close()
+            raise AdbSessionError("The adb shell cannot be started")
+        self._run("true", START_TIMEOUT)  # Wait until the shell is ready
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        deadline = time.time() + 2
+        while self.process.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def _run(self, command, timeout):
+        token = SENTINEL_PREFIX + binascii.hexlify(os.urandom(8)).decode("ascii")
+        # The command runs in a subshell so even "exit" cannot close the session,
+        # the token is split in the command so the echo of the terminal (if any) cannot match it
+        framed = "( " + command + "\n) </dev/null 2>&1; echo \"" + token[:6] + "\"\"" + token[6:] + " $?\"\n"
+        try:
+            self.process.stdin.write(framed.encode("utf-8"))
+            self.process.stdin.flush()
+        except (IOError, OSError):
+            self.close()
+            raise AdbSessionError("The adb shell has been closed")
+
+        end_regex = re.compile(b"^(.*)" + token.encode("ascii") + b" (\\d+)$")
+        output = []
+        deadline = time.time() + timeout
+        while True:
+            try:
+                line = self._lines.get(True, max(deadline - time.time(), 0.01))
+            except queue.Empty:
+                self.close()
+                raise AdbSessionTimeout("The command has exceeded the timeout of "+str(timeout)+" seconds: "+command)
+            if line is None:
+                self.close()
+                raise AdbSessionError("The adb shell has been closed")
+            line = line.rstrip(b"\r\n").replace(b"\r", b"")
+            match = end_regex.match(line)
+            if match is not None:
+                if match.group(1):
+                    output.append(match.group(1))  # Output without a final new line
+                return int(match.group(2)), b"\n".join(output) + (b"\n" if output else b"")
+            output.append(line)
+
+    def run(self, command, timeout=30):
+        """Return a tuple with the exit code and the output (stdout and stderr merged) of a shell command."""
+        if self.process is None or self.process.poll() is not None:
+            self.close()
+            self._start()
+        self.commands_count += 1
+        return self._run(command, timeout)
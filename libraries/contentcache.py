@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""ContentCache - Content-addressed on-disk store of directory trees with LRU eviction."""
+
+import os
+import sys
+import time
+import json
+import shutil
+import hashlib
+
+__author__ = "ale5000"
+__copyright__ = "Copyright (C) 2016-2017, ale5000"
+__license__ = "GPLv3"
+
+META_FILE = "meta.json"
+STATS_FILE = "stats.json"
+TREE_DIR = "tree"
+FICLONE = 0x40049409  # Linux ioctl for copy-on-write clones (btrfs, xfs, ...)
+
+
+def hash_file(filename, algorithm="sha256"):
+    digest = hashlib.new(algorithm)
+    fo = open(filename, "rb")
+    try:
+        while True:
+            chunk = fo.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+    finally:
+        fo.close()
+    return digest.hexdigest()
+
+
+def make_key(*parts):
+    return hashlib.sha256("\0".join([str(part) for part in parts]).encode("utf-8")).hexdigest()
+
+
+def _clone_file(src, dest):
+    import fcntl
+
+    src_fo = open(src, "rb")
+    try:
+        dest_fo = open(dest, "wb")
+        try:
+            fcntl.ioctl(dest_fo.fileno(), FICLONE, src_fo.fileno())
+        finally:
+            dest_fo.close()
+    finally:
+        src_fo.close()
+
+
+class _TreeLinker(object):
+    """Replicate a tree using the cheapest method supported: hardlink, copy-on-write clone or copy."""
+
+    def __init__(self, hardlinks=True):
+        self.methods = [os.link, _clone_file, shutil.copyfile]
+        if not hardlinks or "link" not in os.__dict__:
+            self.methods.pop(0)
+        if not sys.platform.startswith("linux"):
+            self.methods.remove(_clone_file)
+
+    def copy_file(self, src, dest):
+        if os.path.exists(dest):
+            os.remove(dest)
+        while len(self.methods) > 1:
+            try:
+                return self.methods[0](src, dest)
+            except (IOError, OSError, ImportError):
+                if os.path.exists(dest):
+                    os.remove(dest)
+                self.methods.pop(0)  # Not supported here, never try it again
+        return self.methods[0](src, dest)
+
+    def copy_tree(self, src_dir, dest_dir):
+        """Return a tuple with the total size and the number of files replicated."""
+        total_size = 0
+        files_count = 0
+        for root, __, files in os.walk(src_dir):
+            rel_root = os.path.relpath(root, src_dir)
+            dest_root = os.path.normpath(os.path.join(dest_dir, rel_root))
+            if not os.path.exists(dest_root):
+                os.makedirs(dest_root)
+            for filename in files:
+                self.copy_file(os.path.join(root, filename), os.path.join(dest_root, filename))
+                total_size += os.path.getsize(os.path.join(dest_root, filename))
+                files_count += 1
+        return total_size, files_count
+
+
+def clone_file(src, dest):
+    """Replicate a single file as a copy-on-write clone or a copy, the two files never share the data when one is changed."""
+    _TreeLinker(False).copy_file(src, dest)
+
+
+class ContentCache(object):
+    """Store directory trees by key, the least recently used entries are evicted above max_size (bytes).
+
+    Restored trees may be hardlinks to the cached files: a file must be deleted (not overwritten) before changing it.
+    """
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def _read_json(self, filename, default):
+        try:
+            fo = open(filename, "r")
+            try:
+                return json.load(fo)
+            finally:
+                fo.close()
+        except (IOError, OSError, ValueError):
+            return default
+
+    def _write_json(self, filename, data):
+        tmp_file = filename+".tmp-"+str(os.getpid())
+        fo = open(tmp_file, "w")
+        try:
+            json.dump(data, fo)
+        finally:
+            fo.close()
+        if os.path.exists(filename):
+            os.remove(filename)  # Required on Windows
+        os.rename(tmp_file, filename)
+
+    def _update_stats(self, counter, amount=1):
+        stats_file = os.path.join(self.root, STATS_FILE)
+        stats = self._read_json(stats_file, {})
+        stats[counter] = stats.get(counter, 0) + amount
+        try:
+            self._write_json(stats_file, stats)
+        except (IOError, OSError):
+            pass  # The stats are only informative
+
+    def lookup(self, key):
+        """Return the path of the cached tree (and mark it as recently used) or None."""
+        entry_dir = self._entry_dir(key)
+        meta_file = os.path.join(entry_dir, META_FILE)
+        if not os.path.exists(meta_file):
+            self._update_stats("misses")
+            return None
+        os.utime(meta_file, None)
+        self._update_stats("hits")
+        return os.path.join(entry_dir, TREE_DIR)
+
+    def restore(self, key, dest_dir):
+        tree = self.lookup(key)
+        if tree is None:
+            return False
+        _TreeLinker().copy_tree(tree, dest_dir)
+        return True
+
+    def store(self, key, src_dir, info=None):
+        entry_dir = self._entry_dir(key)
+        if os.path.exists(entry_dir):
+            return False
+        tmp_dir = entry_dir+".tmp-"+str(os.getpid())
+        try:
+            size, files_count = _TreeLinker().copy_tree(src_dir, os.path.join(tmp_dir, TREE_DIR))
+            meta = {"size": size, "files": files_count, "created": time.time()}
+            if info:
+                meta["info"] = info
+            self._write_json(os.path.join(tmp_dir, META_FILE), meta)
+            os.rename(tmp_dir, entry_dir)
+        except (IOError, OSError):
+            shutil.rmtree(tmp_dir, True)  # Another process stored it first or the disk is full
+            return False
+        self._update_stats("stores")
+        self.evict()
+        return True
+
+    def entries(self):
+        """Return a list of (key, size, last used, meta) sorted from the least recently used."""
+        result = []
+        for key in os.listdir(self.root):
+            meta_file = os.path.join(self.root, key, META_FILE)
+            if not os.path.exists(meta_file):
+                continue
+            meta = self._read_json(meta_file, {})
+            result.append((key, meta.get("size", 0), os.path.getmtime(meta_file), meta))
+        result.sort(key=lambda entry: entry[2])
+        return result
+
+    def evict(self):
+        entries = self.entries()
+        total_size = sum([entry[1] for entry in entries])
+        evicted = 0
+        for key, size, __, __ in entries:
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(self._entry_dir(key), True)
+            total_size -= size
+            evicted += 1
+        if evicted:
+            self._update_stats("evictions", evicted)
+        return evicted
+
+    def clear(self):
+        for key, __, __, __ in self.entries():
+            shutil.rmtree(self._entry_dir(key), True)
+
+    def stats(self):
+        entries = self.entries()
+        stats = self._read_json(os.path.join(self.root, STATS_FILE), {})
+        stats["entries"] = len(entries)
+        stats["size"] = sum([entry[1] for entry in entries])
+        stats["max_size"] = self.max_size
+        if entries:
+            stats["oldest_use"] = entries[0][2]
+            stats["newest_use"] = entries[-1][2]
+        return stats
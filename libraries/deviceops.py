@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""DeviceOps - Device operations that wait for real readiness signals instead of fixed timeouts.
+
+Every operation is a generator (a task) that yields requests to a driver: the synchronous driver of this
+module or the asyncio driver of deviceops_async, so the same logic runs on both Python 2 and Python 3.
+A task can yield another task to run it and receive its result.
+"""
+
+import sys
+import time
+import types
+import subprocess
+
+__author__ = "ale5000"
+__copyright__ = "Copyright (C) 2016-2017, ale5000"
+__license__ = "GPLv3"
+
+ADB = "adb"  # Request: (ADB, args, timeout), the driver returns (exit code or None on timeout, output)
+SLEEP = "sleep"  # Request: (SLEEP, seconds)
+RESULT = "result"  # Request: (RESULT, value), it ends the task
+
+BACKOFF_START = 0.1  # Seconds
+BACKOFF_MAX = 2.0
+COMMAND_TIMEOUT = 20
+READY_TIMEOUT = 120
+TRANSFER_TIMEOUT = 600
+
+
+class DeviceError(Exception):
+    """Raised when a device operation fails, code is the exit code to use."""
+
+    def __init__(self, message, code):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+def poll(args, is_ready, timeout):
+    """Task: repeat an adb command with exponential backoff until is_ready(output) is True, the result is a bool."""
+    deadline = time.time() + timeout
+    delay = BACKOFF_START
+    while True:
+        code, output = yield (ADB, args, COMMAND_TIMEOUT)
+        if code == 0 and is_ready(output):
+            yield (RESULT, True)
+        if time.time() + delay > deadline:
+            yield (RESULT, False)
+        yield (SLEEP, delay)
+        delay = min(delay * 2, BACKOFF_MAX)
+
+
+def is_rw_mounted(mount_output, partition):
+    for line in mount_output.splitlines():
+        fields = line.split()
+        # Both the formats are in use: "dev on /system type ext4 (rw,...)" and "dev /system ext4 rw,... 0 0"
+        if partition in fields[1:3] and "rw" in line.replace("(", " ").replace(",", " ").split():
+            return True
+    return False
+
+
+def wait_ready(timeout=READY_TIMEOUT):
+    """Task: wait until the device is online and, if not in recovery, fully booted. The result is the state."""
+    deadline = time.time() + timeout
+    if not (yield poll(["get-state"], lambda output: output.strip() in ("device", "recovery"), timeout)):
+        raise DeviceError("The device is not reachable", 92)
+    code, state = yield (ADB, ["get-state"], COMMAND_TIMEOUT)
+    state = state.strip()
+    if state == "device":  # In recovery the properties of the system are not loaded
+        if not (yield poll(["shell", "getprop sys.boot_completed"], lambda output: output.strip() == "1", max(deadline - time.time(), 0))):
+            raise DeviceError("The device has not completed the boot", 92)
+    yield (RESULT, state)
+
+
+def root(timeout=READY_TIMEOUT):
+    """Task: restart adbd as root, the result is True if adbd is unlocked (running as root)."""
+    code, output = yield (ADB, ["root"], COMMAND_TIMEOUT)
+    if "root access is disabled" in output:
+        raise DeviceError("You do NOT have root or root access is disabled.\nEnable it in Settings -> Developer options -> Root access -> Apps and ADB.", 80)
+    if "adbd is already running as root" in output:
+        yield (RESULT, True)
+    if "adbd cannot run as root in production builds" in output:
+        yield (RESULT, False)
+    # adbd is restarting, the device goes offline for a moment
+    if not (yield poll(["shell", "id -u"], lambda output: output.strip() == "0", timeout)):
+        raise DeviceError("adbd has not restarted as root", 80)
+    yield (RESULT, True)
+
+
+def remount(unlocked, partition="/system", timeout=READY_TIMEOUT):
+    """Task: remount the partition as read-write, the result is the output of the remount command."""
+    if unlocked:
+        code, output = yield (ADB, ["remount"], timeout)
+        if code is None:
+            raise DeviceError("Remount has exceeded the timeout", 81)
+        if "Not running as root" in output:
+            raise DeviceError("Remount failed.", 81)
+    else:
+        code, output = yield (ADB, ["shell", "su -c 'mount -o remount,rw "+partition+" "+partition+" && mount' | grep ' "+partition+" '"], timeout)  # Untested
+        if "su: not found" in output:
+            raise DeviceError("The device is NOT rooted.", 81)
+        if "rw," not in output:
+            raise DeviceError("Alternative remount failed.", 81)
+    if ("remount failed" in output) and ("Success" not in output):  # Do NOT stop with "remount failed: Success"
+        raise DeviceError("Remount failed.", 81)
+    # Some devices need a moment before the mount flags change, the system may also be mounted as root (/)
+    yield poll(["shell", "mount"], lambda mount_output: is_rw_mounted(mount_output, partition) or is_rw_mounted(mount_output, "/"), min(timeout, 10))
+    yield (RESULT, output)
+
+
+def enable_writing(timeout=READY_TIMEOUT):
+    """Task: root adbd, wait for the device and remount /system as read-write. The result is (unlocked, remount output)."""
+    unlocked = yield root(timeout)
+    yield wait_ready(timeout)
+    output = yield remount(unlocked, "/system", timeout)
+    yield (RESULT, (unlocked, output))
+
+
+def push(local_file, remote_file, timeout=TRANSFER_TIMEOUT):
+    """Task: the result is a tuple with the exit code and the output of adb push."""
+    code, output = yield (ADB, ["push", local_file, remote_file], timeout)
+    if code is None:
+        raise DeviceError("Pushing has exceeded the timeout", 1)
+    yield (RESULT, (code, output))
+
+
+def reboot(target, timeout=READY_TIMEOUT):
+    """Task: reboot the device (e.g. to recovery) and wait until it is back online. The result is the new state."""
+    yield (ADB, ["reboot", target], COMMAND_TIMEOUT)
+    yield (SLEEP, 1)  # The device may be still online for a moment
+    state = yield wait_ready(timeout)
+    yield (RESULT, state)
+
+
+def _decode(output):
+    try:
+        return output.decode("utf-8")
+    except UnicodeError:
+        return output.decode("latin-1")
+
+
+def run_adb(adb_path, serial, args, timeout):
+    """Return a tuple with the exit code (None on timeout) and the output."""
+    process = subprocess.Popen([adb_path, "-s", serial] + list(args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if "TimeoutExpired" in subprocess.__dict__:
+        try:
+            output = process.communicate(timeout=timeout)[0]
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            return None, ""
+    else:
+        output = process.communicate()[0]  # Python 2
+    return process.returncode, _decode(output)
+
+
+class TaskRunner(object):
+    """Execute a task (and its sub-tasks), step() returns the requests that the driver must handle."""
+
+    def __init__(self, task):
+        self.stack = [task]
+        self.value = None
+        self.error = None
+
+    def step(self):
+        """Advance the task until the next request, return it (or None when the task has ended)."""
+        while self.stack:
+            generator = self.stack[-1]
+            try:
+                if self.error is not None:
+                    error, self.error = self.error, None
+                    request = generator.throw(error[1])
+                else:
+                    request = generator.send(self.value)
+            except StopIteration:
+                self.stack.pop()
+                self.value = None
+                continue
+            except Exception:
+                self.stack.pop()
+                if not self.stack:
+                    raise
+                self.error = sys.exc_info()  # Propagate the exception to the parent task
+                continue
+            self.value = None
+            if isinstance(request, types.GeneratorType):
+                self.stack.append(request)
+                continue
+            if request[0] == RESULT:
+                generator.close()
+                self.stack.pop()
+                self.value = request[1]
+                if not self.stack:
+                    return None
+                continue
+            return request
+        return None
+
+    def set_value(self, value):
+        self.value = value
+
+
+def run_sync(task, adb_path, serial):
+    """Synchronous driver, return the result of the task."""
+    runner = TaskRunner(task)
+    while True:
+        request = runner.step()
+        if request is None:
+            return runner.value
+        if request[0] == ADB:
+            runner.set_value(run_adb(adb_path, serial, request[1], request[2]))
+        elif request[0] == SLEEP:
+            time.sleep(request[1])
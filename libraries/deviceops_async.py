@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""DeviceOpsAsync - Asyncio driver for the tasks of deviceops (Python 3.5 or later only)."""
+
+import asyncio
+
+from deviceops import ADB, SLEEP, TaskRunner, _decode
+
+__author__ = "ale5000"
+__copyright__ = "Copyright (C) 2016-2017, ale5000"
+__license__ = "GPLv3"
+
+
+async def run_adb(adb_path, serial, args, timeout):
+    """Return a tuple with the exit code (None on timeout) and the output."""
+    process = await asyncio.create_subprocess_exec(adb_path, "-s", serial, *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+    try:
+        output = (await asyncio.wait_for(process.communicate(), timeout))[0]
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.communicate()
+        return None, ""
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    return process.returncode, _decode(output)
+
+
+async def run_task(task, adb_path, serial):
+    """Asyncio driver, return the result of the task."""
+    runner = TaskRunner(task)
+    while True:
+        request = runner.step()
+        if request is None:
+            return runner.value
+        if request[0] == ADB:
+            runner.set_value(await run_adb(adb_path, serial, request[1], request[2]))
+        elif request[0] == SLEEP:
+            await asyncio.sleep(request[1])
+
+
+async def _run_with_host_function(task, adb_path, serial, host_function):
+    loop = asyncio.get_event_loop()
+    host_future = loop.run_in_executor(None, host_function)
+    device_future = asyncio.ensure_future(run_task(task, adb_path, serial))
+    await asyncio.wait([host_future, device_future], return_when=asyncio.FIRST_EXCEPTION)
+    if host_future.done() and host_future.exception() is not None:
+        # There is nothing to push, do not leave the device half prepared in the background
+        device_future.cancel()
+        await asyncio.wait([device_future])
+        host_future.result()
+    await asyncio.wait([host_future, device_future])
+    return host_future.result(), device_future
+
+
+def run(task, adb_path, serial):
+    """Run the task on a new event loop and return its result."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run_task(task, adb_path, serial))
+    finally:
+        loop.close()
+
+
+def run_with_host_function(task, adb_path, serial, host_function):
+    """Run the device task on the event loop while host_function runs in a thread.
+
+    Return the result of host_function and the finished future of the task (its result may be an exception).
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_run_with_host_function(task, adb_path, serial, host_function))
+    finally:
+        loop.close()
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""DexFile - Minimal reader for the Dalvik executable format."""
+
+import os
+import mmap
+import struct
+
+__author__ = "ale5000"
+__copyright__ = "Copyright (C) 2016-2017, ale5000"
+__license__ = "GPLv3"
+
+CLASS_DEF_ITEM_SIZE = 32
+
+
+def _build_opcode_sizes():
+    """Return the size (in 16-bit code units) of every instruction, indexed by opcode."""
+    sizes = [1] * 256
+    for opcode in (0x02, 0x05, 0x08, 0x13, 0x15, 0x16, 0x19, 0x1a, 0x1c, 0x1f, 0x20, 0x22, 0x23, 0x29, 0xfe, 0xff):
+        sizes[opcode] = 2
+    for opcode in (0x03, 0x06, 0x09, 0x14, 0x17, 0x1b, 0x24, 0x25, 0x26, 0x2a, 0x2b, 0x2c, 0xfc, 0xfd):
+        sizes[opcode] = 3
+    for first, last in ((0x2d, 0x3d), (0x44, 0x6d), (0x90, 0xaf), (0xd0, 0xe2)):
+        for opcode in range(first, last + 1):
+            sizes[opcode] = 2
+    for first, last in ((0x6e, 0x72), (0x74, 0x78)):
+        for opcode in range(first, last + 1):
+            sizes[opcode] = 3
+    sizes[0x18] = 5  # const-wide
+    sizes[0xfa] = sizes[0xfb] = 4  # invoke-polymorphic
+    return sizes
+
+
+OPCODE_SIZES = _build_opcode_sizes()
+FIELD_REF_OPCODES = frozenset(range(0x52, 0x6e))  # iget / iput / sget / sput
+METHOD_REF_OPCODES = frozenset(list(range(0x6e, 0x73)) + list(range(0x74, 0x79)) + [0xfa, 0xfb])  # invoke-*
+
+
+class DexError(Exception):
+    """Raised when a file is not a valid dex file or it cannot be handled."""
+
+
+# Errors that can be raised while reading a damaged or unsupported file
+READ_ERRORS = (DexError, EnvironmentError, ValueError, IndexError, struct.error)
+
+
+def _read_uint(data, offset):
+    return struct.unpack_from("<I", data, offset)[0]
+
+
+def _read_uleb128(data, offset):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        if not isinstance(byte, int):
+            byte = ord(byte)  # Python 2
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, offset
+        shift += 7
+
+
+def _read_string(data, string_ids_off, string_idx):
+    string_data_off = _read_uint(data, string_ids_off + string_idx * 4)
+    __, start = _read_uleb128(data, string_data_off)  # Skip the utf16 size
+    end = data.find(b"\0", start)
+    return bytes(data[start:end])
+
+
+def check_header(data):
+    if data[:4] != b"dex\n" or len(data) < 0x70:
+        raise DexError("Invalid dex magic")
+    if _read_uint(data, 0x28) != 0x12345678:
+        raise DexError("Unsupported endianness")
+
+
+def get_class_descriptors(data):
+    """Return the descriptors of the classes defined in the dex, in class_defs order."""
+    check_header(data)
+    string_ids_off = _read_uint(data, 0x3C)
+    type_ids_off = _read_uint(data, 0x44)
+    class_defs_size = _read_uint(data, 0x60)
+    class_defs_off = _read_uint(data, 0x64)
+
+    descriptors = []
+    for i in range(class_defs_size):
+        class_idx = _read_uint(data, class_defs_off + i * CLASS_DEF_ITEM_SIZE)
+        descriptor_idx = _read_uint(data, type_ids_off + class_idx * 4)
+        descriptors.append(_read_string(data, string_ids_off, descriptor_idx).decode("utf-8", "replace"))
+    return descriptors
+
+
+def _read_type_list(data, offset):
+    if offset == 0:
+        return ()
+    size = _read_uint(data, offset)
+    return struct.unpack_from("<"+str(size)+"H", data, offset + 4)
+
+
+class DexFile(object):
+    """Read-only index of a dex file, the file is memory mapped and tables are read on demand.
+
+    When data is given (e.g. a dex read from an archive) it is used instead of the file.
+    """
+
+    def __init__(self, filename, data=None):
+        self.filename = filename
+        self._fo = None
+        if data is not None:
+            if len(data) < 0x70:
+                raise DexError("File too small to be a dex: "+filename)
+            check_header(data)
+            self.data = data
+        else:
+            self._fo = open(filename, "rb")
+            try:
+                if os.fstat(self._fo.fileno()).st_size < 0x70:
+                    raise DexError("File too small to be a dex: "+filename)
+                self.data = mmap.mmap(self._fo.fileno(), 0, access=mmap.ACCESS_READ)
+                check_header(self.data)
+            except Exception:
+                self._fo.close()
+                raise
+
+        header = struct.unpack_from("<8I", self.data, 0x38)
+        self.string_ids_size, self.string_ids_off = header[0:2]
+        self.type_ids_size, self.type_ids_off = header[2:4]
+        self.proto_ids_size, self.proto_ids_off = header[4:6]
+        self.field_ids_size, self.field_ids_off = header[6:8]
+        header = struct.unpack_from("<4I", self.data, 0x58)
+        self.method_ids_size, self.method_ids_off = header[0:2]
+        self.class_defs_size, self.class_defs_off = header[2:4]
+        self._classes = None
+
+    def close(self):
+        if self._fo is not None:
+            self.data.close()
+            self._fo.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_string(self, string_idx):
+        return _read_string(self.data, self.string_ids_off, string_idx).decode("utf-8", "replace")
+
+    def get_type(self, type_idx):
+        return self.get_string(_read_uint(self.data, self.type_ids_off + type_idx * 4))
+
+    def find_string(self, value):
+        """Binary search of a string in the sorted string_ids table, return its index or None."""
+        value = value.encode("utf-8")
+        low, high = 0, self.string_ids_size
+        while low < high:
+            middle = (low + high) // 2
+            current = _read_string(self.data, self.string_ids_off, middle)
+            if current < value:
+                low = middle + 1
+            elif current > value:
+                high = middle
+            else:
+                return middle
+        return None
+
+    def find_type(self, descriptor):
+        """Binary search of a type in the type_ids table (sorted by string index), return its index or None."""
+        string_idx = self.find_string(descriptor)
+        if string_idx is None:
+            return None
+        low, high = 0, self.type_ids_size
+        while low < high:
+            middle = (low + high) // 2
+            current = _read_uint(self.data, self.type_ids_off + middle * 4)
+            if current < string_idx:
+                low = middle + 1
+            elif current > string_idx:
+                high = middle
+            else:
+                return middle
+        return None
+
+    def _get_classes(self):
+        if self._classes is None:
+            self._classes = {}
+            for i in range(self.class_defs_size):
+                self._classes[_read_uint(self.data, self.class_defs_off + i * CLASS_DEF_ITEM_SIZE)] = i
+        return self._classes
+
+    def get_class_descriptors(self):
+        return get_class_descriptors(self.data)
+
+    def has_class(self, descriptor):
+        type_idx = self.find_type(descriptor)
+        return type_idx is not None and type_idx in self._get_classes()
+
+    def get_proto(self, proto_idx):
+        """Return the descriptor of a prototype, e.g. (II)Landroid/content/pm/PackageInfo;"""
+        __, return_type_idx, parameters_off = struct.unpack_from("<3I", self.data, self.proto_ids_off + proto_idx * 12)
+        params = "".join([self.get_type(type_idx) for type_idx in _read_type_list(self.data, parameters_off)])
+        return "("+params+")"+self.get_type(return_type_idx)
+
+    def get_method(self, method_idx):
+        """Return (class descriptor, method name, prototype) of a method reference."""
+        class_idx, proto_idx, name_idx = struct.unpack_from("<HHI", self.data, self.method_ids_off + method_idx * 8)
+        return self.get_type(class_idx), self.get_string(name_idx), self.get_proto(proto_idx)
+
+    def get_class_methods(self, descriptor):
+        """Return the methods defined by a class as a list of (method signature, access flags).
+
+        The signature has the same format used by smali, e.g. fillinsig(Landroid/content/pm/PackageInfo;)V
+        """
+        type_idx = self.find_type(descriptor)
+        if type_idx is None or type_idx not in self._get_classes():
+            return None
+        class_def_off = self.class_defs_off + self._get_classes()[type_idx] * CLASS_DEF_ITEM_SIZE
+        class_data_off = _read_uint(self.data, class_def_off + 24)
+        methods = []
+        if class_data_off == 0:
+            return methods
+
+        offset = class_data_off
+        sizes = []
+        for __ in range(4):
+            value, offset = _read_uleb128(self.data, offset)
+            sizes.append(value)
+        for __ in range(sizes[0] + sizes[1]):  # Skip static and instance fields
+            __, offset = _read_uleb128(self.data, offset)
+            __, offset = _read_uleb128(self.data, offset)
+        for count in sizes[2:4]:  # Direct and virtual methods
+            method_idx = 0
+            for __ in range(count):
+                method_idx_diff, offset = _read_uleb128(self.data, offset)
+                access_flags, offset = _read_uleb128(self.data, offset)
+                __, offset = _read_uleb128(self.data, offset)  # code_off
+                method_idx += method_idx_diff
+                __, name, proto = self.get_method(method_idx)
+                methods.append((name+proto, access_flags))
+        return methods
+
+    def _add_code_references(self, code_off, method_refs, field_refs):
+        insns_size = _read_uint(self.data, code_off + 12)
+        if insns_size == 0:
+            return
+        insns = struct.unpack_from("<"+str(insns_size)+"H", self.data, code_off + 16)
+        pc = 0
+        while pc < insns_size:
+            unit = insns[pc]
+            opcode = unit & 0xff
+            if opcode == 0x00 and unit != 0:  # Payload pseudo-instructions
+                if unit == 0x0100:  # packed-switch
+                    pc += 4 + insns[pc + 1] * 2
+                elif unit == 0x0200:  # sparse-switch
+                    pc += 2 + insns[pc + 1] * 4
+                elif unit == 0x0300:  # fill-array-data
+                    pc += 4 + (insns[pc + 1] * (insns[pc + 2] | insns[pc + 3] << 16) + 1) // 2
+                else:
+                    raise DexError("Unknown payload at "+hex(code_off))
+                continue
+            if opcode in METHOD_REF_OPCODES:
+                method_refs.add(insns[pc + 1])
+            elif opcode in FIELD_REF_OPCODES:
+                field_refs.add(insns[pc + 1])
+            pc += OPCODE_SIZES[opcode]
+
+    def get_class_references(self, class_def_idx, include_definitions=True):
+        """Return the sets of method ids and field ids defined or referenced by the code of a class.
+
+        With include_definitions set to False only the ids referenced by the code are returned.
+        """
+        method_refs = set()
+        field_refs = set()
+        class_data_off = _read_uint(self.data, self.class_defs_off + class_def_idx * CLASS_DEF_ITEM_SIZE + 24)
+        if class_data_off == 0:
+            return method_refs, field_refs
+
+        offset = class_data_off
+        sizes = []
+        for __ in range(4):
+            value, offset = _read_uleb128(self.data, offset)
+            sizes.append(value)
+        for count in sizes[0:2]:  # Static and instance fields
+            field_idx = 0
+            for __ in range(count):
+                field_idx_diff, offset = _read_uleb128(self.data, offset)
+                __, offset = _read_uleb128(self.data, offset)
+                field_idx += field_idx_diff
+                if include_definitions:
+                    field_refs.add(field_idx)
+        for count in sizes[2:4]:  # Direct and virtual methods
+            method_idx = 0
+            for __ in range(count):
+                method_idx_diff, offset = _read_uleb128(self.data, offset)
+                __, offset = _read_uleb128(self.data, offset)
+                code_off, offset = _read_uleb128(self.data, offset)
+                method_idx += method_idx_diff
+                if include_definitions:
+                    method_refs.add(method_idx)
+                if code_off != 0:
+                    self._add_code_references(code_off, method_refs, field_refs)
+        return method_refs, field_refs
+
+    def get_package_references(self):
+        """Return a dict with the package path (e.g. android/bluetooth/) as key and a tuple of (method ids, field ids)."""
+        packages = {}
+        for i, descriptor in enumerate(self.get_class_descriptors()):
+            package = descriptor[1:descriptor.rfind("/") + 1]
+            method_refs, field_refs = self.get_class_references(i)
+            if package in packages:
+                packages[package][0].update(method_refs)
+                packages[package][1].update(field_refs)
+            else:
+                packages[package] = (method_refs, field_refs)
+        return packages
+
+    def get_class_invoked_methods(self, descriptor):
+        """Return the method ids invoked by the code of a class or None if the class is not defined in the dex."""
+        type_idx = self.find_type(descriptor)
+        if type_idx is None or type_idx not in self._get_classes():
+            return None
+        return self.get_class_references(self._get_classes()[type_idx], False)[0]
+
+    def find_methods_by_name(self, name):
+        """Return the ids of the methods (defined or only referenced) with the given name."""
+        string_idx = self.find_string(name)
+        if string_idx is None:
+            return set()
+        method_ids = set()
+        for method_idx in range(self.method_ids_size):
+            if _read_uint(self.data, self.method_ids_off + method_idx * 8 + 4) == string_idx:
+                method_ids.add(method_idx)
+        return method_ids
+
+    def has_method(self, descriptor, signature):
+        methods = self.get_class_methods(descriptor)
+        if methods is None:
+            return False
+        for method_signature, __ in methods:
+            if method_signature == signature:
+                return True
+        return False
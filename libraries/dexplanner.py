@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""DexPlanner - Predict the 64K reference overflow of a dex and plan which packages to move to another dex."""
+
+import dexfile
+
+__author__ = "ale5000"
+__copyright__ = "Copyright (C) 2016-2017, ale5000"
+__license__ = "GPLv3"
+
+MAX_REFS = 65536  # Method and field ids are 16-bit in the instructions
+SAFETY_MARGIN = 256  # Ids referenced outside the code (e.g. annotations) are not counted
+
+
+class PlannerError(Exception):
+    """Raised when no layout that fits in the limits can be found."""
+
+
+def _removable(package_refs, ref_counts):
+    """Return the number of ids that would disappear from the dex if the package is moved."""
+    return len([idx for idx in package_refs if ref_counts[idx] == 1])
+
+
+def _count_refs(packages, kind):
+    counts = {}
+    for refs in packages.values():
+        for idx in refs[kind]:
+            counts[idx] = counts.get(idx, 0) + 1
+    return counts
+
+
+def plan_rebalance(source_dex, target_dex, methods_delta, fields_delta, excluded_packages=()):
+    """Check if source_dex, after adding the expected new references, still fits in the limits.
+
+    Return None if it fits or the list of the packages to move from source_dex to target_dex.
+    target_dex is None when the packages go to a new dex.
+    """
+    source = dexfile.DexFile(source_dex)
+    try:
+        method_limit = MAX_REFS - SAFETY_MARGIN - methods_delta
+        field_limit = MAX_REFS - SAFETY_MARGIN - fields_delta
+        methods_count, fields_count = source.method_ids_size, source.field_ids_size
+        if methods_count <= method_limit and fields_count <= field_limit:
+            return None
+        packages = source.get_package_references()
+    finally:
+        source.close()
+
+    target_methods = target_fields = 0
+    if target_dex is not None:
+        target = dexfile.DexFile(target_dex)
+        try:
+            target_methods, target_fields = target.method_ids_size, target.field_ids_size
+        finally:
+            target.close()
+
+    method_counts = _count_refs(packages, 0)
+    field_counts = _count_refs(packages, 1)
+    candidates = set(packages) - set(excluded_packages)
+    moved = []
+    moved_methods = set()
+    moved_fields = set()
+    while methods_count > method_limit or fields_count > field_limit:
+        if not candidates:
+            raise PlannerError("There are no more packages that can be moved")
+
+        # Pick the package that frees the most of the exceeded ids, the smallest one on equal terms
+        def _score(package):
+            method_refs, field_refs = packages[package]
+            gain = 0
+            if methods_count > method_limit:
+                gain += _removable(method_refs, method_counts)
+            if fields_count > field_limit:
+                gain += _removable(field_refs, field_counts)
+            return (gain, -len(method_refs) - len(field_refs), package)
+        package = max(candidates, key=_score)
+        if _score(package)[0] == 0:
+            raise PlannerError("Moving packages does not free any reference")
+
+        candidates.remove(package)
+        method_refs, field_refs = packages[package]
+        methods_count -= _removable(method_refs, method_counts)
+        fields_count -= _removable(field_refs, field_counts)
+        for idx in method_refs:
+            method_counts[idx] -= 1
+        for idx in field_refs:
+            field_counts[idx] -= 1
+        moved.append(package)
+        moved_methods.update(method_refs)
+        moved_fields.update(field_refs)
+
+    # In the worst case none of the moved references already exist in the target dex
+    if target_methods + len(moved_methods) > MAX_REFS - SAFETY_MARGIN or target_fields + len(moved_fields) > MAX_REFS - SAFETY_MARGIN:
+        raise PlannerError("The target dex does not have enough free references")
+    return moved
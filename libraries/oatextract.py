@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""OatExtract - Extraction of the dex files embedded in the vdex and oat containers of odexed ROMs.
+
+The containers are memory mapped and the dex files are located by their headers, so the same code works
+with every version of the formats and the big boot images are never loaded in memory.
+"""
+
+import os
+import mmap
+import zlib
+import struct
+
+__author__ = "ale5000"
+__copyright__ = "Copyright (C) 2016-2017, ale5000"
+__license__ = "GPLv3"
+
+VDEX_MAGIC = b"vdex"
+OAT_MAGIC = b"oat\n"
+ELF_MAGIC = b"\x7fELF"
+DEX_MAGIC = b"dex\n"
+CDEX_MAGIC = b"cdex"
+DEX_HEADER_SIZE = 0x70
+CHUNK_SIZE = 1024 * 1024
+MAX_LOCATION_SIZE = 1024
+
+
+class OatError(Exception):
+    """Raised when a container is not supported or the dex files inside it cannot be extracted."""
+
+
+# Errors that can be raised while reading a damaged or unsupported container
+READ_ERRORS = (OatError, EnvironmentError, ValueError, struct.error)
+
+
+def _read_uint(data, offset):
+    return struct.unpack_from("<I", data, offset)[0]
+
+
+def _is_dex_header(data, offset):
+    if offset + DEX_HEADER_SIZE > len(data):
+        return False
+    version = data[offset + 4:offset + 8]
+    if not version[:3].isdigit() or version[3:] != b"\0":
+        return False
+    file_size, header_size, endian_tag = struct.unpack_from("<3I", data, offset + 0x20)
+    return header_size == DEX_HEADER_SIZE and endian_tag == 0x12345678 and DEX_HEADER_SIZE <= file_size <= len(data) - offset
+
+
+def find_dex(data):
+    """Return the offset and the size of every dex embedded in data."""
+    found = []
+    offset = data.find(DEX_MAGIC)
+    while offset != -1:
+        if _is_dex_header(data, offset):
+            size = _read_uint(data, offset + 0x20)
+            found.append((offset, size))
+            offset = data.find(DEX_MAGIC, offset + size)
+        else:
+            offset = data.find(DEX_MAGIC, offset + 1)
+    return found
+
+
+def get_vdex_quickening_size(data):
+    """Return the size of the quickening info of a vdex or None if the version is unknown."""
+    version = data[4:8]
+    if not version[:3].isdigit():
+        return None
+    version = int(version[:3])
+    if version < 19:  # Android 8.x
+        return _read_uint(data, 20)
+    if version < 27:  # Android 9 and 10
+        if data[8:12] == b"000\0":
+            return 0  # No dex section
+        return _read_uint(data, 28)
+    return None
+
+
+def _get_oat_location(data, oat_offset, search_end, dex_offset):
+    """Return the location of a dex embedded in an oat by searching its entry in the dex table of the oat header.
+
+    Every entry has the length of the location, the location, the checksum of the dex and its offset from the header.
+    """
+    pattern = struct.pack("<2I", _read_uint(data, dex_offset + 8), dex_offset - oat_offset)
+    position = data.find(pattern, oat_offset, search_end)
+    while position != -1:
+        for length in range(1, min(MAX_LOCATION_SIZE, position - oat_offset - 4) + 1):
+            if _read_uint(data, position - length - 4) == length:
+                return data[position - length:position].decode("utf-8", "replace")
+        position = data.find(pattern, position + 1, search_end)
+    return None
+
+
+def _get_jar_name(location):
+    """Return the name of the jar of a location, e.g. /system/framework/framework.jar:classes2.dex => framework.jar"""
+    for separator in ("!", ":"):
+        location = location.split(separator)[0]
+    return location.split("/")[-1]
+
+
+def find_jar_dex(data, jar_name):
+    """Return the name, the offset and the size of the dex files of jar_name inside a vdex or oat container."""
+    dex_list = find_dex(data)
+    if not dex_list:
+        if data.find(CDEX_MAGIC) != -1:
+            raise OatError("The dex files are in the compact format (Android 10 or later), it is not supported")
+        raise OatError("No dex file found in the container")
+
+    if data[:4] == VDEX_MAGIC:
+        # Every jar of the boot classpath has its own vdex
+        if get_vdex_quickening_size(data):
+            raise OatError("The dex files are quickened, they cannot be disassembled")
+    elif data[:4] in (ELF_MAGIC, OAT_MAGIC):
+        oat_offset = data.find(OAT_MAGIC, 0, dex_list[0][0])
+        if oat_offset == -1:
+            raise OatError("The oat header cannot be found")
+        jar_dex_list = []
+        for offset, size in dex_list:
+            location = _get_oat_location(data, oat_offset, dex_list[0][0], offset)
+            if location is None:
+                raise OatError("The location of the dex at "+hex(offset)+" cannot be found")
+            if _get_jar_name(location) == jar_name:
+                jar_dex_list.append((offset, size))
+        if not jar_dex_list:
+            raise OatError("The container does not have the dex files of "+jar_name)
+        dex_list = jar_dex_list
+    else:
+        raise OatError("Unknown container format")
+
+    names = ["classes.dex"] + ["classes"+str(i)+".dex" for i in range(2, len(dex_list) + 1)]
+    return [(name, offset, size) for name, (offset, size) in zip(names, dex_list)]
+
+
+def _check_dex(data, offset, size):
+    checksum = 1
+    for start in range(offset + 12, offset + size, CHUNK_SIZE):
+        checksum = zlib.adler32(data[start:min(start + CHUNK_SIZE, offset + size)], checksum)
+    if checksum & 0xffffffff != _read_uint(data, offset + 8):
+        raise OatError("The checksum of the dex at "+hex(offset)+" is not valid")
+
+
+class _Container(object):
+    def __init__(self, filename):
+        self._fo = open(filename, "rb")
+        try:
+            if os.fstat(self._fo.fileno()).st_size < DEX_HEADER_SIZE:
+                raise OatError("File too small to be a container: "+filename)
+            self.data = mmap.mmap(self._fo.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._fo.close()
+            raise
+
+    def close(self):
+        self.data.close()
+        self._fo.close()
+
+
+def iter_dex(container, jar_name):
+    """Yield the name and the content of the dex files of jar_name, one at a time."""
+    fo = _Container(container)
+    try:
+        for name, offset, size in find_jar_dex(fo.data, jar_name):
+            _check_dex(fo.data, offset, size)
+            yield name, fo.data[offset:offset + size]
+    finally:
+        fo.close()
+
+
+def extract_dex(container, out_dir, jar_name):
+    """Copy the dex files of jar_name to out_dir in chunks, return the list of extracted names."""
+    fo = _Container(container)
+    extracted = []
+    try:
+        for name, offset, size in find_jar_dex(fo.data, jar_name):
+            _check_dex(fo.data, offset, size)
+            target = open(os.path.join(out_dir, name), "wb")
+            try:
+                for start in range(offset, offset + size, CHUNK_SIZE):
+                    target.write(fo.data[start:min(start + CHUNK_SIZE, offset + size)])
+            finally:
+                target.close()
+            extracted.append(name)
+    finally:
+        fo.close()
+    return extracted
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""SmaliPatcher - Single-pass patch engine for large smali files."""
+
+import os
+import re
+import mmap
+
+__author__ = "ale5000"
+__copyright__ = "Copyright (C) 2016-2017, ale5000"
+__license__ = "GPLv3"
+
+METHOD_BOUNDARY_RE = re.compile(br"^\.method [^\n]*|^\.end method[^\n]*", re.M)
+CHUNK_SIZE = 1024 * 1024
+
+
+class SmaliError(Exception):
+    """Raised when a smali file is malformed."""
+
+
+class Method(object):
+    """Position of a method inside a smali file (byte offsets)."""
+
+    __slots__ = ("header", "start", "end")
+
+    def __init__(self, header, start, end):
+        self.header = header  # The .method line without the line terminator
+        self.start = start  # Start of the .method line
+        self.end = end  # End of the .end method line (terminator included)
+
+
+class MethodMatcher(object):
+    """Match method headers against a table of (modifiers, signature, value) with a single compiled regex."""
+
+    def __init__(self, table):
+        self.values = {}
+        for modifiers, signature, value in table:
+            self.values[modifiers+" "+signature] = value
+        alternatives = sorted(self.values, key=len, reverse=True)  # The longest match wins
+        self.regex = re.compile(r"^\.method ("+"|".join([re.escape(item) for item in alternatives])+")")
+
+    def match(self, header):
+        match = self.regex.match(header)
+        if match is None:
+            return None
+        return self.values[match.group(1)]
+
+
+class SmaliFile(object):
+    """Memory mapped smali file with an index of the method boundaries, built on first use."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fo = open(filename, "rb")
+        self.size = os.fstat(self._fo.fileno()).st_size
+        if self.size == 0:
+            self.data = b""
+        else:
+            self.data = mmap.mmap(self._fo.fileno(), 0, access=mmap.ACCESS_READ)
+        self._methods = None
+
+    def close(self):
+        if self.size != 0:
+            self.data.close()
+        self._fo.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def contains(self, text):
+        return self.data.find(text.encode("utf-8")) != -1
+
+    def _line_end(self, offset):
+        end = self.data.find(b"\n", offset)
+        if end == -1:
+            return self.size
+        return end + 1
+
+    def methods(self):
+        if self._methods is None:
+            self._methods = []
+            start = None
+            header = None
+            for match in METHOD_BOUNDARY_RE.finditer(self.data):
+                line = match.group(0)
+                if line.startswith(b".method "):
+                    if start is not None:
+                        raise SmaliError("Missing .end method before offset "+str(match.start()))
+                    start = match.start()
+                    header = line.rstrip(b"\r").decode("utf-8")
+                else:
+                    if start is None:
+                        raise SmaliError("Unexpected .end method at offset "+str(match.start()))
+                    self._methods.append(Method(header, start, self._line_end(match.end())))
+                    start = None
+            if start is not None:
+                raise SmaliError("Unterminated method: "+header)
+        return self._methods
+
+    def match_methods(self, matcher):
+        """Return a list of (method, value) for every method accepted by the matcher."""
+        result = []
+        for method in self.methods():
+            value = matcher.match(method.header)
+            if value is not None:
+                result.append((method, value))
+        return result
+
+    def get_lines(self, method):
+        return self.data[method.start:method.end].decode("utf-8").splitlines(True)
+
+    def _write_range(self, fo, start, end):
+        while start < end:
+            chunk_end = min(start + CHUNK_SIZE, end)
+            fo.write(self.data[start:chunk_end])
+            start = chunk_end
+
+    def write(self, out_file, replacements, extra_text=None):
+        """Stream the file to out_file, replacing some methods and appending extra_text at the end.
+
+        replacements is a list of (method, new lines).
+        """
+        fo = open(out_file, "wb")
+        try:
+            position = 0
+            for method, lines in sorted(replacements, key=lambda item: item[0].start):
+                self._write_range(fo, position, method.start)
+                fo.write("".join(lines).encode("utf-8"))
+                position = method.end
+            self._write_range(fo, position, self.size)
+            if extra_text:
+                fo.write(extra_text.encode("utf-8"))
+        finally:
+            fo.close()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""StartupCache - Values that are slow to compute at every start, valid until the files they depend on change."""
+
+import os
+import json
+
+__author__ = "ale5000"
+__copyright__ = "Copyright (C) 2016-2017, ale5000"
+__license__ = "GPLv3"
+
+CACHE_VERSION = 1
+
+
+def get_fingerprint(paths):
+    """Return the modification time and the size of every path (file or folder), None values for the missing ones."""
+    fingerprint = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            fingerprint.append([path, None, None])
+            continue
+        fingerprint.append([path, stat.st_mtime, stat.st_size])
+    return fingerprint
+
+
+class StartupCache(object):
+    """Store JSON values by name together with the fingerprint of the files used to compute them.
+
+    With filename None the values are kept only in memory (e.g. when the cache folder is not writable).
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = None
+
+    def _load(self):
+        if self.entries is not None:
+            return
+        self.entries = {}
+        if self.filename is None:
+            return
+        try:
+            fo = open(self.filename, "r")
+            try:
+                data = json.load(fo)
+            finally:
+                fo.close()
+        except (IOError, OSError, ValueError):
+            return
+        if isinstance(data, dict) and data.get("version") == CACHE_VERSION:
+            self.entries = data.get("entries", {})
+
+    def _save(self):
+        if self.filename is None:
+            return
+        tmp_file = self.filename+"."+str(os.getpid())+".tmp"
+        try:
+            fo = open(tmp_file, "w")
+            try:
+                json.dump({"version": CACHE_VERSION, "entries": self.entries}, fo, indent=1, sort_keys=True)
+            finally:
+                fo.close()
+            if os.path.exists(self.filename):
+                os.remove(self.filename)  # On Windows rename does not overwrite
+            os.rename(tmp_file, self.filename)
+        except (IOError, OSError):
+            try:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+            except OSError:
+                pass  # The cache is only an optimization
+
+    def get(self, name, paths):
+        """Return a tuple with a bool that tells if the value is valid and the value."""
+        self._load()
+        entry = self.entries.get(name)
+        # The values of JSON are lists instead of tuples
+        if entry is None or entry["fingerprint"] != get_fingerprint(paths):
+            return False, None
+        return True, entry["value"]
+
+    def set(self, name, paths, value):
+        self._load()
+        self.entries[name] = {"fingerprint": get_fingerprint(paths), "value": value}
+        self._save()
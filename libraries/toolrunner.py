@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""ToolRunner - JVM sizing for smali / baksmali and resource usage of the child processes."""
+
+import os
+import sys
+import time
+import subprocess
+
+__author__ = "ale5000"
+__copyright__ = "Copyright (C) 2016-2017, ale5000"
+__license__ = "GPLv3"
+
+MIN_HEAP = {"smali": 166, "baksmali": 128}  # MiB, enough for small inputs (these were the fixed values)
+HEAP_PER_INPUT_MIB = {"smali": 3, "baksmali": 24}  # The input of smali is source code, the one of baksmali is a dex
+HEAP_PER_THREAD = 48  # MiB used by every additional thread
+MAX_THREADS = 6  # Neither smali nor baksmali scale beyond this
+MAX_HEAP_SHARE = 0.75  # Part of the available memory that a single JVM can use
+BLOCK_SIZE = 512  # Unit of ru_inblock / ru_oublock
+
+
+def choose_jvm_options(tool, input_size, available_mem, cpu_count):
+    """Return a tuple with the heap size (MiB) and the number of threads for a job on input_size bytes.
+
+    available_mem is in MiB, it can be None if unknown.
+    """
+    base_heap = MIN_HEAP[tool] + HEAP_PER_INPUT_MIB[tool] * input_size // (1024 * 1024)
+    threads = max(1, min(cpu_count, MAX_THREADS))
+    heap = base_heap + (threads - 1) * HEAP_PER_THREAD
+    if available_mem is not None:
+        budget = int(available_mem * MAX_HEAP_SHARE)
+        while threads > 1 and heap > budget:
+            threads -= 1
+            heap -= HEAP_PER_THREAD
+        heap = min(heap, budget)  # Better trying with less memory than being killed
+    return max(heap, MIN_HEAP[tool]), threads
+
+
+def _decode_status(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _usage_from_rusage(usage, io):
+    max_rss = usage.ru_maxrss
+    if sys.platform == "darwin":
+        max_rss //= 1024  # Bytes instead of KiB
+    read_bytes, written_bytes = io
+    if read_bytes is None or written_bytes is None:
+        # Without /proc only the blocks of the real disk I/O are known (the page cache hits are not counted)
+        read_bytes, written_bytes = usage.ru_inblock * BLOCK_SIZE, usage.ru_oublock * BLOCK_SIZE
+    return usage.ru_utime + usage.ru_stime, max_rss, read_bytes, written_bytes
+
+
+def read_process_io(pid):
+    """Return the bytes read and written by a process (also after its end, until it is reaped), None values if unknown."""
+    read_bytes = written_bytes = None
+    try:
+        fo = open("/proc/"+str(pid)+"/io", "r")
+        try:
+            for line in fo:
+                if line.startswith("rchar:"):
+                    read_bytes = int(line.split()[1])
+                elif line.startswith("wchar:"):
+                    written_bytes = int(line.split()[1])
+        finally:
+            fo.close()
+    except (IOError, OSError, ValueError):
+        pass
+    return read_bytes, written_bytes
+
+
+def _wait_exited(pid, block):
+    """Wait for the end of a child process without reaping it, so its counters can still be read.
+
+    Return False if it is still running and None if it is not supported.
+    """
+    if "waitid" not in os.__dict__:
+        return None  # Python 2 and Windows
+    try:
+        result = os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT | (0 if block else os.WNOHANG))
+    except OSError:
+        return None
+    return result is not None
+
+
+def poll_process(process):
+    """Like Popen.poll() but return a tuple with the exit code, the CPU time (seconds), the peak RSS (KiB) and the bytes read and written.
+
+    The usage values are None when they are unknown.
+    """
+    if process.returncode is not None or "wait4" not in os.__dict__:
+        return process.poll(), None, None, None, None
+    io = (None, None)
+    exited = _wait_exited(process.pid, False)
+    if exited is False:
+        return None, None, None, None, None
+    if exited:
+        io = read_process_io(process.pid)
+    pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+    if pid == 0:
+        return None, None, None, None, None
+    process.returncode = _decode_status(status)
+    return (process.returncode, ) + _usage_from_rusage(usage, io)
+
+
+def wait_process(process):
+    """Like Popen.wait() but return a tuple with the exit code, the CPU time (seconds), the peak RSS (KiB) and the bytes read and written."""
+    io = (None, None)
+    try:
+        if "wait4" not in os.__dict__:
+            return process.wait(), None, None, None, None
+        if _wait_exited(process.pid, True):
+            io = read_process_io(process.pid)
+        __, status, usage = os.wait4(process.pid, 0)
+    except KeyboardInterrupt:
+        process.kill()
+        raise
+    process.returncode = _decode_status(status)
+    return (process.returncode, ) + _usage_from_rusage(usage, io)
+
+
+def run(cmd, capture_output=False):
+    """Execute cmd and return a tuple with the exit code, the output (None if not captured) and the usage.
+
+    The usage is a tuple with the elapsed time, the CPU time, the peak RSS and the bytes read and written.
+    """
+    start = time.time()
+    output = None
+    if capture_output:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        try:
+            output = process.stdout.read()
+        finally:
+            process.stdout.close()
+    else:
+        process = subprocess.Popen(cmd)
+    returncode, cpu_time, max_rss, read_bytes, written_bytes = wait_process(process)
+    return returncode, output, (time.time() - start, cpu_time, max_rss, read_bytes, written_bytes)
+
+
+def read_process_usage(pid):
+    """Return the CPU time (seconds) and the peak RSS (KiB) of a running process, None values if unknown."""
+    try:
+        fo = open("/proc/"+str(pid)+"/stat", "r")
+        try:
+            fields = fo.read().rsplit(")", 1)[1].split()
+        finally:
+            fo.close()
+        cpu_time = float(int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+        max_rss = None
+        fo = open("/proc/"+str(pid)+"/status", "r")
+        try:
+            for line in fo:
+                if line.startswith("VmHWM:"):
+                    max_rss = int(line.split()[1])
+        finally:
+            fo.close()
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return None, None
+    return cpu_time, max_rss
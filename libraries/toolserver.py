@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""ToolServer - Client for the long-lived smali / baksmali front-end (see misc/ToolServer.java)."""
+
+import os
+import time
+import threading
+import subprocess
+
+import toolrunner
+
+__author__ = "ale5000"
+__copyright__ = "Copyright (C) 2016-2017, ale5000"
+__license__ = "GPLv3"
+
+READY = "TINGLE-TOOLSERVER-READY"
+JOB_END = "TINGLE-JOB-END "
+STARTUP_TIMEOUT = 120  # Seconds, a slow device may need a lot to start the virtual machine
+
+
+class ToolServerError(Exception):
+    """Raised when the tool server cannot be started."""
+
+
+def _delta(after, before):
+    if after is None or before is None:
+        return None
+    return after - before
+
+
+class ToolServer(object):
+    """Send jobs to a single JVM that keeps smali and baksmali loaded.
+
+    If a tool terminate the JVM (System.exit) the job is reported as failed
+    and the server is transparently restarted on the next job.
+    """
+
+    def __init__(self, cmd, log_dir):
+        self.cmd = cmd
+        self.log_dir = log_dir
+        self.process = None
+        self.jobs_count = 0
+        self.starts_count = 0
+        self.last_usage = (0.0, None, None, None, None)  # Elapsed time, CPU time, peak RSS (of the JVM) and bytes read / written of the last job
+
+    def _start(self):
+        self.process = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.starts_count += 1
+        # The virtual machine may print something before (e.g. "Picked up _JAVA_OPTIONS: ..."), the server is killed if it never gets ready
+        watchdog = threading.Timer(STARTUP_TIMEOUT, self.process.kill)
+        watchdog.start()
+        banner = []
+        try:
+            while True:
+                line = self.process.stdout.readline()
+                if not line:
+                    break
+                line = line.decode("utf-8", "replace").strip()
+                if line == READY:
+                    return
+                banner.append(line)
+        finally:
+            watchdog.cancel()
+        self.stop()
+        raise ToolServerError("The tool server has not started in "+str(STARTUP_TIMEOUT)+" seconds: "+(" | ".join(banner[-5:]) or "no output"))
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        if self.process.poll() is None:
+            try:
+                self.process.wait()
+            except KeyboardInterrupt:
+                self.process.kill()
+                raise
+        self.process.stdout.close()
+        self.process = None
+
+    def run(self, tool, args):
+        """Execute a job and return a tuple with the exit code and the output (bytes)."""
+        if self.process is None or self.process.poll() is not None:
+            self._start()
+
+        self.jobs_count += 1
+        start = time.time()
+        cpu_before = toolrunner.read_process_usage(self.process.pid)[0]
+        read_before, written_before = toolrunner.read_process_io(self.process.pid)
+        log_file = os.path.join(self.log_dir, "toolserver-job-"+str(self.jobs_count)+".log")
+        job = "\t".join([tool, log_file] + list(args)) + "\n"
+        try:
+            self.process.stdin.write(job.encode("utf-8"))
+            self.process.stdin.flush()
+        except (IOError, OSError):
+            self.stop()
+            raise ToolServerError("The tool server is not responding")
+
+        extra_output = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:  # The tool has terminated the JVM
+                returncode, cpu_time, max_rss, read_bytes, written_bytes = toolrunner.wait_process(self.process)
+                returncode = returncode or 1
+                self.last_usage = (time.time() - start, _delta(cpu_time, cpu_before), max_rss, _delta(read_bytes, read_before), _delta(written_bytes, written_before))
+                self.stop()
+                break
+            decoded_line = line.decode("utf-8", "replace").rstrip()
+            if decoded_line.startswith(JOB_END):
+                returncode = int(decoded_line[len(JOB_END):])
+                cpu_after, max_rss = toolrunner.read_process_usage(self.process.pid)
+                read_after, written_after = toolrunner.read_process_io(self.process.pid)
+                self.last_usage = (time.time() - start, _delta(cpu_after, cpu_before), max_rss, _delta(read_after, read_before), _delta(written_after, written_before))
+                break
+            extra_output.append(line)  # Output that bypassed the redirection
+
+        output = b"".join(extra_output)
+        if os.path.exists(log_file):
+            fo = open(log_file, "rb")
+            try:
+                output += fo.read()
+            finally:
+                fo.close()
+            os.remove(log_file)
+        return returncode, output
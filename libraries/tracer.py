@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tracer - Time and resources used by the stages of the pipeline and by the child processes.
+
+Every stage records the monotonic wall time, the CPU time of this process, the CPU time of the child processes
+that have ended inside it, the bytes read / written by both and the peak RSS of this process. The values are read
+only at the start and at the end of the stages, so the tracer can always stay active.
+
+The peak RSS of a stage is exact where the peak of the process can be reset (Linux 4.0 and later), otherwise it is
+the highest RSS seen at the start and at the end of the stages.
+"""
+
+import os
+import sys
+import time
+import threading
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows
+
+__author__ = "ale5000"
+__copyright__ = "Copyright (C) 2016-2017, ale5000"
+__license__ = "GPLv3"
+
+TRACE_VERSION = 1
+BLOCK_SIZE = 512  # Unit of ru_inblock / ru_oublock
+
+if "monotonic" in time.__dict__:
+    monotonic = time.monotonic
+else:
+    monotonic = time.time  # Python 2
+
+
+def _read_self_io():
+    """Return the bytes read and written by this process or None values if unknown."""
+    read_bytes = written_bytes = None
+    try:
+        fo = open("/proc/self/io", "r")
+        try:
+            for line in fo:
+                if line.startswith("rchar:"):
+                    read_bytes = int(line.split()[1])
+                elif line.startswith("wchar:"):
+                    written_bytes = int(line.split()[1])
+        finally:
+            fo.close()
+    except (IOError, OSError, ValueError):
+        pass
+    return read_bytes, written_bytes
+
+
+def _read_status_value(key):
+    """Return a value in KiB from /proc/self/status or None if unknown."""
+    try:
+        fo = open("/proc/self/status", "r")
+        try:
+            for line in fo:
+                if line.startswith(key+":"):
+                    return int(line.split()[1])
+        finally:
+            fo.close()
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    """Reset the peak RSS of this process, return False if it is not supported."""
+    try:
+        fo = open("/proc/self/clear_refs", "w")
+        try:
+            fo.write("5")
+        finally:
+            fo.close()
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _read_children_usage():
+    """Return the CPU time, the bytes read and the bytes written by the ended child processes or None values if unknown."""
+    if resource is None:
+        return None, None, None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime, usage.ru_inblock * BLOCK_SIZE, usage.ru_oublock * BLOCK_SIZE
+
+
+def _read_snapshot():
+    times = os.times()
+    return (monotonic(), times[0] + times[1]) + _read_self_io() + _read_children_usage()
+
+
+def _delta(end, start, digits=None):
+    if end is None or start is None:
+        return None
+    if digits is None:
+        return end - start
+    return round(end - start, digits)
+
+
+class _Stage(object):
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.snapshot = None
+        self.peak_rss = None
+
+    def __enter__(self):
+        self.snapshot = _read_snapshot()
+        self.tracer._push_stage(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer._pop_stage(self)
+        self.tracer._add_stage(self.name, self.snapshot, _read_snapshot(), self.args, exc_type is not None, self.peak_rss)
+        return False
+
+
+class Tracer(object):
+    """Collect the events of a run, it can be used from multiple threads.
+
+    The CPU time of this process is shared by all the threads, so the stages that overlap in time share it too.
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.start = monotonic()
+        self.stages = []
+        self.processes = []
+        self.metadata = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._thread_ids = {}
+        self._open_stages = []  # Of all the threads, the peak RSS is shared by the whole process
+        self._peak_rss = None
+        self._peak_rss_reset = _reset_peak_rss() and _read_status_value("VmHWM") is not None
+
+    def _get_thread_id(self):
+        ident = threading.current_thread().ident
+        with self._lock:
+            return self._thread_ids.setdefault(ident, len(self._thread_ids) + 1)
+
+    def _get_stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _update_peak_rss(self):
+        """Propagate the peak RSS since the last call to the open stages, it must be called with the lock held."""
+        if self._peak_rss_reset:
+            value = _read_status_value("VmHWM")
+            _reset_peak_rss()
+        else:
+            value = _read_status_value("VmRSS")
+        if value is None:
+            return
+        self._peak_rss = max(self._peak_rss or 0, value)
+        for stage in self._open_stages:
+            stage.peak_rss = max(stage.peak_rss or 0, value)
+
+    def _push_stage(self, stage):
+        self._get_stack().append(stage.name)
+        with self._lock:
+            self._update_peak_rss()
+            self._open_stages.append(stage)
+
+    def _pop_stage(self, stage):
+        self._get_stack().pop()
+        with self._lock:
+            self._update_peak_rss()
+            self._open_stages.remove(stage)
+
+    def get_current_stage(self):
+        stack = self._get_stack()
+        if stack:
+            return stack[-1]
+        return None
+
+    def get_stages_peak_rss(self):
+        """Return a list of (stage name, peak RSS in KiB) of the ended stages, in order of start."""
+        with self._lock:
+            stages = sorted(self.stages, key=lambda event: event["start"])
+        return [(event["name"], event["peak_rss"]) for event in stages]
+
+    def stage(self, name, **args):
+        """Return a context manager that records the block as a stage, args are additional informative values."""
+        return _Stage(self, name, args)
+
+    def _add_stage(self, name, start, end, args, failed, peak_rss):
+        event = {
+            "name": name,
+            "parent": self.get_current_stage(),
+            "thread": self._get_thread_id(),
+            "start": round(start[0] - self.start, 6),
+            "wall_time": round(end[0] - start[0], 6),
+            "cpu_time": _delta(end[1], start[1], 3),
+            "read_bytes": _delta(end[2], start[2]),
+            "written_bytes": _delta(end[3], start[3]),
+            "children_cpu_time": _delta(end[4], start[4], 3),
+            "children_read_bytes": _delta(end[5], start[5]),
+            "children_written_bytes": _delta(end[6], start[6]),
+            "peak_rss": peak_rss,
+            "failed": failed,
+        }
+        if args:
+            event["args"] = args
+        with self._lock:
+            self.stages.append(event)
+
+    def add_process(self, name, usage, **args):
+        """Record a child process that has just ended.
+
+        usage is a tuple with the elapsed time, the CPU time, the peak RSS (KiB) and the bytes read and written.
+        """
+        elapsed, cpu_time, max_rss, read_bytes, written_bytes = usage
+        event = {
+            "name": name,
+            "stage": self.get_current_stage(),
+            "thread": self._get_thread_id(),
+            "start": round(max(monotonic() - elapsed - self.start, 0), 6),
+            "wall_time": round(elapsed, 6),
+            "cpu_time": None if cpu_time is None else round(cpu_time, 3),
+            "max_rss": max_rss,
+            "read_bytes": read_bytes,
+            "written_bytes": written_bytes,
+        }
+        if args:
+            event["args"] = args
+        with self._lock:
+            self.processes.append(event)
+
+    def set_metadata(self, key, value):
+        self.metadata[key] = value
+
+    def to_dict(self):
+        with self._lock:
+            stages = sorted(self.stages, key=lambda event: event["start"])
+            processes = sorted(self.processes, key=lambda event: event["start"])
+        max_rss = None
+        if resource is not None:
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform == "darwin":
+                max_rss //= 1024  # Bytes instead of KiB
+        with self._lock:
+            self._update_peak_rss()
+            if self._peak_rss is not None:
+                max_rss = max(max_rss or 0, self._peak_rss)  # The reset of the peak RSS also affects ru_maxrss
+        times = os.times()
+        return {
+            "version": TRACE_VERSION,
+            "start_time": self.start_time,
+            "wall_time": round(monotonic() - self.start, 6),
+            "cpu_time": round(times[0] + times[1], 3),
+            "children_cpu_time": round(times[2] + times[3], 3),
+            "max_rss": max_rss,
+            "peak_rss_exact": self._peak_rss_reset,
+            "metadata": self.metadata,
+            "stages": stages,
+            "processes": processes,
+        }
+
+    def to_chrome_trace(self):
+        """Return the events in the Trace Event Format, it can be opened with chrome://tracing or Perfetto."""
+        trace = self.to_dict()
+        pid = os.getpid()
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": trace["metadata"].get("app", "python")}}]
+        for category, items in (("stage", trace["stages"]), ("process", trace["processes"])):
+            for item in items:
+                args = dict(item.get("args", {}))
+                for key, value in item.items():
+                    if key not in ("name", "start", "wall_time", "thread", "args") and value is not None:
+                        args[key] = value
+                events.append({
+                    "name": item["name"],
+                    "cat": category,
+                    "ph": "X",
+                    "ts": int(item["start"] * 1000000),
+                    "dur": int(item["wall_time"] * 1000000),
+                    "pid": pid,
+                    "tid": item["thread"],
+                    "args": args,
+                })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, trace_file, chrome_trace_file=None):
+        """Write the JSON trace and / or the Chrome trace, None skips the file."""
+        import json
+
+        if trace_file is not None:
+            fo = open(trace_file, "w")
+            try:
+                json.dump(self.to_dict(), fo, indent=2, sort_keys=True)
+            finally:
+                fo.close()
+        if chrome_trace_file is not None:
+            fo = open(chrome_trace_file, "w")
+            try:
+                json.dump(self.to_chrome_trace(), fo)
+            finally:
+                fo.close()
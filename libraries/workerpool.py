@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""WorkerPool - Minimal bounded thread pool (the real work is usually done by child processes)."""
+
+import sys
+import threading
+
+__author__ = "ale5000"
+__copyright__ = "Copyright (C) 2016-2017, ale5000"
+__license__ = "GPLv3"
+
+
+def run_jobs(jobs, max_workers):
+    """Execute the callables in jobs with at most max_workers threads.
+
+    Return a list, in the same order of jobs, of (True, result) or (False, exception).
+    """
+    results = [None] * len(jobs)
+    lock = threading.Lock()
+    pending = list(range(len(jobs)))
+
+    def _worker():
+        while True:
+            lock.acquire()
+            try:
+                if not pending:
+                    return
+                index = pending.pop(0)
+            finally:
+                lock.release()
+            try:
+                results[index] = (True, jobs[index]())
+            except Exception:
+                results[index] = (False, sys.exc_info()[1])
+
+    threads = [threading.Thread(target=_worker) for __ in range(max(1, min(max_workers, len(jobs))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.5)  # A timeout allows KeyboardInterrupt to be delivered
+    return results
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""ZipEngine - In-process handling of jar files with raw passthrough of the unchanged entries."""
+
+import os
+import sys
+import time
+import struct
+import shutil
+import zipfile
+import zlib
+
+__author__ = "ale5000"
+__copyright__ = "Copyright (C) 2016-2017, ale5000"
+__license__ = "GPLv3"
+
+LOCAL_HEADER_SIG = 0x04034b50
+CENTRAL_HEADER_SIG = 0x02014b50
+END_RECORD_SIG = 0x06054b50
+DATA_DESCRIPTOR_SIG = 0x08074b50
+
+LOCAL_HEADER_FMT = "<IHHHHHIIIHH"
+CENTRAL_HEADER_FMT = "<IHHHHHHIIIHHHHHII"
+END_RECORD_FMT = "<IHHHHIIH"
+LOCAL_HEADER_SIZE = struct.calcsize(LOCAL_HEADER_FMT)
+CENTRAL_HEADER_SIZE = struct.calcsize(CENTRAL_HEADER_FMT)
+END_RECORD_SIZE = struct.calcsize(END_RECORD_FMT)
+
+STORED_ALIGNMENT = 4  # Uncompressed dex files must stay aligned to be memory mapped
+CHUNK_SIZE = 64 * 1024
+
+
+class ZipEngineError(Exception):
+    """Raised when an archive cannot be handled by the zip engine."""
+
+
+# Errors that can be raised while handling a damaged or unsupported archive
+ERRORS = (ZipEngineError, zipfile.BadZipfile, EnvironmentError, EOFError, zlib.error, struct.error)
+
+
+class _Entry(object):
+    def __init__(self, name, central_header, name_bytes, extra, comment):
+        self.name = name
+        self.central_header = list(central_header)
+        self.name_bytes = name_bytes
+        self.extra = extra
+        self.comment = comment
+
+    flags = property(lambda self: self.central_header[3])
+    compress_type = property(lambda self: self.central_header[4])
+    crc = property(lambda self: self.central_header[7])
+    compress_size = property(lambda self: self.central_header[8])
+    file_size = property(lambda self: self.central_header[9])
+    header_offset = property(lambda self: self.central_header[16])
+
+
+def _read_exact(fo, size):
+    data = fo.read(size)
+    if len(data) != size:
+        raise ZipEngineError("Truncated archive")
+    return data
+
+
+def _read_central_directory(fo):
+    fo.seek(0, os.SEEK_END)
+    file_size = fo.tell()
+    tail_size = min(file_size, END_RECORD_SIZE + 0xffff)
+    fo.seek(file_size - tail_size)
+    tail = fo.read(tail_size)
+    end_pos = tail.rfind(struct.pack("<I", END_RECORD_SIG))
+    if end_pos < 0:
+        raise ZipEngineError("End of central directory not found")
+    end_record = struct.unpack(END_RECORD_FMT, tail[end_pos:end_pos + END_RECORD_SIZE])
+    entries_count, cd_size, cd_offset = end_record[4], end_record[5], end_record[6]
+    if entries_count == 0xffff or cd_offset == 0xffffffff:
+        raise ZipEngineError("Zip64 archives are not supported")
+    if end_record[1] != 0 or end_record[2] != 0:
+        raise ZipEngineError("Multi-disk archives are not supported")
+    comment = tail[end_pos + END_RECORD_SIZE:end_pos + END_RECORD_SIZE + end_record[7]]
+
+    fo.seek(cd_offset)
+    central_directory = _read_exact(fo, cd_size)
+    entries = []
+    pos = 0
+    for __ in range(entries_count):
+        header = struct.unpack(CENTRAL_HEADER_FMT, central_directory[pos:pos + CENTRAL_HEADER_SIZE])
+        if header[0] != CENTRAL_HEADER_SIG:
+            raise ZipEngineError("Bad central directory")
+        pos += CENTRAL_HEADER_SIZE
+        name_bytes = central_directory[pos:pos + header[10]]
+        pos += header[10]
+        extra = central_directory[pos:pos + header[11]]
+        pos += header[11]
+        entry_comment = central_directory[pos:pos + header[12]]
+        pos += header[12]
+        if header[3] & 0x1:
+            raise ZipEngineError("Encrypted archives are not supported")
+        if header[3] & 0x800:
+            name = name_bytes.decode("utf-8")
+        else:
+            name = name_bytes.decode("cp437")
+        entries.append(_Entry(name, header, name_bytes, extra, entry_comment))
+    return entries, comment
+
+
+def _is_root_dex(name):
+    return name.endswith(".dex") and "/" not in name
+
+
+def list_dex(archive):
+    """Return the names of the dex files in the root of the archive."""
+    try:
+        zf = zipfile.ZipFile(archive, "r")
+    except (zipfile.BadZipfile, IOError, OSError):
+        e = sys.exc_info()[1]
+        raise ZipEngineError(str(e))
+    try:
+        return [name for name in zf.namelist() if _is_root_dex(name)]
+    finally:
+        zf.close()
+
+
+def read_dex(archive):
+    """Yield the name and the content of the dex files in the root of the archive, sorted by name."""
+    try:
+        zf = zipfile.ZipFile(archive, "r")
+    except (zipfile.BadZipfile, IOError, OSError):
+        e = sys.exc_info()[1]
+        raise ZipEngineError(str(e))
+    try:
+        for name in sorted([name for name in zf.namelist() if _is_root_dex(name)]):
+            yield name, zf.read(name)
+    finally:
+        zf.close()
+
+
+def extract_dex(archive, out_dir):
+    """Stream the dex files in the root of the archive to out_dir, return the list of extracted names."""
+    try:
+        zf = zipfile.ZipFile(archive, "r")
+    except (zipfile.BadZipfile, IOError, OSError):
+        e = sys.exc_info()[1]
+        raise ZipEngineError(str(e))
+    extracted = []
+    try:
+        for info in zf.infolist():
+            if not _is_root_dex(info.filename):
+                continue
+            source = zf.open(info, "r")
+            try:
+                target = open(os.path.join(out_dir, info.filename), "wb")
+                try:
+                    shutil.copyfileobj(source, target, CHUNK_SIZE)
+                finally:
+                    target.close()
+            finally:
+                source.close()
+            extracted.append(info.filename)
+    finally:
+        zf.close()
+    return extracted
+
+
+def _file_crc(filename):
+    crc = 0
+    size = 0
+    fo = open(filename, "rb")
+    try:
+        while True:
+            chunk = fo.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+    finally:
+        fo.close()
+    return crc & 0xffffffff, size
+
+
+def _dos_date_time(timestamp):
+    date_time = time.localtime(timestamp)
+    dos_date = (date_time[0] - 1980) << 9 | date_time[1] << 5 | date_time[2]
+    dos_time = date_time[3] << 11 | date_time[4] << 5 | date_time[5] // 2
+    return dos_date, dos_time
+
+
+def _alignment_padding(offset, name_len, extra_len):
+    data_offset = offset + LOCAL_HEADER_SIZE + name_len + extra_len
+    return (STORED_ALIGNMENT - data_offset % STORED_ALIGNMENT) % STORED_ALIGNMENT
+
+
+def _copy_raw(source, target, entry):
+    """Copy an entry as-is (compressed bytes included), return the new central directory header."""
+    source.seek(entry.header_offset)
+    header = struct.unpack(LOCAL_HEADER_FMT, _read_exact(source, LOCAL_HEADER_SIZE))
+    if header[0] != LOCAL_HEADER_SIG:
+        raise ZipEngineError("Bad local header for "+entry.name)
+    name = _read_exact(source, header[9])
+    extra = _read_exact(source, header[10])
+
+    offset = target.tell()
+    if entry.compress_type == zipfile.ZIP_STORED:
+        extra += b"\0" * _alignment_padding(offset, len(name), len(extra))
+    target.write(struct.pack(LOCAL_HEADER_FMT, *(header[:10] + (len(extra),))))
+    target.write(name)
+    target.write(extra)
+
+    remaining = entry.compress_size
+    if entry.flags & 0x8:  # The data descriptor follows the data
+        remaining += 12
+    while remaining > 0:
+        chunk = source.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            raise ZipEngineError("Truncated data for "+entry.name)
+        target.write(chunk)
+        remaining -= len(chunk)
+    if entry.flags & 0x8:
+        # The signature of the data descriptor is optional, if present there are 4 more bytes
+        source.seek(-12, os.SEEK_CUR)
+        if struct.unpack("<I", _read_exact(source, 4))[0] == DATA_DESCRIPTOR_SIG:
+            source.seek(8, os.SEEK_CUR)
+            target.write(_read_exact(source, 4))
+
+    central_header = list(entry.central_header)
+    central_header[16] = offset
+    return central_header
+
+
+def _write_file(target, filename, name_bytes, compress_type, dos_date_time, flags):
+    """Write a new entry from a file, return the new central directory header."""
+    crc, file_size = _file_crc(filename)
+    offset = target.tell()
+    extra = b""
+    if compress_type == zipfile.ZIP_STORED:
+        extra = b"\0" * _alignment_padding(offset, len(name_bytes), 0)
+    flags &= 0x800  # Keep only the UTF-8 flag, sizes are always known in advance
+    dos_date, dos_time = dos_date_time
+
+    target.write(struct.pack(LOCAL_HEADER_FMT, LOCAL_HEADER_SIG, 20, flags, compress_type, dos_time, dos_date, crc, 0, file_size, len(name_bytes), len(extra)))
+    target.write(name_bytes)
+    target.write(extra)
+    data_start = target.tell()
+
+    if compress_type == zipfile.ZIP_STORED:
+        fo = open(filename, "rb")
+        try:
+            shutil.copyfileobj(fo, target, CHUNK_SIZE)
+        finally:
+            fo.close()
+    else:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+        fo = open(filename, "rb")
+        try:
+            while True:
+                chunk = fo.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                target.write(compressor.compress(chunk))
+        finally:
+            fo.close()
+        target.write(compressor.flush())
+    compress_size = target.tell() - data_start
+
+    # Now that the compressed size is known, fill it in the local header
+    end = target.tell()
+    target.seek(offset + 18)
+    target.write(struct.pack("<I", compress_size))
+    target.seek(end)
+
+    return [CENTRAL_HEADER_SIG, 20, 20, flags, compress_type, dos_time, dos_date, crc, compress_size, file_size, len(name_bytes), 0, 0, 0, 0, 0, offset]
+
+
+def update_archive(archive, in_dir, out_archive):
+    """Create out_archive from archive replacing / adding the files present in in_dir.
+
+    Unchanged entries (also the ones in in_dir that are identical to the original) are copied as raw
+    compressed bytes, only the modified files are compressed again. Return the list of rewritten names.
+    """
+    replacements = {}
+    for filename in os.listdir(in_dir):
+        if os.path.isfile(os.path.join(in_dir, filename)):
+            replacements[filename] = os.path.join(in_dir, filename)
+
+    source = open(archive, "rb")
+    try:
+        entries, comment = _read_central_directory(source)
+        target = open(out_archive, "wb")
+        try:
+            central_records = []
+            rewritten = []
+            for entry in entries:
+                new_file = replacements.pop(entry.name, None)
+                if new_file is not None and _file_crc(new_file) != (entry.crc, entry.file_size):
+                    header = _write_file(target, new_file, entry.name_bytes, entry.compress_type, (entry.central_header[6], entry.central_header[5]), entry.flags)
+                    header[13:16] = entry.central_header[13:16]  # Keep the file attributes
+                    central_records.append((header, entry.name_bytes, b"", b""))
+                    rewritten.append(entry.name)
+                else:
+                    central_records.append((_copy_raw(source, target, entry), entry.name_bytes, entry.extra, entry.comment))
+
+            for name in sorted(replacements):  # New files
+                name_bytes = name.encode("utf-8")
+                header = _write_file(target, replacements[name], name_bytes, zipfile.ZIP_DEFLATED, _dos_date_time(time.time()), 0x800)
+                central_records.append((header, name_bytes, b"", b""))
+                rewritten.append(name)
+
+            cd_offset = target.tell()
+            for header, name_bytes, extra, entry_comment in central_records:
+                header[10:13] = [len(name_bytes), len(extra), len(entry_comment)]
+                target.write(struct.pack(CENTRAL_HEADER_FMT, *header))
+                target.write(name_bytes)
+                target.write(extra)
+                target.write(entry_comment)
+            cd_size = target.tell() - cd_offset
+            target.write(struct.pack(END_RECORD_FMT, END_RECORD_SIG, 0, 0, len(central_records), len(central_records), cd_size, cd_offset, len(comment)))
+            target.write(comment)
+        finally:
+            target.close()
+    finally:
+        source.close()
+    return rewritten
@@ -5,9 +5,8 @@
 import sys
 import os
 import subprocess
-import tempfile
 import shutil
-import hashlib
+import threading
 
 __app__ = "Tingle"
 __author__ = "ale5000, moosd"
@@ -17,15 +16,71 @@ FALLBACK_OUT_ENCODING_1 = sys.stdout.encoding
 FALLBACK_OUT_ENCODING_2 = "cp850"
 
 DEPS_PATH = {}
+TOOL_SERVER = None
+STARTUP_CACHE = None
+TRACER = None
+TRACE_FILE = None
+CHROME_TRACE_FILE = None
+ODEX_CONTAINER = None  # The vdex / oat with the dex files of an odexed framework.jar
+TOOL_DALVIK_DATA = None  # The ANDROID_DATA folder where dalvikvm keeps the optimized tool jars
+ADB_SESSIONS = {}
+ADB_SESSIONS_LOCK = threading.Lock()  # The devices of the fleet mode are handled in parallel
+TOOL_SERVER_HEAP = 0
+TOOL_MAIN_CLASSES = {"smali": "org.jf.smali.Main", "baksmali": "org.jf.baksmali.Main"}
+CACHE_COUNTERS = {"smali": [0, 0], "result": [0, 0], "pull": [0, 0]}  # Hits and misses of the current run
 DEBUG_PROCESS = False
 UNLOCKED_ADB = True
 PATCH_NOT_IMPL_METHOD_MSG = "You must implement this method in your Patch class => {0}"
 
+USE_ZIP_ENGINE = True  # Handle the archives in-process instead of using 7za / zip / unzip
+SMALI_CACHE = True  # Reuse the disassembled trees of already seen dex files
+SMALI_CACHE_MAX_SIZE = 2048  # MiB, the least recently used trees are evicted above it
+RESULT_CACHE = True  # Reuse the patched file when the same input has already been patched
+RESULT_CACHE_MAX_SIZE = 512  # MiB
+PULL_CACHE = True  # Keep the files pulled from the devices, they are pulled again only when the hash on the device changes
+PULL_CACHE_MAX_SIZE = 512  # MiB
+USE_EXEC_OUT = True  # Pull through "adb exec-out" with gzip compression when the device supports it
+USE_ADB_SESSION = True  # Send the shell commands through a single adb shell per device instead of starting adb every time
+DEVICE_SHELL_TIMEOUT = 60  # Seconds
+CONCURRENT_DEVICE_PREPARATION = True  # In mode 1 root adbd and remount /system while the framework is being patched
+USE_TOOL_SERVER = True  # Keep smali and baksmali loaded in a single JVM instead of starting one per call
+TOOL_DALVIK_CACHE = True  # On Android keep the optimized tool jars in the cache folder instead of optimizing them again at every call
+PARALLEL_DISASSEMBLE = True
+PLAN_DEX_LAYOUT = True  # Predict the 64K references overflow from the dex tables instead of waiting for the assembler to fail
+MIN_MULTIDEX_SDK = 21  # Before Android 5.0 only classes.dex is loaded from the boot class path
+MAX_WORKERS = None  # None means one worker per CPU core
+BATCH_WORKER_MEM = 512  # Estimated memory (in MiB) used by every patching process in batch mode
+FLEET_MAX_WORKERS = 8  # Maximum number of devices handled at the same time in fleet mode
+DISASSEMBLE_WORKER_MEM = 192  # Minimum memory (in MiB) reserved for every disassembler process
+TOOL_USAGE_LOG = True  # Log the heap, threads, CPU time and peak RSS of every smali / baksmali job in the cache folder
+RAM_WORK_DIR = True  # Create the work dir on tmpfs (/dev/shm) when there is enough free memory
+RAM_WORK_DIR_MIN_FREE = 1536  # MiB that must be free both on the tmpfs and in the physical memory
+RAM_WORK_DIR_PARENT = "/dev/shm"
+BACKGROUND_CLEANUP = True  # Delete the work dir in a detached process instead of waiting for it at exit
+LINK_COPIES = True  # Copy framework.jar as a reflink (copy-on-write clone) where the filesystem allows it
+LOW_MEMORY = False  # Memory-bounded run, always enabled in mode 3
+LOW_MEMORY_BUDGET = 64  # MiB, the peak RSS of this process that every stage should stay under in low memory mode
+TRACE = True  # Write trace.json, with the time and the resources used by every stage and child process, in the output folder
+USE_DEX_INDEX = True  # Locate the class to patch by reading the dex tables instead of disassembling every dex
+ODEX_ARCHS = ("arm64", "arm", "x86_64", "x86")
+ODEX_CONTAINERS = ("boot-framework.vdex", "boot-framework.oat", "boot.oat")  # Android 8+, Android 7, Android 5-6
+
+
+class PatchError(Exception):
+    """Raised by a patch that cannot be applied, code is the exit code to use."""
+
+    def __init__(self, message, code):
+        Exception.__init__(self, message)
+        self.code = code
+
 
 class BasePatch(object):
-    """Base implementation for a patching class."""
+    """Base implementation for a patching class.
+
+    The classes to patch are disassembled (once for all the patches), then apply() edits their smali files.
+    """
 
-    _patch_ver = 0
+    _patch_ver = 1
 
     def _initialize(self):
         raise NotImplementedError(str(PATCH_NOT_IMPL_METHOD_MSG).format(get_func_name()))
@@ -33,17 +88,44 @@ class BasePatch(object):
     def _set_files_list(self):
         raise NotImplementedError(str(PATCH_NOT_IMPL_METHOD_MSG).format(get_func_name()))
 
+    def _set_classes_list(self):
+        raise NotImplementedError(str(PATCH_NOT_IMPL_METHOD_MSG).format(get_func_name()))
+
+    def detect(self, descriptor, signatures):
+        """Return the description of the code to patch found in the method signatures of a class, None if it is not supported."""
+        return descriptor
+
+    def get_refs_delta(self):
+        """Return an upper bound of the number of method and field ids added to a dex by the patch."""
+        return 0, 0
+
+    def get_state(self, dex, descriptor):
+        """Return "patched" or "partially patched" by reading a dex (a dexfile.DexFile) that defines the class, None if not patched."""
+        return None
+
+    def apply(self, smali_files, dry_run=False):
+        """Patch the smali files (a dict of class descriptor => file path) and return the descriptors of the changed classes.
+
+        An empty list means that the patch is already applied, raise PatchError if it cannot be applied.
+        """
+        raise NotImplementedError(str(PATCH_NOT_IMPL_METHOD_MSG).format(get_func_name()))
+
     def get_files_list(self):
         return self.files
 
+    def get_classes_list(self):
+        return self.classes
+
     def __init__(self):
         self._initialize()
         self.files = []
+        self.classes = []
         self._set_files_list()
+        self._set_classes_list()
 
         if(not isinstance(self.__class__.name, basestring) or
            not isinstance(self.__class__.version, basestring) or
-           not self.files):
+           not self.files or not self.classes):
             raise RuntimeError("There was one or more missing attribute(s)")
 
         if self.__class__._patch_ver != BasePatch._patch_ver:
@@ -59,11 +141,12 @@ def get_func_name():
 
 
 def init():
-    global SCRIPT_DIR, TMP_DIR, PREVIOUS_DIR, DUMB_MODE
+    global SCRIPT_DIR, TMP_DIR, PREVIOUS_DIR, DUMB_MODE, NON_INTERACTIVE, TRACER
     SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
     import libraries
     import pycompatlayer
+    import tracer
 
     import atexit
 
@@ -85,22 +168,32 @@ def init():
     TMP_DIR = None
     PREVIOUS_DIR = os.getcwd()
     DUMB_MODE = False
+    NON_INTERACTIVE = False
     if os.environ.get("TERM") == "dumb":
         DUMB_MODE = True
 
+    TRACER = tracer.Tracer()
+    TRACER.set_metadata("app", __app__)
+    TRACER.set_metadata("python", sys.version.split()[0])
+    TRACER.set_metadata("platform", sys.platform_codename)
+
     # Register exit handler
     atexit.register(on_exit)
 
     sys.BasePatch = BasePatch
+    sys.PatchError = PatchError
 
 
 def on_exit():
     # Return to the previous working directory
     os.chdir(PREVIOUS_DIR)
     # Clean up
+    stop_tool_server()
+    close_adb_sessions()
+    write_trace()
     if TMP_DIR is not None:
-        shutil.rmtree(TMP_DIR+"/")
-    if sys.platform_codename == "win" and not DUMB_MODE:
+        remove_work_dir(TMP_DIR)
+    if sys.platform_codename == "win" and not DUMB_MODE and not NON_INTERACTIVE:
         import msvcrt
         msvcrt.getch()  # Wait a keypress before exit (useful when the script is running from a double click)
 
@@ -108,11 +201,21 @@ def on_exit():
 def exit_now(err_code):
     if err_code != 0:
         print_(os.linesep+"ERROR CODE:", err_code)
-        import time
-        time.sleep(0.2)  # Give time to allow external locks to be released
+        # Terminate the child processes now so their locks on the temporary files are released before the cleanup
+        stop_tool_server()
+        close_adb_sessions()
     sys.exit(err_code)
 
 
+def write_trace():
+    if TRACE_FILE is None and CHROME_TRACE_FILE is None:
+        return
+    try:
+        TRACER.write(TRACE_FILE, CHROME_TRACE_FILE)
+    except (IOError, OSError):
+        warning("The trace cannot be written.")
+
+
 def safe_output_decode(in_bytes):
     try:
         return in_bytes.decode(DEFAULT_ENCODING)
@@ -127,18 +230,57 @@ def safe_output_decode(in_bytes):
     return str(in_bytes)
 
 
-def safe_output_decode_false_passthrough(output):
-    if output == False:
-        return False
-    return safe_output_decode(output)
+def find_executable(name):
+    """Return the path of the executable searching in PATH (like the one of distutils, that is missing in recent versions of Python)."""
+    if sys.platform_codename == "win" and not name.lower().endswith(".exe"):
+        name += ".exe"
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            return path
+    return None
 
 
-def handle_dependencies(deps_path, mode):
-    from distutils.spawn import find_executable
+def get_startup_cache():
+    global STARTUP_CACHE
+    import startupcache
 
+    if STARTUP_CACHE is None:
+        try:
+            filename = os.path.join(get_cache_dir(), "startup.json")
+        except EnvironmentError:
+            filename = None  # Read-only installation, the values are computed at every start
+        STARTUP_CACHE = startupcache.StartupCache(filename)
+    return STARTUP_CACHE
+
+
+def find_executable_cached(name):
+    """Like find_executable but the result is reused until PATH, its folders or the executable change."""
+    path_dirs = os.environ.get("PATH", "").split(os.pathsep)
+    # Adding or removing a file changes the modification time of its folder, so new executables are noticed too
+    valid, path = get_startup_cache().get("path:"+name, path_dirs)
+    if valid and (path is None or os.path.isfile(path)):
+        return path
+    path = find_executable(name)
+    get_startup_cache().set("path:"+name, path_dirs, path)
+    return path
+
+
+def get_tool_version(name, path, read_version):
+    """Return read_version(path), cached until the file changes."""
+    valid, version = get_startup_cache().get("version:"+name, [path])
+    if not valid:
+        version = read_version(path)
+        get_startup_cache().set("version:"+name, [path], version)
+    return version
+
+
+def resolve_dependencies(deps_path, mode):
+    """Fill deps_path with the path of the dependencies, return the error message for the missing ones (empty if none)."""
     deps_type = {}
-    deps_type["decompressor"] = ["7za", "unzip", "busybox"]
-    deps_type["compressor"] = ["7za", "zip"]
+    if not USE_ZIP_ENGINE:
+        deps_type["decompressor"] = ["7za", "unzip", "busybox"]
+        deps_type["compressor"] = ["7za", "zip"]
     deps_type["java_vm"] = ["java"]
     if sys.platform_codename == "android":
         deps_type["java_vm"].insert(0, "dalvikvm")
@@ -153,7 +295,7 @@ def handle_dependencies(deps_path, mode):
                 found = True
                 break  # We have already found the path of this binary, skip it
 
-            path = find_executable(dep)
+            path = find_executable_cached(dep)
 
             if path is not None:
                 deps_path[dep] = path
@@ -162,7 +304,11 @@ def handle_dependencies(deps_path, mode):
 
         if not found:
             errors += os.linesep+ "ERROR: Missing "+key+" => "+str(value_list)
+    return errors
 
+
+def handle_dependencies(deps_path, mode):
+    errors = resolve_dependencies(deps_path, mode)
     if errors:
         print_(errors +os.linesep+os.linesep+ "NOTE: Only one binary per type is required")
         exit_now(65)
@@ -200,32 +346,14 @@ def display_error_info(e_type, text, raise_error):
 
 
 def safe_subprocess_run(command, raise_error=True):
-    try:
-        return subprocess.check_output(command, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError:
-        e_type, e = sys.exc_info()[:2]
-        e_text = "Cmd: "+str(e.cmd) + os.linesep + "Return code: "+str(e.returncode) + os.linesep
-        e_text += "Output: "+safe_output_decode(e.output).strip()
-        del e
-        if display_error_info(e_type, e_text, raise_error):
-            raise
-    except OSError:
-        e_type, e = sys.exc_info()[:2]
-        if display_error_info(e_type, "Name: "+e.strerror+" ("+str(e.errno)+") ", raise_error):
-            raise
-        del e
-
-    return False
-
-
-def safe_subprocess_run_timeout(command, raise_error=True, timeout=6):
-    if "TimeoutExpired" not in subprocess.__dict__:
-        return safe_subprocess_run(command, raise_error)
+    import toolrunner
 
     try:
-        return subprocess.check_output(command, stderr=subprocess.STDOUT, timeout=timeout)
-    except subprocess.TimeoutExpired:
-        print_(os.linesep+"WARNING: The command exceeded timeout, continuing anyway."+os.linesep)
+        returncode, output, usage = toolrunner.run(command, True)
+        TRACER.add_process(" ".join([os.path.basename(command[0])] + command[1:2]), usage)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command, output=output)
+        return output
     except subprocess.CalledProcessError:
         e_type, e = sys.exc_info()[:2]
         e_text = "Cmd: "+str(e.cmd) + os.linesep + "Return code: "+str(e.returncode) + os.linesep
@@ -247,13 +375,27 @@ def parse_7za_version(output):
     return output[output.rindex(" ")+1:]
 
 
+def read_7za_version(path):
+    try:
+        return parse_7za_version(safe_output_decode(subprocess.check_output([path, "i"])))
+    except (subprocess.CalledProcessError, OSError, ValueError):
+        return None
+
+
 def display_info():
     print_(os.linesep+"-----------------------")
     print_("Name: "+__app__)
     print_("Author: "+__author__+os.linesep)
 
     print_("Installed dependencies:")
-    print_("- 7za "+parse_7za_version(safe_output_decode(subprocess.check_output(["7za", "i"]))))
+    path = find_executable_cached("7za")
+    version = None
+    if path is not None:
+        version = get_tool_version("7za", path, read_7za_version)
+    if version is not None:
+        print_("- 7za "+version)
+    else:
+        print_("- 7za: missing (optional)")
     print_("-----------------------"+os.linesep)
 
 
@@ -322,58 +464,113 @@ def select_device():
     return chosen_one
 
 
+def get_adb_session(chosen_device):
+    import adbsession
+
+    ADB_SESSIONS_LOCK.acquire()
+    try:
+        if chosen_device not in ADB_SESSIONS:
+            ADB_SESSIONS[chosen_device] = adbsession.AdbSession(DEPS_PATH["adb"], chosen_device)
+        return ADB_SESSIONS[chosen_device]
+    finally:
+        ADB_SESSIONS_LOCK.release()
+
+
+def close_adb_sessions(chosen_device=None):
+    """Close the adb shell of a device (all if None), it must be done before restarting adbd or the device."""
+    for device, session in list(ADB_SESSIONS.items()):
+        if chosen_device is None or device == chosen_device:
+            debug("ADB session of "+device+": "+str(session.commands_count)+" command(s), "+str(session.starts_count)+" start(s)")
+            session.close()
+            del ADB_SESSIONS[device]
+
+
+def device_shell(chosen_device, command, raise_error=True, timeout=DEVICE_SHELL_TIMEOUT):
+    """Execute a shell command on the device and return its output, the errors are handled like safe_subprocess_run.
+
+    The command is sent through the persistent adb shell of the device, a new adb process is used only if it is not usable.
+    """
+    if USE_ADB_SESSION:
+        import adbsession
+        try:
+            returncode, output = get_adb_session(chosen_device).run(command, timeout)
+        except adbsession.AdbSessionError:
+            e = sys.exc_info()[1]
+            debug("The ADB session is not usable, using a new process ("+str(e)+")")
+            del e
+        else:
+            if returncode == 0:
+                return output
+            e_text = "Cmd: "+command + os.linesep + "Return code: "+str(returncode) + os.linesep
+            e_text += "Output: "+safe_output_decode(output).strip()
+            if display_error_info(subprocess.CalledProcessError, e_text, raise_error):
+                raise subprocess.CalledProcessError(returncode, command, output=output)
+            return False
+    return safe_subprocess_run([DEPS_PATH["adb"], "-s", chosen_device, "shell", command], raise_error)
+
+
 def adb_automount_if_needed(chosen_device, partition):
     print_(" *** Automounting "+partition+"...")
-    output = safe_subprocess_run([DEPS_PATH["adb"], "-s", chosen_device, "shell", "case $(mount) in  *' "+partition+" '*) echo 'Already mounted';;  *) mount '"+partition+"';;  esac"])
+    output = device_shell(chosen_device, "case $(mount) in  *' "+partition+" '*) echo 'Already mounted';;  *) mount '"+partition+"';;  esac")
     debug(safe_output_decode(output))
 
 
-def root_adbd(chosen_device):
-    print_(" *** Rooting adbd...")
-    root_output = safe_output_decode(subprocess.check_output([DEPS_PATH["adb"], "-s", chosen_device, "root"]))
+def trace_device_task(name, task):
+    """Task: run the task inside a stage of the trace."""
+    import deviceops
 
-    if "root access is disabled" in root_output:
-        print_(os.linesep+"ERROR: You do NOT have root or root access is disabled.")
-        print_(os.linesep+"Enable it in Settings -> Developer options -> Root access -> Apps and ADB.")
-        exit_now(80)
+    with TRACER.stage(name):
+        result = yield task
+    yield (deviceops.RESULT, result)
 
-    debug(root_output)
 
-    if "adbd is already running as root" in root_output:
-        return
+def run_device_task(chosen_device, task):
+    """Run a task of deviceops (with asyncio when available) and return its result, on failure exit with its code."""
+    import deviceops
 
-    if "adbd cannot run as root in production builds" in root_output:
-        global UNLOCKED_ADB
-        UNLOCKED_ADB = False
-        return
+    try:
+        if sys.version_info >= (3, 5):
+            import deviceops_async
+            return deviceops_async.run(task, DEPS_PATH["adb"], chosen_device)
+        return deviceops.run_sync(task, DEPS_PATH["adb"], chosen_device)
+    except deviceops.DeviceError:
+        e = sys.exc_info()[1]
+        print_(os.linesep+"ERROR: "+str(e))
+        exit_now(e.code)
 
-    output = safe_subprocess_run_timeout([DEPS_PATH["adb"], "-s", chosen_device, "wait-for-device"])
-    debug(safe_output_decode_false_passthrough(output))
+
+def show_device_writing(result):
+    global UNLOCKED_ADB
+    UNLOCKED_ADB, remount_output = result
+    print_(" *** Unlocked ADB:", UNLOCKED_ADB)
+    debug(remount_output.strip())
 
 
 def enable_device_writing(chosen_device):
-    root_adbd(chosen_device)
-    print_(" *** Unlocked ADB:", UNLOCKED_ADB)
+    import deviceops
+
+    print_(" *** Rooting adbd and remounting /system...")
+    close_adb_sessions(chosen_device)  # adbd may be restarted
+    show_device_writing(run_device_task(chosen_device, trace_device_task("device preparation", deviceops.enable_writing())))
 
-    print_(" *** Remounting /system...")
-    if UNLOCKED_ADB:
-        remount_check = safe_output_decode_false_passthrough(safe_subprocess_run_timeout([DEPS_PATH["adb"], "-s", chosen_device, "remount"]))
-        debug(remount_check)
-        if "Not running as root" in remount_check:
-            print_(os.linesep+"ERROR: Remount failed.")
-            exit_now(81)
-    else:
-        remount_check = safe_output_decode(safe_subprocess_run([DEPS_PATH["adb"], "-s", chosen_device, "shell", "su -c 'mount -o remount,rw /system /system && mount' | grep ' /system '"]))  # Untested
-        debug(remount_check)
-        if "su: not found" in remount_check:
-            print_(os.linesep+"ERROR: The device is NOT rooted.")
-            exit_now(81)
-        if "rw," not in remount_check:
-            print_(os.linesep+"ERROR: Alternative remount failed.")
-            exit_now(81)
-    if("remount failed" in remount_check) and ("Success" not in remount_check):  # Do NOT stop with "remount failed: Success"
-        print_(os.linesep+"ERROR: Remount failed.")
-        exit_now(81)
+
+def run_with_device_writing(chosen_device, host_function):
+    """Execute host_function while the device is prepared for writing, return False if it cannot be done concurrently."""
+    if not CONCURRENT_DEVICE_PREPARATION or sys.version_info < (3, 5):
+        return False  # The synchronous fallback cannot overlap the two things
+    import deviceops
+    import deviceops_async
+
+    print_(" *** Rooting adbd and remounting /system in the background...")
+    close_adb_sessions(chosen_device)
+    __, device_future = deviceops_async.run_with_host_function(trace_device_task("device preparation", deviceops.enable_writing()), DEPS_PATH["adb"], chosen_device, host_function)
+    try:
+        show_device_writing(device_future.result())
+    except deviceops.DeviceError:
+        e = sys.exc_info()[1]
+        print_(os.linesep+"ERROR: "+str(e))
+        exit_now(e.code)
+    return True
 
 
 def safe_copy(orig, dest):
@@ -384,6 +581,115 @@ def safe_copy(orig, dest):
         warning("shutil.copystat has failed.")
 
 
+def safe_link(orig, dest):
+    """Like safe_copy but the copy may be a copy-on-write clone.
+
+    It is never a hardlink: the input, the backup and the output are visible to the user and they may be overwritten in-place by other programs.
+    """
+    if not LINK_COPIES:
+        return safe_copy(orig, dest)
+    import contentcache
+
+    contentcache.clone_file(orig, dest)
+    try:
+        shutil.copystat(orig, dest)  # It may fail on Android
+    except OSError:
+        warning("shutil.copystat has failed.")
+
+
+def enable_low_memory():
+    """Bound the memory used by the run, every stage already streams or memory maps its input."""
+    global LOW_MEMORY, PARALLEL_DISASSEMBLE, PLAN_DEX_LAYOUT, RAM_WORK_DIR
+    LOW_MEMORY = True
+    PARALLEL_DISASSEMBLE = False  # A single virtual machine at a time
+    PLAN_DEX_LAYOUT = False  # The references of every package would be kept in memory, the assembler will find the overflow
+    RAM_WORK_DIR = False  # A work dir on tmpfs uses memory too
+
+
+def check_memory_budget():
+    """Show the peak memory of every stage and warn about the ones over the budget."""
+    over_budget = []
+    for name, peak_rss in TRACER.get_stages_peak_rss():
+        if peak_rss is None:
+            continue
+        debug("Peak memory of "+name+": "+str(peak_rss // 1024)+" MiB")
+        if peak_rss > LOW_MEMORY_BUDGET * 1024 and name not in over_budget:
+            over_budget.append(name)
+    if over_budget:
+        warning("The memory budget ("+str(LOW_MEMORY_BUDGET)+" MiB) has been exceeded in: "+", ".join(over_budget))
+
+
+def get_work_dir_parent():
+    """Return the folder where the work dir is created, None means the default temporary folder."""
+    if not RAM_WORK_DIR or not os.path.isdir(RAM_WORK_DIR_PARENT) or "statvfs" not in os.__dict__:
+        return None
+    try:
+        stats = os.statvfs(RAM_WORK_DIR_PARENT)
+    except OSError:
+        return None
+    free_space = stats.f_bavail * stats.f_frsize // (1024 * 1024)
+    available_mem = get_available_memory()
+    # The files on tmpfs use the physical memory, that is also needed by the JVM
+    if available_mem is None or min(free_space, available_mem) < RAM_WORK_DIR_MIN_FREE or not os.access(RAM_WORK_DIR_PARENT, os.W_OK):
+        return None
+    return RAM_WORK_DIR_PARENT
+
+
+def make_work_dir():
+    purge_old_work_dirs()
+    import tempfile
+
+    return tempfile.mkdtemp("", __app__+"-", get_work_dir_parent())
+
+
+def delete_in_background(paths):
+    """Delete the folders in a detached process, return False if it cannot be started."""
+    cmd = [sys.executable, "-c", "import sys, shutil\nfor path in sys.argv[1:]:\n    shutil.rmtree(path, True)"] + paths
+    devnull = open(os.devnull, "r+b")
+    try:
+        if sys.platform_codename == "win":
+            subprocess.Popen(cmd, stdin=devnull, stdout=devnull, stderr=devnull, creationflags=0x00000008)  # DETACHED_PROCESS
+        else:
+            subprocess.Popen(cmd, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+    except (OSError, ValueError):
+        return False
+    finally:
+        devnull.close()
+    return True
+
+
+def remove_work_dir(work_dir):
+    if BACKGROUND_CLEANUP:
+        # The renaming is immediate, the files are deleted after the exit and a new run never sees them
+        trash_dir = work_dir.rstrip("/\\")+"-trash"
+        try:
+            os.rename(work_dir, trash_dir)
+        except OSError:
+            pass
+        else:
+            if delete_in_background([trash_dir]):
+                return
+            work_dir = trash_dir
+    shutil.rmtree(work_dir+"/")
+
+
+def purge_old_work_dirs():
+    """Delete (in background) the work dirs whose deletion has been interrupted in the previous runs."""
+    import glob
+    import tempfile
+
+    if not BACKGROUND_CLEANUP:
+        return
+    parents = [tempfile.gettempdir()]
+    if os.path.isdir(RAM_WORK_DIR_PARENT):
+        parents.append(RAM_WORK_DIR_PARENT)
+    old_dirs = []
+    for parent in parents:
+        old_dirs.extend(glob.glob(os.path.join(parent, __app__+"-*-trash")))
+    if old_dirs:
+        delete_in_background(old_dirs)
+
+
 def safe_move(orig, dest):
     if not os.path.exists(orig) or os.path.exists(dest.rstrip("/")):
         print_(os.linesep+"ERROR: Safe move fail.")  # ToDO: Notify error better
@@ -397,6 +703,8 @@ def safe_file_delete(file_path):
 
 
 def clean_dalvik_cache(file):
+    if TOOL_DALVIK_DATA is not None:
+        return  # The optimized file is in the private dalvik-cache and it is reused by the next calls
     safe_file_delete("/data/dalvik-cache/"+file[1:].replace("/", "@")+"@classes.art")
     safe_file_delete("/data/dalvik-cache/"+file[1:].replace("/", "@")+"@classes.dex")
 
@@ -413,28 +721,211 @@ def parse_sdk_ver(filename):
     return None
 
 
-def brew_input_file(mode, files_list, chosen_one):
-    if mode == 1:
+def get_device_file_hash(chosen_device, file_path):
+    """Return a tuple with the algorithm and the hex digest of a file on the device, None if it cannot be computed."""
+    import hashlib
+
+    output = device_shell(chosen_device, "sha256sum '"+file_path+"' 2>/dev/null || md5sum '"+file_path+"' 2>/dev/null || true", False)
+    if output == False:
+        return None
+    digest = safe_output_decode(output).strip().split(" ")[0].lower()
+    # The output must be validated since the hashing tools may be missing
+    for algorithm in ("sha256", "md5"):
+        if len(digest) == hashlib.new(algorithm).digest_size * 2 and not digest.strip("0123456789abcdef"):
+            return (algorithm, digest)
+    return None
+
+
+def is_device_file_equal(chosen_device, file_path, local_file):
+    import contentcache
+
+    device_hash = get_device_file_hash(chosen_device, file_path)
+    if device_hash is None:
+        return False
+    return contentcache.hash_file(local_file, device_hash[0]) == device_hash[1]
+
+
+def exec_out_pull(chosen_device, file_path, dest_file):
+    """Stream a file from the device compressed with gzip, return False if it is not possible."""
+    import zlib
+
+    devnull = open(os.devnull, "wb")
+    try:
+        process = subprocess.Popen([DEPS_PATH["adb"], "-s", chosen_device, "exec-out", "gzip -c '"+file_path+"' 2>/dev/null"], stdout=subprocess.PIPE, stderr=devnull)
+        try:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            fo = open(dest_file, "wb")
+            try:
+                while True:
+                    chunk = process.stdout.read(64 * 1024)
+                    if not chunk:
+                        break
+                    fo.write(decompressor.decompress(chunk))
+                fo.write(decompressor.flush())
+            finally:
+                fo.close()
+        finally:
+            process.stdout.close()
+            process.wait()
+    except (zlib.error, IOError, OSError):
+        safe_file_delete(dest_file)
+        return False
+    finally:
+        devnull.close()
+    return process.returncode == 0
+
+
+def get_pull_cache():
+    import contentcache
+    return contentcache.ContentCache(os.path.join(get_cache_dir(), "pull"), PULL_CACHE_MAX_SIZE * 1024 * 1024)
+
+
+def pull_device_file(chosen_device, file_path, dest_dir):
+    """Pull a file from the device, the local copy is reused if the hash on the device matches. Return False on failure."""
+    import tempfile
+    import contentcache
+
+    filename = file_path.rsplit("/", 1)[-1]
+    dest_file = os.path.join(dest_dir, filename)
+    device_hash = None
+    if PULL_CACHE or USE_EXEC_OUT:
+        device_hash = get_device_file_hash(chosen_device, file_path)
+
+    cache_key = None
+    if PULL_CACHE and device_hash is not None:
+        cache_key = contentcache.make_key(filename, device_hash[0], device_hash[1])
+        if count_cache_lookup("pull", get_pull_cache().restore(cache_key, dest_dir)):
+            debug("Reused the local copy of "+file_path)
+            return True
+
+    pulled = False
+    if USE_EXEC_OUT and device_hash is not None:
+        # Without the hash the integrity of the stream cannot be verified
+        pulled = exec_out_pull(chosen_device, file_path, dest_file) and contentcache.hash_file(dest_file, device_hash[0]) == device_hash[1]
+        if not pulled:
+            debug("The pulling through exec-out is not usable for "+file_path)
+            safe_file_delete(dest_file)
+    if not pulled and safe_subprocess_run([DEPS_PATH["adb"], "-s", chosen_device, "pull", file_path, dest_dir], False) == False:
+        return False
+
+    if cache_key is not None and contentcache.hash_file(dest_file, device_hash[0]) == device_hash[1]:
+        staging_dir = tempfile.mkdtemp("", "pulled-", dest_dir)
+        try:
+            shutil.copyfile(dest_file, os.path.join(staging_dir, filename))
+            get_pull_cache().store(cache_key, staging_dir, {"file": file_path, "device": chosen_device})
+        finally:
+            shutil.rmtree(staging_dir, True)
+    return True
+
+
+def get_odex_container_names():
+    """Return the relative paths where the vdex / oat with the dex files of framework.jar can be found, in order of preference."""
+    names = list(ODEX_CONTAINERS)  # Already pulled in the root of the folder
+    for arch in ODEX_ARCHS:
+        names.extend([arch+"/"+filename for filename in ODEX_CONTAINERS])
+    return names
+
+
+def find_odex_container(folder):
+    for name in get_odex_container_names():
+        if os.path.isfile(os.path.join(folder, name)):
+            return os.path.join(folder, name)
+    return None
+
+
+def find_device_odex_container(chosen_device):
+    paths = ["/system/framework/"+name for name in get_odex_container_names()[len(ODEX_CONTAINERS):]]
+    output = device_shell(chosen_device, "ls "+" ".join(paths)+" 2>/dev/null", False)
+    if output == False:
+        return None
+    existing = safe_output_decode(output).split()
+    for path in paths:
+        if path in existing:
+            return path
+    return None
+
+
+def has_dex(file):
+    import zipengine
+
+    try:
+        return len(zipengine.list_dex(file)) > 0
+    except zipengine.ERRORS:
+        return True  # The error will be shown by decompress()
+
+
+def brew_input_file(mode, files_list, chosen_one, input_dir=None):
+    global ODEX_CONTAINER
+    if mode == 1 and input_dir is None:
         print_(" *** Pulling framework from device...")
         for path, filename in files_list:
-            try:
-                safe_subprocess_run([DEPS_PATH["adb"], "-s", chosen_one, "pull", path+"/"+filename, "."])
-            except (subprocess.CalledProcessError, OSError):
+            if not pull_device_file(chosen_one, path+"/"+filename, "."):
                 exit_now(90)
-    elif mode == 2:
-        if not os.path.exists(SCRIPT_DIR+"/input/framework.jar"):
+        if not has_dex("framework.jar"):
+            container = find_device_odex_container(chosen_one)
+            if container is not None:
+                print_(" *** The ROM is odexed, pulling "+container+"...")
+                if not pull_device_file(chosen_one, container, "."):
+                    exit_now(90)
+                ODEX_CONTAINER = os.path.join(TMP_DIR, container.split("/")[-1])
+    elif mode in (1, 2):
+        if input_dir is None:
+            input_dir = os.path.join(SCRIPT_DIR, "input")
+        if not os.path.exists(os.path.join(input_dir, "framework.jar")):
             print_(os.linesep+"ERROR: The input file cannot be found.")
             exit_now(91)
-        safe_copy(os.path.join(SCRIPT_DIR, "input", "framework.jar"), os.path.join(TMP_DIR, "framework.jar"))
-        safe_copy(os.path.join(SCRIPT_DIR, "input", "build.prop"), os.path.join(TMP_DIR, "build.prop"))
+        safe_link(os.path.join(input_dir, "framework.jar"), os.path.join(TMP_DIR, "framework.jar"))
+        try:
+            safe_copy(os.path.join(input_dir, "build.prop"), os.path.join(TMP_DIR, "build.prop"))
+        except EnvironmentError:
+            print_(os.linesep+"ERROR: The build.prop of the input cannot be read ("+str(sys.exc_info()[1])+").")
+            exit_now(99)
+        if not has_dex(os.path.join(TMP_DIR, "framework.jar")):
+            ODEX_CONTAINER = find_odex_container(input_dir)  # It is read in-place, boot images are big
     else:
-        safe_copy("/system/framework/framework.jar", os.path.join(TMP_DIR, "framework.jar"))
+        safe_link("/system/framework/framework.jar", os.path.join(TMP_DIR, "framework.jar"))
+        if not has_dex(os.path.join(TMP_DIR, "framework.jar")):
+            ODEX_CONTAINER = find_odex_container("/system/framework")
+    if ODEX_CONTAINER is not None:
+        debug("Odex container: "+ODEX_CONTAINER)
+
+
+def extract_odex_container(out_dir, jar_name):
+    """Extract the dex files of an odexed jar from its vdex / oat, exit if there is none."""
+    import oatextract
+
+    if ODEX_CONTAINER is None:
+        print_("ERROR: No dex file(s) found, probably the ROM is odexed.")
+        exit_now(87)
+    print_(" *** The ROM is odexed, extracting the dex files from "+os.path.basename(ODEX_CONTAINER)+"...")
+    try:
+        extracted = oatextract.extract_dex(ODEX_CONTAINER, out_dir, jar_name)
+    except oatextract.READ_ERRORS:
+        e = sys.exc_info()[1]
+        print_("ERROR: "+str(e))
+        del e
+        exit_now(87)
+    debug("Extracted: "+", ".join(extracted))
+    return True
 
 
 def decompress(file, out_dir):
     debug("Decompressing "+file)
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
+    if USE_ZIP_ENGINE:
+        import zipengine
+        try:
+            extracted = zipengine.extract_dex(file, out_dir)
+        except zipengine.ERRORS:
+            e = sys.exc_info()[1]
+            print_("ERROR: "+str(e))
+            del e
+            exit_now(87)
+        if not extracted:
+            return extract_odex_container(out_dir, os.path.basename(file))
+        return True
+
     if "7za" in DEPS_PATH:
         decomp_cmd = [DEPS_PATH["7za"], "x", "-y", "-bd", "-tzip", "-o"+out_dir]
     elif "unzip" in DEPS_PATH:
@@ -447,16 +938,33 @@ def decompress(file, out_dir):
         safe_subprocess_run(decomp_cmd)
     except (subprocess.CalledProcessError, OSError):
         e = sys.exc_info()[1]
-
-        if "unzip" in DEPS_PATH and e.returncode == 11:
-            print_("ERROR: No dex file(s) found, probably the ROM is odexed.")
+        no_dex = "unzip" in DEPS_PATH and getattr(e, "returncode", None) == 11
         del e
-        exit_now(87)
+        if not no_dex:
+            exit_now(87)
+    if not [filename for filename in os.listdir(out_dir) if filename.endswith(".dex")]:
+        return extract_odex_container(out_dir, os.path.basename(file))
     return True
 
 
 def compress(in_dir, file):
     debug("Compressing "+file)
+    if USE_ZIP_ENGINE:
+        import zipengine
+        try:
+            rewritten = zipengine.update_archive(file, in_dir, file+".tmp")
+            os.remove(file)
+            os.rename(file+".tmp", file)
+        except zipengine.ERRORS:
+            e = sys.exc_info()[1]
+            print_("ERROR: "+str(e))
+            if isinstance(e, EnvironmentError) and sys.platform_codename == "win":
+                print_("ERROR: Another process (probably an antivirus) is locking the temporary files and the process cannot continue.")
+            del e
+            exit_now(88)
+        debug("Recompressed entries: "+", ".join(rewritten))
+        return True
+
     if "7za" in DEPS_PATH:
         comp_cmd = [DEPS_PATH["7za"], "a", "-y", "-bd", "-tzip", file, os.path.join(in_dir, "*.dex")]
     else:
@@ -476,67 +984,997 @@ def compress(in_dir, file):
     return True
 
 
-def disassemble(file, out_dir, device_sdk):
-    debug("Disassembling "+file)
+def get_cache_dir():
+    cache_dir = os.path.join(SCRIPT_DIR, "cache")
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    return cache_dir
+
+
+def is_noexec(path):
+    if "statvfs" not in os.__dict__:
+        return False
+    try:
+        return bool(os.statvfs(path).f_flag & 8)  # ST_NOEXEC
+    except OSError:
+        return True
+
+
+def remove_tool_dalvik_caches(keep=None):
+    cache_dir = get_cache_dir()
+    for filename in os.listdir(cache_dir):
+        if filename.startswith("dalvik-") and filename != keep:
+            shutil.rmtree(os.path.join(cache_dir, filename), True)
+
+
+def setup_tool_dalvik_cache():
+    """Make dalvikvm keep the optimized tool jars in a private dalvik-cache, the folder is replaced only when the jars change.
+
+    Dalvik and ART place the optimized files in $ANDROID_DATA/dalvik-cache, so the variable is changed for the child processes.
+    """
+    global TOOL_DALVIK_DATA
+    import hashlib
+    import startupcache
+
+    cache_dir = get_cache_dir()
+    if not TOOL_DALVIK_CACHE or is_noexec(cache_dir):
+        return  # The optimized files must be mapped as executable
+    jars = [SCRIPT_DIR+"/tools/"+tool+"-dvk.jar" for tool in sorted(TOOL_MAIN_CLASSES)]
+    stamp = hashlib.md5(str(startupcache.get_fingerprint(jars)).encode("utf-8")).hexdigest()[:12]
+    TOOL_DALVIK_DATA = os.path.join(cache_dir, "dalvik-"+stamp)
+    remove_tool_dalvik_caches("dalvik-"+stamp)
+    if not os.path.exists(os.path.join(TOOL_DALVIK_DATA, "dalvik-cache")):
+        os.makedirs(os.path.join(TOOL_DALVIK_DATA, "dalvik-cache"))
+    os.environ["ANDROID_DATA"] = TOOL_DALVIK_DATA
+    debug("Optimized tool jars: "+TOOL_DALVIK_DATA)
+
+
+def build_tool_server_dex():
+    """Assemble the Dalvik version of the tool server (only when the smali source change)."""
+    source = SCRIPT_DIR+"/misc/ToolServer.smali"
+    server_dex = os.path.join(get_cache_dir(), "ToolServer-dvk.dex")
+    if os.path.exists(server_dex) and os.path.getmtime(server_dex) >= os.path.getmtime(source):
+        return server_dex
+
+    debug("Building the tool server")
+    output = safe_subprocess_run([DEPS_PATH["dalvikvm"], "-Xmx166m", "-cp", SCRIPT_DIR+"/tools/smali-dvk.jar", "org.jf.smali.Main", "assemble", "-o", server_dex, source], False)
+    if output == False:
+        safe_file_delete(server_dex)
+        return None
+    return server_dex
+
+
+def build_tool_server_class():
+    """Compile the Java version of the tool server in the cache folder (only when the source change), return the folder or None."""
+    source = SCRIPT_DIR+"/misc/ToolServer.java"
+    class_dir = os.path.join(get_cache_dir(), "toolserver-jvm")
+    server_class = os.path.join(class_dir, "ToolServer.class")
+    if os.path.exists(server_class) and os.path.getmtime(server_class) >= os.path.getmtime(source):
+        return class_dir
+
+    # The javac of the same JDK of java is preferred, a JRE does not have it
+    javac = os.path.join(os.path.dirname(os.path.realpath(DEPS_PATH["java"])), "javac.exe" if sys.platform_codename == "win" else "javac")
+    if not os.path.isfile(javac):
+        javac = find_executable_cached("javac")
+        if javac is None:
+            return None
+    debug("Building the tool server")
+    if not os.path.exists(class_dir):
+        os.makedirs(class_dir)
+    output = safe_subprocess_run([javac, "-encoding", "UTF-8", "-nowarn", "-d", class_dir, source], False)
+    if output == False:
+        safe_file_delete(server_class)
+        return None
+    return class_dir
+
+
+def get_tool_server_cmd(heap):
+    heap_option = "-Xmx"+str(heap)+"m"
     if "java" in DEPS_PATH:
-        disass_cmd = [DEPS_PATH["java"], "-jar", SCRIPT_DIR+"/tools/baksmali.jar"]
-    else:
-        disass_cmd = [DEPS_PATH["dalvikvm"], "-Xmx128m", "-cp", SCRIPT_DIR+"/tools/baksmali-dvk.jar", "org.jf.baksmali.Main"]
-    disass_cmd.extend(["dis", "-l", "--seq", "-o", out_dir, file])
+        class_path = SCRIPT_DIR+"/tools/smali.jar" + os.pathsep + SCRIPT_DIR+"/tools/baksmali.jar"
+        if os.path.exists(SCRIPT_DIR+"/misc/ToolServer.class"):
+            return [DEPS_PATH["java"], heap_option, "-cp", class_path + os.pathsep + SCRIPT_DIR+"/misc", "ToolServer"]
+        class_dir = build_tool_server_class()
+        if class_dir is not None:
+            return [DEPS_PATH["java"], heap_option, "-cp", class_path + os.pathsep + class_dir, "ToolServer"]
+        return [DEPS_PATH["java"], heap_option, "-cp", class_path, SCRIPT_DIR+"/misc/ToolServer.java"]  # Source-file mode (Java 11 or later)
+
+    server_dex = build_tool_server_dex()
+    if server_dex is None:
+        return None
+    class_path = SCRIPT_DIR+"/tools/smali-dvk.jar" + os.pathsep + SCRIPT_DIR+"/tools/baksmali-dvk.jar" + os.pathsep + server_dex
+    return [DEPS_PATH["dalvikvm"], heap_option, "-cp", class_path, "ToolServer"]
+
+
+def get_tool_server(heap):
+    """Return the tool server (restarted if its heap is smaller than the requested one) or None."""
+    global TOOL_SERVER, TOOL_SERVER_HEAP
+    if TOOL_SERVER is None:
+        TOOL_SERVER = False
+        if USE_TOOL_SERVER:
+            server_cmd = get_tool_server_cmd(heap)
+            if server_cmd is not None:
+                import toolserver
+                TOOL_SERVER = toolserver.ToolServer(server_cmd, TMP_DIR)
+                TOOL_SERVER_HEAP = heap
+    if TOOL_SERVER is False:
+        return None
+    if heap > TOOL_SERVER_HEAP:
+        debug("Restarting the tool server with "+str(heap)+" MiB of heap")
+        TOOL_SERVER.stop()
+        TOOL_SERVER.cmd = get_tool_server_cmd(heap)
+        TOOL_SERVER_HEAP = heap
+    return TOOL_SERVER
+
+
+def stop_tool_server():
+    if TOOL_SERVER:
+        debug("Tool server: "+str(TOOL_SERVER.jobs_count)+" job(s), "+str(TOOL_SERVER.starts_count)+" JVM start(s)")
+        TOOL_SERVER.stop()
+
+
+def get_cpu_count():
+    import multiprocessing
+
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def get_jvm_options(tool, input_size, workers=1):
+    """Return the heap size (MiB) and the number of threads for a job, sized on the input and on this machine."""
+    import toolrunner
+
+    available_mem = get_available_memory()
+    if available_mem is not None:
+        available_mem //= workers
+    return toolrunner.choose_jvm_options(tool, input_size, available_mem, max(get_cpu_count() // workers, 1))
+
+
+def get_tool_cmd(tool, heap):
+    if "java" in DEPS_PATH:
+        return [DEPS_PATH["java"], "-Xmx"+str(heap)+"m", "-jar", SCRIPT_DIR+"/tools/"+tool+".jar"]
+    return [DEPS_PATH["dalvikvm"], "-Xmx"+str(heap)+"m", "-cp", SCRIPT_DIR+"/tools/"+tool+"-dvk.jar", TOOL_MAIN_CLASSES[tool]]
+
+
+def record_tool_usage(tool, input_size, heap, threads, usage):
+    """Log the resources used by a job, the log is useful to tune the sizing of the JVM."""
+    import json
+    import time
+
+    elapsed, cpu_time, max_rss, read_bytes, written_bytes = usage
+    info = " ("+str(input_size // 1024)+" KiB input, "+str(heap)+" MiB heap, "+str(threads)+" thread(s)): {0:.1f} s".format(elapsed)
+    if cpu_time is not None:
+        info += ", {0:.1f} s CPU".format(cpu_time)
+    if max_rss is not None:
+        info += ", "+str(max_rss // 1024)+" MiB peak RSS"
+    debug(tool.capitalize()+info)
+    TRACER.add_process(tool, usage, input_size=input_size, heap=heap, threads=threads)
+    if not TOOL_USAGE_LOG:
+        return
+    record = {"time": time.time(), "tool": tool, "input_size": input_size, "heap": heap, "threads": threads, "java": "java" in DEPS_PATH,
+              "available_mem": get_available_memory(), "elapsed": elapsed, "cpu_time": cpu_time, "max_rss": max_rss,
+              "read_bytes": read_bytes, "written_bytes": written_bytes}
+    try:
+        fo = open(os.path.join(get_cache_dir(), "tool-usage.log"), "a")
+        try:
+            fo.write(json.dumps(record, sort_keys=True)+"\n")
+        finally:
+            fo.close()
+    except (IOError, OSError):
+        pass  # The log is only informative
+
+
+def run_tool(tool, args, input_size, hide_output=False):
+    """Run smali / baksmali inside the persistent tool server when possible, otherwise in a new process.
+
+    The heap and the threads are chosen from the input size (bytes) and from the resources of this machine.
+    """
+    global TOOL_SERVER
+    import toolrunner
+
+    heap, threads = get_jvm_options(tool, input_size)
+    args = args + ["-j", str(threads)]
+    server = get_tool_server(heap)
+    if server is not None:
+        import toolserver
+        try:
+            returncode, output = server.run(tool, args)
+        except toolserver.ToolServerError:
+            e = sys.exc_info()[1]
+            warning("The tool server is not usable, falling back to a process per call ("+str(e)+")")
+            del e
+            server.stop()
+            TOOL_SERVER = False
+        else:
+            record_tool_usage(tool, input_size, heap, threads, server.last_usage)
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, get_tool_cmd(tool, heap)+args, output=output)
+            if hide_output:
+                return output
+            if output.strip():
+                print_(safe_output_decode(output).rstrip())
+            return True
+
+    cmd = get_tool_cmd(tool, heap)+args
+    returncode, output, usage = toolrunner.run(cmd, hide_output)
+    record_tool_usage(tool, input_size, heap, threads, usage)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, output=output)
+    if hide_output:
+        return output
+    return True
+
+
+def get_disassemble_args(file, out_dir, device_sdk):
+    disass_args = ["dis", "-l", "--seq", "-o", out_dir, file]
     if device_sdk is not None:
-        disass_cmd.extend(["-a", device_sdk])
+        disass_args.extend(["-a", device_sdk])
+    return disass_args
+
+
+def get_disassemble_cmd(file, out_dir, device_sdk, workers=1):
+    heap, threads = get_jvm_options("baksmali", os.path.getsize(file), workers)
+    return get_tool_cmd("baksmali", heap) + get_disassemble_args(file, out_dir, device_sdk) + ["-j", str(threads)]
+
+
+def get_smali_cache():
+    import contentcache
+    return contentcache.ContentCache(os.path.join(get_cache_dir(), "smali"), SMALI_CACHE_MAX_SIZE * 1024 * 1024)
+
+
+def get_result_cache():
+    import contentcache
+    return contentcache.ContentCache(os.path.join(get_cache_dir(), "result"), RESULT_CACHE_MAX_SIZE * 1024 * 1024)
+
+
+def count_cache_lookup(cache_name, hit):
+    if hit:
+        CACHE_COUNTERS[cache_name][0] += 1
+    else:
+        CACHE_COUNTERS[cache_name][1] += 1
+    return hit
+
+
+def get_result_cache_key(patches_list, device_sdk):
+    import contentcache
+
+    patches_ids = []
+    for patch in patches_list:
+        patch_class = patch.__class__
+        patches_ids.append(patch_class.__module__+"."+patch_class.__name__+" "+patch_class.version)
+    odex_hash = None
+    if ODEX_CONTAINER is not None:
+        odex_hash = contentcache.hash_file(ODEX_CONTAINER)  # The odexed archives of different ROMs can be identical
+    return contentcache.make_key(contentcache.hash_file("framework.jar"), odex_hash, " ".join(patches_ids), BasePatch._patch_ver, device_sdk)
+
+
+def restore_result_cache(cache_key):
+    """Replace framework.jar in the working dir with the cached patched file, return False on a miss."""
+    if not count_cache_lookup("result", get_result_cache().restore(cache_key, "cached-result/")):
+        return False
+    safe_file_delete("framework.jar")
+    safe_move("cached-result/framework.jar", "framework.jar")
+    return True
+
+
+def store_result_cache(cache_key, patches_list):
+    os.makedirs("result/")
+    safe_link("framework.jar", "result/framework.jar")
+    get_result_cache().store(cache_key, "result/", {"patches": [[patch.__class__.name, patch.__class__.version] for patch in patches_list]})
+
+
+def read_baksmali_version(jar):
+    import zipfile
+
+    zf = zipfile.ZipFile(jar, "r")
+    try:
+        properties = safe_output_decode(zf.read("baksmali.properties"))
+    finally:
+        zf.close()
+    return properties.split("=", 1)[-1].strip()
+
+
+def get_baksmali_version():
+    if "java" in DEPS_PATH:
+        jar = SCRIPT_DIR+"/tools/baksmali.jar"
+    else:
+        jar = SCRIPT_DIR+"/tools/baksmali-dvk.jar"
+    return get_tool_version("baksmali", jar, read_baksmali_version)
+
+
+def get_smali_cache_key(file, device_sdk):
+    import contentcache
+    return contentcache.make_key(contentcache.hash_file(file), "baksmali "+get_baksmali_version(), " ".join(get_disassemble_args("", "", device_sdk)))
+
 
-    subprocess.check_call(disass_cmd)
+def restore_smali_cache(file, out_dir, device_sdk):
+    """Restore a pristine disassembled tree from the cache, return the key to store it on a miss (or None)."""
+    if not SMALI_CACHE:
+        return None
+    cache_key = get_smali_cache_key(file, device_sdk)
+    if count_cache_lookup("smali", get_smali_cache().restore(cache_key, out_dir)):
+        debug("Restored "+file+" from the smali cache")
+        return True
+    return cache_key
+
+
+def store_smali_cache(cache_key, file, out_dir):
+    if cache_key is not None and cache_key is not True:
+        get_smali_cache().store(cache_key, out_dir, {"dex": os.path.basename(file)})
+
+
+def show_cache_stats():
+    import time
+
+    for cache_name, cache in (("Smali", get_smali_cache()), ("Result", get_result_cache()), ("Pull", get_pull_cache())):
+        stats = cache.stats()
+        print_(cache_name+" cache: "+cache.root)
+        print_("- Entries: "+str(stats["entries"]))
+        print_("- Size: "+str(stats["size"] // (1024 * 1024))+" MiB (max "+str(stats["max_size"] // (1024 * 1024))+" MiB)")
+        for counter in ("hits", "misses", "stores", "evictions"):
+            print_("- "+counter.capitalize()+": "+str(stats.get(counter, 0)))
+        if stats["entries"]:
+            print_("- Least recently used: "+time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stats["oldest_use"])))
+            print_("- Most recently used: "+time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stats["newest_use"])))
+        print_()
+
+
+def show_cache_summary():
+    for cache_name in ("pull", "result", "smali"):
+        hits, misses = CACHE_COUNTERS[cache_name]
+        if hits or misses:
+            print_(" *** "+cache_name.capitalize()+" cache:", hits, "hit(s),", misses, "miss(es)")
+
+
+def disassemble(file, out_dir, device_sdk):
+    cache_key = restore_smali_cache(file, out_dir, device_sdk)
+    if cache_key is True:
+        return True
+    debug("Disassembling "+file)
+    run_tool("baksmali", get_disassemble_args(file, out_dir, device_sdk), os.path.getsize(file))
     if sys.platform_codename == "android":
         clean_dalvik_cache(SCRIPT_DIR+"/tools/baksmali-dvk.jar")
+    store_smali_cache(cache_key, file, out_dir)
     return True
 
 
 def assemble(in_dir, file, device_sdk, hide_output=False):
     debug("Assembling "+file)
-    if "java" in DEPS_PATH:
-        ass_cmd = [DEPS_PATH["java"], "-jar", SCRIPT_DIR+"/tools/smali.jar", "assemble"]
-    else:
-        ass_cmd = [DEPS_PATH["dalvikvm"], "-Xmx166m", "-cp", SCRIPT_DIR+"/tools/smali-dvk.jar", "org.jf.smali.Main", "assemble", "-j", "1"]
-    ass_cmd.extend(["-o", file, in_dir])
+    ass_args = ["assemble", "-o", file, in_dir]
     if device_sdk is not None:
-        ass_cmd.extend(["-a", device_sdk])
+        ass_args.extend(["-a", device_sdk])
 
+    input_size = get_tree_size(in_dir)
     if hide_output:
-        return subprocess.check_output(ass_cmd, stderr=subprocess.STDOUT)
-    subprocess.check_call(ass_cmd)
+        return run_tool("smali", ass_args, input_size, True)
+    run_tool("smali", ass_args, input_size)
     if sys.platform_codename == "android":
         clean_dalvik_cache(SCRIPT_DIR+"/tools/smali-dvk.jar")
     return True
 
 
-def find_smali(search_dir, device_sdk):
+def get_available_memory():
+    """Return the available physical memory in MiB or None if it is unknown."""
+    try:
+        fo = open("/proc/meminfo", "r")
+    except (IOError, OSError):
+        return None
+    try:
+        for line in fo:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) // 1024
+    finally:
+        fo.close()
+    return None
+
+
+def get_tree_size(path):
+    total_size = 0
+    for root, __, files in os.walk(path):
+        for filename in files:
+            total_size += os.path.getsize(os.path.join(root, filename))
+    return total_size
+
+
+def get_workers_budget(per_worker_mem):
+    workers = get_cpu_count()
+    if MAX_WORKERS is not None:
+        workers = min(workers, MAX_WORKERS)
+    available_mem = get_available_memory()
+    if available_mem is not None:
+        workers = min(workers, available_mem // per_worker_mem)
+    return max(workers, 1)
+
+
+def get_smali_path(descriptor):
+    return descriptor[1:-1]+".smali"
+
+
+def get_patches_classes(patches_list):
+    """Return the classes listed by the patches, without duplicates."""
+    descriptors = []
+    for patch in patches_list:
+        for descriptor in patch.get_classes_list():
+            if descriptor not in descriptors:
+                descriptors.append(descriptor)
+    return descriptors
+
+
+def has_patches_classes(patches_list, found):
+    """Return True when at least one class of every patch has been found, the other classes of a patch are only alternatives."""
+    for patch in patches_list:
+        if not [descriptor for descriptor in patch.get_classes_list() if descriptor in found]:
+            return False
+    return True
+
+
+def find_smali_targets(out_dir, dex_filename, patches_list, found):
+    """Add to found the classes that are in the smali tree of the dex, return True when the search can stop."""
+    for descriptor in get_patches_classes(patches_list):
+        if descriptor not in found and os.path.exists(out_dir+get_smali_path(descriptor)):
+            found[descriptor] = (out_dir, dex_filename)
+    return has_patches_classes(patches_list, found)
+
+
+def kill_processes(running):
+    for __, __, process, __ in running:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+
+
+def find_smali_parallel(search_dir, dir_list, device_sdk, max_workers, patches_list, found):
+    import time
+    import toolrunner
+
+    debug("Disassembling with "+str(max_workers)+" workers")
+    pending = list(dir_list)
+    running = []
+    start_times = {}
+    try:
+        while pending or running:
+            while pending and len(running) < max_workers:
+                filename = pending.pop(0)
+                out_dir = "./smali-"+remove_ext(filename)+"/"
+                cache_key = restore_smali_cache(search_dir+filename, out_dir, device_sdk)
+                if cache_key is True:
+                    if find_smali_targets(out_dir, filename, patches_list, found):
+                        return
+                    continue
+                debug("Disassembling "+search_dir+filename)
+                running.append((filename, out_dir, subprocess.Popen(get_disassemble_cmd(search_dir+filename, out_dir, device_sdk, max_workers)), cache_key))
+                start_times[filename] = time.time()
+
+            for item in tuple(running):
+                filename, out_dir, process, cache_key = item
+                returncode, cpu_time, max_rss, read_bytes, written_bytes = toolrunner.poll_process(process)
+                if returncode is None:
+                    continue
+                running.remove(item)
+                heap, threads = get_jvm_options("baksmali", os.path.getsize(search_dir+filename), max_workers)
+                record_tool_usage("baksmali", os.path.getsize(search_dir+filename), heap, threads, (time.time() - start_times[filename], cpu_time, max_rss, read_bytes, written_bytes))
+                if returncode != 0:
+                    raise subprocess.CalledProcessError(returncode, get_disassemble_cmd(search_dir+filename, out_dir, device_sdk, max_workers))
+                store_smali_cache(cache_key, search_dir+filename, out_dir)
+                if find_smali_targets(out_dir, filename, patches_list, found):
+                    return
+            time.sleep(0.05)
+    finally:
+        # All the targets have been found (or something has failed), the remaining work is discarded
+        kill_processes(running)
+        if sys.platform_codename == "android":
+            clean_dalvik_cache(SCRIPT_DIR+"/tools/baksmali-dvk.jar")
+
+
+def get_smali_descriptor(smali_file_path):
+    return "L"+remove_ext(smali_file_path)+";"
+
+
+def locate_classes(search_dir, patches_list):
+    """Locate the classes to patch by reading the dex tables (no JVM is needed).
+
+    Return a dict with the dex filename and the method signatures of every class found (the missing ones are not present).
+    Return None when the index cannot be used so the caller can fallback to the full search.
+    """
+    import dexfile
+
+    dir_list = tuple(sorted(os.listdir(search_dir)))
+    if len(dir_list) == 0:
+        return None
+
+    descriptors = get_patches_classes(patches_list)
+    located = {}
+    for filename in dir_list:
+        try:
+            dex = dexfile.DexFile(search_dir+filename)
+            try:
+                for descriptor in descriptors:
+                    if descriptor in located:
+                        continue
+                    methods = dex.get_class_methods(descriptor)
+                    if methods is not None:
+                        located[descriptor] = (filename, set([signature for signature, __ in methods]))
+            finally:
+                dex.close()
+        except dexfile.READ_ERRORS:
+            e = sys.exc_info()[1]
+            warning("The dex index cannot be used ("+filename+": "+str(e)+")")
+            del e
+            return None
+        if has_patches_classes(patches_list, located):
+            break
+    return located
+
+
+def find_smali(search_dir, device_sdk, patches_list, located=None):
+    """Disassemble the dex files that contain the classes to patch, every dex at most once.
+
+    Return a tuple with a dict (class descriptor => (smali folder, dex filename)) and the filename of the last dex.
+    located is the result of locate_classes, without it the dex files are disassembled until every patch has one of its classes.
+    """
     dir_list = tuple(sorted(os.listdir(search_dir)))
 
     if len(dir_list) == 0:
         print_(os.linesep+"ERROR: No dex file(s) found, probably the ROM is odexed.")
         exit_now(86)
 
-    for filename in dir_list:
+    found = {}
+    if located is not None:
+        for filename in sorted(set([dex_filename for dex_filename, __ in located.values()])):
+            out_dir = "./smali-"+remove_ext(filename)+"/"
+            disassemble(search_dir+filename, out_dir, device_sdk)
+            find_smali_targets(out_dir, filename, patches_list, found)
+        if len(found) == len(located):
+            return (found, dir_list[-1])
+        warning("Some classes to patch were not found where expected, searching in all dex files.")
+
+    remaining = [filename for filename in dir_list if not os.path.exists("./smali-"+remove_ext(filename)+"/")]
+    if PARALLEL_DISASSEMBLE and len(remaining) > 1:
+        import toolrunner
+
+        # Every worker needs at least the heap required by the biggest dex with a single thread
+        largest_dex = max([os.path.getsize(search_dir+filename) for filename in remaining])
+        per_worker_mem = max(DISASSEMBLE_WORKER_MEM, toolrunner.choose_jvm_options("baksmali", largest_dex, None, 1)[0])
+        max_workers = min(get_workers_budget(per_worker_mem), len(remaining))
+        if max_workers > 1:
+            find_smali_parallel(search_dir, remaining, device_sdk, max_workers, patches_list, found)
+            return (found, dir_list[-1])
+
+    for filename in remaining:
         out_dir = "./smali-"+remove_ext(filename)+"/"
         disassemble(search_dir+filename, out_dir, device_sdk)
-        if os.path.exists(out_dir+"android/content/pm/PackageParser.smali"):
-            return (out_dir, "android/content/pm/PackageParser.smali", filename, dir_list[-1])
-        if os.path.exists(out_dir+"com/android/server/pm/PackageManagerService.smali"):
-            return (out_dir, "com/android/server/pm/PackageManagerService.smali", filename, dir_list[-1])
-    return (None, None, None, None)
+        if find_smali_targets(out_dir, filename, patches_list, found):
+            break
+    return (found, dir_list[-1])
+
 
+def is_multidex_supported(device_sdk):
+    try:
+        return int(device_sdk) >= MIN_MULTIDEX_SDK
+    except (TypeError, ValueError):
+        return False  # Unknown version, better be safe
+
+
+def parse_args():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [options]", version=__app__)
+    parser.add_option("--cache-stats", action="store_true", default=False, help="show the statistics of the caches and exit")
+    parser.add_option("--cache-clear", action="store_true", default=False, help="empty the caches and exit")
+    parser.add_option("--patch", action="append", metavar="NAME", help="apply only this patch (the name of its file in the patches folder), it can be repeated")
+    parser.add_option("--check-deps", action="store_true", default=False, help="show the path of the dependencies and exit")
+    parser.add_option("--mode", type="int", help="select the mode without showing the menu")
+    parser.add_option("--device", help="serial of the device to patch (mode 1)")
+    parser.add_option("--input-dir", help="folder with framework.jar and build.prop to use instead of the default input (mode 1 and 2)")
+    parser.add_option("--output-dir", help="folder where the output files are placed")
+    parser.add_option("--keep-adb-server", action="store_true", default=False, help="do not kill the adb server at the end")
+    parser.add_option("--fleet", action="store_true", default=False, help="patch all the connected devices, the patching is done once per firmware")
+    parser.add_option("--batch", metavar="DIR", help="patch every framework.jar (with its build.prop) found inside DIR, without user interaction")
+    parser.add_option("--scan", metavar="PATH", help="check, without patching, if every framework.jar found inside PATH (or the file itself) can be patched")
+    parser.add_option("--summary", metavar="FILE", help="where to write the JSON summary of the batch or scan mode (default: summary.json in the output folder)")
+    parser.add_option("--trace", metavar="FILE", help="where to write the JSON trace with the time and the resources used by every stage (default: trace.json in the output folder)")
+    parser.add_option("--low-memory", action="store_true", default=False, help="bound the memory used by the run (always enabled in mode 3)")
+    parser.add_option("--no-cache", action="store_true", default=False, help="do not use the caches (smali, result and pull)")
+    parser.add_option("--chrome-trace", metavar="FILE", help="also write the trace in the Chrome trace event format (chrome://tracing or Perfetto)")
+    options = parser.parse_args()[0]
+    if options.mode is not None and not 0 < options.mode <= 3:
+        parser.error("invalid mode")
+    return options
+
+
+def get_self_cmd():
+    cmd = [sys.executable, os.path.realpath(__file__)]
+    for patch_name in OPTIONS.patch or ():
+        cmd.extend(["--patch", patch_name])
+    if OPTIONS.low_memory:
+        cmd.append("--low-memory")
+    return cmd
+
+
+def load_patches(selected=None):
+    """Return an instance of every patch (subclass of BasePatch) found in the patches folder, or only of the selected ones."""
+    patches_dir = os.path.join(SCRIPT_DIR, "patches")
+    module_names = sorted([remove_ext(filename) for filename in os.listdir(patches_dir) if filename.endswith(".py") and not filename.startswith("_")])
+    for module_name in selected or ():
+        if module_name not in module_names:
+            print_(os.linesep+"ERROR: Unknown patch: "+module_name+" (available: "+", ".join(module_names)+")")
+            exit_now(98)
+    patches_list = []
+    for module_name in module_names:
+        if selected and module_name not in selected:
+            continue
+        module = __import__("patches."+module_name, fromlist=[module_name])
+        for attr_name in sorted(dir(module)):
+            value = getattr(module, attr_name)
+            if isinstance(value, type) and issubclass(value, BasePatch) and value.__module__ == module.__name__:
+                patches_list.append(value())
+    return patches_list
+
+
+def get_patches_files_list(patches_list):
+    """Merge the files required by the patches."""
+    files_list = []
+    for patch in patches_list:
+        for item in patch.get_files_list():
+            if list(item) not in files_list:
+                files_list.append(list(item))
+    return files_list
+
+
+def run_logged(cmd, log_file):
+    """Run a command with the output redirected to a log file, return the exit code."""
+    import time
+    import toolrunner
+
+    fo = open(log_file, "wb")
+    devnull = open(os.devnull, "rb")
+    try:
+        start = time.time()
+        returncode, cpu_time, max_rss, read_bytes, written_bytes = toolrunner.wait_process(subprocess.Popen(cmd, stdout=fo, stderr=subprocess.STDOUT, stdin=devnull))
+        TRACER.add_process(remove_ext(os.path.basename(log_file)), (time.time() - start, cpu_time, max_rss, read_bytes, written_bytes))
+        return returncode
+    finally:
+        devnull.close()
+        fo.close()
 
-def move_methods_workaround(dex_filename, dex_filename_last, in_dir, out_dir, device_sdk):
+
+def list_adb_devices():
+    """Return the serials of the connected devices that are ready (the unauthorized and offline ones are skipped)."""
+    subprocess.check_output([DEPS_PATH["adb"], "start-server"])
+    output = safe_output_decode(subprocess.check_output([DEPS_PATH["adb"], "devices"]))
+    devices = []
+    for line in output.splitlines()[1:]:
+        fields = line.split("\t")
+        if len(fields) == 2 and fields[1].strip() == "device":
+            devices.append(fields[0])
+    return devices
+
+
+def get_device_fingerprint(chosen_device):
+    output = device_shell(chosen_device, "getprop ro.build.fingerprint")
+    fingerprint = safe_output_decode(output).strip()
+    if not fingerprint:  # In recovery the properties of the system are not loaded, only there /system must be mounted
+        adb_automount_if_needed(chosen_device, "/system")
+        output = device_shell(chosen_device, "grep -m 1 '^ro.build.fingerprint=' /system/build.prop")
+        fingerprint = safe_output_decode(output).strip()[21:]
+    if not fingerprint:
+        raise RuntimeError("Unknown build fingerprint")
+    return fingerprint
+
+
+def find_batch_inputs(batch_dir):
+    inputs = []
+    for root, dirs, files in os.walk(batch_dir):
+        dirs.sort()
+        if "framework.jar" in files:
+            inputs.append(root)
+    return inputs
+
+
+def run_batch(batch_dir, output_dir, summary_file):
+    """Patch every firmware dump found in batch_dir, each one in its own process."""
+    import json
+    import time
+    import workerpool
+
+    inputs = find_batch_inputs(batch_dir)
+    max_workers = min(get_workers_budget(BATCH_WORKER_MEM), max(len(inputs), 1))
+    print_(" *** Inputs:", len(inputs), "- Workers:", max_workers)
+
+    def _patch(input_dir):
+        rel_path = os.path.relpath(input_dir, batch_dir)
+        item_output_dir = os.path.normpath(os.path.join(output_dir, rel_path))
+        if not os.path.exists(item_output_dir):
+            os.makedirs(item_output_dir)
+        log_file = os.path.join(item_output_dir, "log.txt")
+        start = time.time()
+        returncode = run_logged(get_self_cmd() + ["--mode", "2", "--input-dir", input_dir, "--output-dir", item_output_dir], log_file)
+        elapsed = time.time() - start
+        print_(" *** "+rel_path+": "+("OK" if returncode == 0 else "FAILED (code "+str(returncode)+")")+" in "+str(round(elapsed, 1))+"s", flush=True)
+        output_file = os.path.join(item_output_dir, "framework.jar")
+        return {
+            "input": input_dir,
+            "output": output_file if os.path.exists(output_file) else None,
+            "log": log_file,
+            "success": returncode == 0,
+            "error_code": returncode,
+            "seconds": round(elapsed, 3),
+        }
+
+    start = time.time()
+    results = workerpool.run_jobs([lambda input_dir=input_dir: _patch(input_dir) for input_dir in inputs], max_workers)
+    items = []
+    for input_dir, (success, result) in zip(inputs, results):
+        if not success:
+            result = {"input": input_dir, "output": None, "log": None, "success": False, "error_code": None, "seconds": None, "exception": str(result)}
+        items.append(result)
+
+    summary = {
+        "app": __app__,
+        "batch_dir": os.path.abspath(batch_dir),
+        "workers": max_workers,
+        "seconds": round(time.time() - start, 3),
+        "total": len(items),
+        "succeeded": len([item for item in items if item["success"]]),
+        "items": items,
+    }
+    summary["failed"] = summary["total"] - summary["succeeded"]
+    fo = open(summary_file, "w")
+    try:
+        json.dump(summary, fo, indent=2, sort_keys=True)
+    finally:
+        fo.close()
+
+    print_(os.linesep+" *** Succeeded:", summary["succeeded"], "- Failed:", summary["failed"])
+    print_(" *** Summary: "+summary_file)
+    return 96 if summary["failed"] else 0
+
+
+def scan_framework(archive, patches_list):
+    """Report, for every patch, where and how it would be applied by reading the dex tables inside the archive (nothing is extracted)."""
+    import dexfile
+    import dexplanner
+    import zipengine
+    import oatextract
+
+    descriptors = get_patches_classes(patches_list)
+    build_prop = os.path.join(os.path.dirname(archive), "build.prop")
+    report = {"file": archive, "sdk": parse_sdk_ver(build_prop) if os.path.exists(build_prop) else None, "dex_files": [], "patches": [], "patchable": False, "error": None, "error_code": None, "odex_container": None}
+    located = {}
+    states = {}
+    try:
+        dex_source = zipengine.read_dex(archive)
+        if not zipengine.list_dex(archive):
+            report["odex_container"] = find_odex_container(os.path.dirname(archive))
+            if report["odex_container"] is not None:
+                dex_source = oatextract.iter_dex(report["odex_container"], os.path.basename(archive))
+        for name, data in dex_source:
+            dex = dexfile.DexFile(name, data)
+            try:
+                report["dex_files"].append({"name": name, "method_ids": dex.method_ids_size, "field_ids": dex.field_ids_size})
+                for descriptor in descriptors:
+                    if descriptor in located:
+                        continue
+                    methods = dex.get_class_methods(descriptor)
+                    if methods is None:
+                        continue
+                    located[descriptor] = (name, set([signature for signature, __ in methods]), dex.method_ids_size, dex.field_ids_size)
+                    for i, patch in enumerate(patches_list):
+                        if descriptor in patch.get_classes_list():
+                            states[(i, descriptor)] = patch.get_state(dex, descriptor)
+            finally:
+                dex.close()
+                del data  # Only one dex at a time is kept in memory
+            if has_patches_classes(patches_list, located):
+                break  # The remaining dex files are not needed
+    except zipengine.ERRORS + dexfile.READ_ERRORS + oatextract.READ_ERRORS:
+        report["error"], report["error_code"] = str(sys.exc_info()[1]), 87
+        return report
+    if not report["dex_files"]:
+        report["error"], report["error_code"] = "No dex file(s) found, probably the ROM is odexed.", 87
+        return report
+
+    for i, patch in enumerate(patches_list):
+        patch_report = {"patch": patch.__class__.name, "class": None, "dex": None, "variant": None, "state": None}
+        report["patches"].append(patch_report)
+        candidates = [descriptor for descriptor in patch.get_classes_list() if descriptor in located]
+        if not candidates:
+            report["error"], report["error_code"] = "The smali file to patch ("+patch.__class__.name+") cannot be found.", 82
+            continue
+        descriptor = candidates[0]
+        for candidate in candidates:
+            variant = patch.detect(candidate, located[candidate][1])
+            if variant is not None:
+                descriptor = candidate
+                patch_report["variant"] = variant
+                break
+        dex_name, __, method_ids, field_ids = located[descriptor]
+        methods_delta, fields_delta = patch.get_refs_delta()
+        patch_report.update({
+            "class": descriptor,
+            "dex": dex_name,
+            "state": states[(i, descriptor)] or "not patched",
+            "method_headroom": dexplanner.MAX_REFS - method_ids,
+            "field_headroom": dexplanner.MAX_REFS - field_ids,
+            "refs_delta": [methods_delta, fields_delta],
+        })
+        # Without room the classes must be moved to another dex, it is possible only with multidex
+        patch_report["fits"] = method_ids + methods_delta <= dexplanner.MAX_REFS and field_ids + fields_delta <= dexplanner.MAX_REFS
+        if report["error"] is not None:
+            continue
+        if patch_report["variant"] is None:
+            report["error"], report["error_code"] = "The function to patch ("+patch.__class__.name+") cannot be found, probably your version of Android is NOT supported.", 89
+        elif patch_report["state"] == "partially patched":
+            report["error"], report["error_code"] = "The file is partially patched.", 93
+    report["patchable"] = report["error"] is None
+    return report
+
+
+def run_scan(scan_path, patches_list, summary_file):
+    """Check without patching if every framework.jar found in scan_path (a folder or a single file) can be patched.
+
+    The files are scanned one at a time: the parsing of the dex tables is pure Python, threads would not run it in parallel.
+    """
+    import json
+    import time
+
+    if os.path.isdir(scan_path):
+        archives = [os.path.join(input_dir, "framework.jar") for input_dir in find_batch_inputs(scan_path)]
+    else:
+        archives = [scan_path]
+    print_(" *** Files:", len(archives))
+
+    def _scan(archive):
+        start = time.time()
+        report = scan_framework(archive, patches_list)
+        report["seconds"] = round(time.time() - start, 3)
+        rel_path = os.path.relpath(archive, scan_path) if os.path.isdir(scan_path) else archive
+        if report["error"] is not None:
+            print_(" *** "+rel_path+": ERROR (code "+str(report["error_code"])+") "+report["error"], flush=True)
+        for patch_report in report["patches"]:
+            if patch_report["class"] is not None:
+                print_(" *** "+rel_path+": "+patch_report["patch"]+" - "+str(patch_report["variant"])+" - "+patch_report["dex"]+" "+patch_report["class"]+" - "+patch_report["state"]+" - method headroom: "+str(patch_report["method_headroom"]), flush=True)
+        return report
+
+    start = time.time()
+    items = []
+    with TRACER.stage("scan"):
+        for archive in archives:
+            try:
+                items.append(_scan(archive))
+            except Exception:
+                items.append({"file": archive, "patchable": False, "error": str(sys.exc_info()[1]), "error_code": None})
+
+    summary = {
+        "app": __app__,
+        "scan_path": os.path.abspath(scan_path),
+        "patches": [[patch.__class__.name, patch.__class__.version] for patch in patches_list],
+        "seconds": round(time.time() - start, 3),
+        "total": len(items),
+        "patchable": len([item for item in items if item["patchable"]]),
+        "items": items,
+    }
+    fo = open(summary_file, "w")
+    try:
+        json.dump(summary, fo, indent=2, sort_keys=True)
+    finally:
+        fo.close()
+
+    print_(os.linesep+" *** Patchable:", summary["patchable"], "- Not patchable:", summary["total"] - summary["patchable"])
+    print_(" *** Summary: "+summary_file)
+    return 0
+
+
+def run_fleet(fleet_dir, logs_dir):
+    """Patch every connected device, the host-side pipeline is executed once for every firmware."""
+    import hashlib
+    import workerpool
+
+    devices = list_adb_devices()
+    if not devices:
+        print_(os.linesep+"ERROR: No device detected! This mean that no device is connected or that your device have 'Android debugging' disabled.")
+        return 0
+    max_workers = min(FLEET_MAX_WORKERS, MAX_WORKERS or FLEET_MAX_WORKERS)
+    print_(" *** Devices:", len(devices))
+
+    report = {}
+    groups = {}
+    fingerprints = workerpool.run_jobs([lambda device=device: get_device_fingerprint(device) for device in devices], max_workers)
+    for device, (success, result) in zip(devices, fingerprints):
+        if not success:
+            report[device] = ("?", "FAILED", "cannot read the build fingerprint: "+str(result))
+            continue
+        groups.setdefault(result, []).append(device)
+    print_(" *** Firmwares:", len(groups))
+
+    push_jobs = []
+    for fingerprint in sorted(groups):
+        group_devices = groups[fingerprint]
+        group_id = hashlib.md5(fingerprint.encode("utf-8")).hexdigest()
+        input_dir = os.path.join(fleet_dir, group_id)
+        os.makedirs(input_dir)
+
+        # Pull from one device and build the patched file once (it will be found in the result cache)
+        print_(" *** Building "+fingerprint+" ("+str(len(group_devices))+" device(s))...")
+        pull_error = None
+        for path, filename in (["/system/framework", "framework.jar"], ["/system", "build.prop"]):
+            if not pull_device_file(group_devices[0], path+"/"+filename, input_dir):
+                pull_error = "cannot pull "+filename+" from "+group_devices[0]
+        if pull_error is None and not has_dex(os.path.join(input_dir, "framework.jar")):
+            container = find_device_odex_container(group_devices[0])
+            if container is not None and not pull_device_file(group_devices[0], container, input_dir):
+                pull_error = "cannot pull "+container+" from "+group_devices[0]
+        build_log = os.path.join(logs_dir, group_id+"-build.log")
+        if pull_error is None:
+            returncode = run_logged(get_self_cmd() + ["--mode", "2", "--input-dir", input_dir, "--output-dir", os.path.join(input_dir, "output")], build_log)
+            if returncode != 0:
+                pull_error = "the patching has failed with code "+str(returncode)+", see "+build_log
+        if pull_error is not None:
+            for device in group_devices:
+                report[device] = (fingerprint, "FAILED", pull_error)
+            continue
+
+        for device in group_devices:
+            push_jobs.append((device, fingerprint))
+
+    def _push(device):
+        # Every device pulls its own framework.jar, so the backup is its own and a device with a different file
+        # is not overwritten with the one of the group; the identical files are found in the pull and result caches
+        log_file = os.path.join(logs_dir, device.replace(":", "_")+".log")
+        return run_logged(get_self_cmd() + ["--mode", "1", "--device", device, "--keep-adb-server"], log_file), log_file
+
+    print_(" *** Pushing to "+str(len(push_jobs))+" device(s)...")
+    results = workerpool.run_jobs([lambda job=job: _push(job[0]) for job in push_jobs], max_workers)
+    for (device, fingerprint), (success, result) in zip(push_jobs, results):
+        if not success:
+            report[device] = (fingerprint, "FAILED", str(result))
+        elif result[0] != 0:
+            report[device] = (fingerprint, "FAILED", "code "+str(result[0])+", see "+result[1])
+        else:
+            report[device] = (fingerprint, "OK", result[1])
+
+    print_(os.linesep+"FLEET REPORT"+os.linesep+"============")
+    failed = 0
+    for device in devices:
+        fingerprint, status, detail = report[device]
+        print_(device+" - "+status+" - "+fingerprint)
+        print_("    "+detail)
+        if status != "OK":
+            failed += 1
+    print_(os.linesep+" *** Patched:", len(devices) - failed, "- Failed:", failed)
+    return 95 if failed else 0
+
+
+def move_smali_package(src_dir, dest_dir, package):
+    """Move the classes of a package (but not the ones of its sub-packages)."""
+    src = os.path.join(src_dir, package)
+    dest = os.path.join(dest_dir, package)
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    for filename in os.listdir(src):
+        if filename.endswith(".smali"):
+            safe_move(os.path.join(src, filename), os.path.join(dest, filename))
+
+
+def move_methods_workaround(dex_filename, dex_filename_last, in_dir, out_dir, device_sdk, packages=None):
     if(dex_filename == dex_filename_last):
         print_(os.linesep+"ERROR")  # ToDO: Notify error better
         exit_now(84)
     print_(" *** Moving methods...")
-    warning("Experimental code.")
     smali_dir = "./smali-"+remove_ext(dex_filename)+"/"
     smali_dir_last = "./smali-"+remove_ext(dex_filename_last)+"/"
-    disassemble(in_dir+dex_filename_last, smali_dir_last, device_sdk)
-    safe_move(smali_dir+"android/bluetooth/", smali_dir_last+"android/bluetooth/")
+    if os.path.exists(in_dir+dex_filename_last):
+        disassemble(in_dir+dex_filename_last, smali_dir_last, device_sdk)
+    else:
+        os.makedirs(smali_dir_last)  # New dex
+    if packages is None:
+        warning("Experimental code.")
+        safe_move(smali_dir+"android/bluetooth/", smali_dir_last+"android/bluetooth/")
+    else:
+        for package in packages:
+            move_smali_package(smali_dir, smali_dir_last, package)
     print_(" *** Reassembling classes...")
     assemble(smali_dir, out_dir+dex_filename, device_sdk)
     assemble(smali_dir_last, out_dir+dex_filename_last, device_sdk)
@@ -545,14 +1983,260 @@ def move_methods_workaround(dex_filename, dex_filename_last, in_dir, out_dir, de
         subprocess.check_call(["attrib", "-a", out_dir+dex_filename_last])
 
 
+def plan_dex_layout(dex_filename, dex_filename_last, in_dir, device_sdk, excluded_packages, refs_delta):
+    """Return a tuple with the target dex and the packages to move there, or None if no move is needed (or possible)."""
+    import dexfile
+    import dexplanner
+
+    target_dex = dex_filename_last
+    if dex_filename == dex_filename_last:
+        if not is_multidex_supported(device_sdk):
+            return None
+        target_dex = None
+    methods_delta, fields_delta = refs_delta
+    try:
+        packages = dexplanner.plan_rebalance(in_dir+dex_filename, None if target_dex is None else in_dir+target_dex, methods_delta, fields_delta, excluded_packages)
+    except (dexplanner.PlannerError, ) + dexfile.READ_ERRORS:
+        e = sys.exc_info()[1]
+        warning("The dex layout cannot be planned ("+str(e)+")")
+        del e
+        return None
+    if packages is None:
+        return None
+    if target_dex is None:
+        target_dex = "classes"+str(len(os.listdir(in_dir))+1)+".dex"
+    return (target_dex, packages)
+
+
+def assemble_full(smali_dir, dex_filename, dex_filename_last, in_dir, out_dir, device_sdk, excluded_packages=(), refs_delta=(0, 0)):
+    if PLAN_DEX_LAYOUT:
+        plan = plan_dex_layout(dex_filename, dex_filename_last, in_dir, device_sdk, excluded_packages, refs_delta)
+        if plan is not None:
+            print_(" *** The 64K references limit would be exceeded, "+str(len(plan[1]))+" packages will be moved to "+plan[0])
+            debug("Packages to move: "+", ".join(plan[1]))
+            with TRACER.stage("rebalance", planned=True, packages=len(plan[1]), target=plan[0]):
+                move_methods_workaround(dex_filename, plan[0], in_dir, out_dir, device_sdk, plan[1])
+            return
+    try:
+        assemble(smali_dir, out_dir+dex_filename, device_sdk, True)
+        if sys.platform_codename == "win":
+            subprocess.check_call(["attrib", "-a", out_dir+dex_filename])
+    except subprocess.CalledProcessError:  # ToDO: Check e.cmd
+        e = sys.exc_info()[1]
+        safe_file_delete(out_dir+dex_filename)  # Remove incomplete file
+        output = safe_output_decode(e.output)
+        if "Unsigned short value out of range: 65536" not in output:
+            print_(os.linesep+output.strip())
+            print_(os.linesep+"Return code: "+str(e.returncode))
+            exit_now(83)
+        del e
+        warning("The reassembling has failed (probably we have exceeded the 64K methods limit)")
+        warning("but do NOT worry, we will retry.", False)
+        with TRACER.stage("rebalance", planned=False, target=dex_filename_last):
+            move_methods_workaround(dex_filename, dex_filename_last, in_dir, out_dir, device_sdk)
+
+
+def apply_patches(patches_list, found):
+    """Run every patch on the shared smali trees, return the descriptors of the changed classes."""
+    changed = []
+    for patch in patches_list:
+        smali_files = {}
+        for descriptor in patch.get_classes_list():
+            if descriptor in found:
+                smali_files[descriptor] = found[descriptor][0]+get_smali_path(descriptor)
+        print_(" *** Applying: "+patch.__class__.name+"...")
+        with TRACER.stage("patch", patch=patch.__class__.name):
+            try:
+                patch_changed = patch.apply(smali_files, DEBUG_PROCESS)
+            except PatchError:
+                e = sys.exc_info()[1]
+                print_(os.linesep+"ERROR: "+str(e))
+                exit_now(e.code)
+        for descriptor in patch_changed:
+            if descriptor not in changed:
+                changed.append(descriptor)
+    return changed
+
+
+def check_located_classes(patches_list, located):
+    """Exit if a patch cannot be applied, the check is done on the dex tables before starting any JVM."""
+    for patch in patches_list:
+        patch_name = patch.__class__.name
+        descriptors = [descriptor for descriptor in patch.get_classes_list() if descriptor in located]
+        if not descriptors:
+            print_(os.linesep+"ERROR: The smali file to patch ("+patch_name+") cannot be found, please report the problem to https://github.com/ale5000-git/tingle")
+            exit_now(82)
+        detected = [patch.detect(descriptor, located[descriptor][1]) for descriptor in descriptors]
+        for descriptor in descriptors:
+            debug("Found "+descriptor+" in "+located[descriptor][0])
+        if detected.count(None) == len(detected) and not DEBUG_PROCESS:
+            print_(os.linesep+"ERROR: The function to patch ("+patch_name+") cannot be found, probably your version of Android is NOT supported.")
+            exit_now(89)
+
+
+def build_patched_framework(patches_list, device_sdk):
+    """Run the host-side pipeline, framework.jar in the working dir is replaced with the patched one.
+
+    Every dex is disassembled and reassembled at most once, whatever the number of patches.
+    """
+    print_(" *** Decompressing framework...")
+    with TRACER.stage("decompress"):
+        decompress("framework.jar", "framework/")
+
+    # Locate the classes to patch (without starting any JVM)
+    located = None
+    if USE_DEX_INDEX:
+        with TRACER.stage("locate"):
+            located = locate_classes("framework/", patches_list)
+    if located is not None:
+        check_located_classes(patches_list, located)
+
+    # Disassemble them
+    print_(" *** Disassembling classes...")
+    with TRACER.stage("disassemble"):
+        found, dex_filename_last = find_smali("framework/", device_sdk, patches_list, located)
+
+    # Check the existence of the files to patch
+    for patch in patches_list:
+        if not [descriptor for descriptor in patch.get_classes_list() if descriptor in found]:
+            print_(os.linesep+"ERROR: The smali file to patch ("+patch.__class__.name+") cannot be found, please report the problem to https://github.com/ale5000-git/tingle")
+            exit_now(82)
+
+    # Do the injection
+    print_(" *** Patching...")
+    changed = apply_patches(patches_list, found)
+    if not changed:
+        if not DEBUG_PROCESS:
+            print_(" *** All the patches are already applied... Exiting.")
+            exit_now(0)
+        changed = [descriptor for descriptor in get_patches_classes(patches_list) if descriptor in found]  # Reassemble them anyway
+    print_(" *** Patching succeeded.")
+
+    # Reassemble the changed dex files
+    print_(" *** Reassembling classes...")
+    os.makedirs("out/")
+    refs_delta = [0, 0]
+    for patch in patches_list:
+        methods_delta, fields_delta = patch.get_refs_delta()
+        refs_delta[0] += methods_delta
+        refs_delta[1] += fields_delta
+
+    changed_dexes = {}
+    for descriptor in changed:
+        changed_dexes.setdefault(found[descriptor][1], []).append(descriptor)
+    with TRACER.stage("reassemble"):
+        for dex_filename in sorted(changed_dexes):
+            smali_folder = "./smali-"+remove_ext(dex_filename)+"/"
+            excluded_packages = tuple(set([os.path.dirname(get_smali_path(descriptor))+"/" for descriptor in changed_dexes[dex_filename]]))
+            assemble_full(smali_folder, dex_filename, dex_filename_last, "framework/", "out/", device_sdk, excluded_packages, tuple(refs_delta))
+        if ODEX_CONTAINER is not None:
+            # The archive is deodexed, so it also needs the dex files that have not been changed
+            for dex_filename in os.listdir("framework/"):
+                if not os.path.exists("out/"+dex_filename):
+                    shutil.copyfile("framework/"+dex_filename, "out/"+dex_filename)
+
+    # Put classes back in the archive
+    print_(" *** Recompressing framework...")
+    with TRACER.stage("recompress"):
+        compress(os.path.join(os.curdir, "out"), "framework.jar")
+
+
+def produce_patched_framework(patches_list, device_sdk):
+    """Replace framework.jar in the working dir with the patched one, taken from the result cache when possible."""
+    with TRACER.stage("patching"):
+        result_cache_key = None
+        if RESULT_CACHE:
+            result_cache_key = get_result_cache_key(patches_list, device_sdk)
+        if result_cache_key is not None and restore_result_cache(result_cache_key):
+            print_(" *** The patched file has been found in the cache, skipping the patching.")
+        else:
+            build_patched_framework(patches_list, device_sdk)
+            if result_cache_key is not None and not DEBUG_PROCESS:
+                store_result_cache(result_cache_key, patches_list)
+
+
 init()
+OPTIONS = parse_args()
+TRACE_FILE = OPTIONS.trace
+CHROME_TRACE_FILE = OPTIONS.chrome_trace
+if OPTIONS.no_cache:
+    SMALI_CACHE = RESULT_CACHE = PULL_CACHE = False
+
+if OPTIONS.cache_clear:
+    get_smali_cache().clear()
+    get_result_cache().clear()
+    get_pull_cache().clear()
+    remove_tool_dalvik_caches()
+    print_("The caches have been emptied.")
+if OPTIONS.cache_stats:
+    show_cache_stats()
+if OPTIONS.cache_clear or OPTIONS.cache_stats:
+    exit_now(0)
+
+if OPTIONS.check_deps:
+    NON_INTERACTIVE = True
+    DEPS_ERRORS = resolve_dependencies(DEPS_PATH, 1)
+    for dep in sorted(DEPS_PATH):
+        print_(dep+": "+DEPS_PATH[dep])
+    if DEPS_ERRORS:
+        print_(DEPS_ERRORS.strip())
+        exit_now(65)
+    exit_now(0)
 
-question = "MENU"+os.linesep+os.linesep+"    1 - Patch file from a device (adb)"+os.linesep+"    2 - Patch file from the input folder"+os.linesep
-if sys.platform_codename == "android":
-    question += "    3 - Patch file directly from the device"+os.linesep
-mode = user_question(question, 3, 2)
+if OPTIONS.fleet:
+    NON_INTERACTIVE = True
+    handle_dependencies(DEPS_PATH, 1)
+    if safe_subprocess_run([DEPS_PATH["adb"], "version"], False) == False:
+        print_(os.linesep+"ERROR: ADB is not setup correctly.")
+        exit_now(92)
+    TMP_DIR = make_work_dir()
+    FLEET_LOGS_DIR = os.path.join(OPTIONS.output_dir or os.path.join(SCRIPT_DIR, "output"), "fleet")
+    if not os.path.exists(FLEET_LOGS_DIR):
+        os.makedirs(FLEET_LOGS_DIR)
+    if TRACE and TRACE_FILE is None:
+        TRACE_FILE = os.path.join(FLEET_LOGS_DIR, "trace.json")
+    exit_code = run_fleet(TMP_DIR, FLEET_LOGS_DIR)
+    if not OPTIONS.keep_adb_server:
+        close_adb_sessions()
+        subprocess.check_call([DEPS_PATH["adb"], "kill-server"])
+    exit_now(exit_code)
+
+if OPTIONS.batch:
+    NON_INTERACTIVE = True
+    if not os.path.isdir(OPTIONS.batch):
+        print_(os.linesep+"ERROR: The batch folder cannot be found.")
+        exit_now(91)
+    BATCH_OUTPUT_DIR = OPTIONS.output_dir or os.path.join(SCRIPT_DIR, "output", "batch")
+    if not os.path.exists(BATCH_OUTPUT_DIR):
+        os.makedirs(BATCH_OUTPUT_DIR)
+    exit_now(run_batch(OPTIONS.batch, BATCH_OUTPUT_DIR, OPTIONS.summary or os.path.join(BATCH_OUTPUT_DIR, "summary.json")))
+
+if OPTIONS.scan:
+    NON_INTERACTIVE = True
+    if not os.path.exists(OPTIONS.scan):
+        print_(os.linesep+"ERROR: The file or folder to scan cannot be found.")
+        exit_now(91)
+    SCAN_OUTPUT_DIR = OPTIONS.output_dir or os.path.join(SCRIPT_DIR, "output", "scan")
+    if not os.path.exists(SCAN_OUTPUT_DIR):
+        os.makedirs(SCAN_OUTPUT_DIR)
+    if TRACE and TRACE_FILE is None:
+        TRACE_FILE = os.path.join(SCAN_OUTPUT_DIR, "trace.json")
+    exit_now(run_scan(OPTIONS.scan, load_patches(OPTIONS.patch), OPTIONS.summary or os.path.join(SCAN_OUTPUT_DIR, "summary.json")))
+
+if OPTIONS.mode is not None:
+    NON_INTERACTIVE = True
+    mode = OPTIONS.mode
+else:
+    question = "MENU"+os.linesep+os.linesep+"    1 - Patch file from a device (adb)"+os.linesep+"    2 - Patch file from the input folder"+os.linesep
+    if sys.platform_codename == "android":
+        question += "    3 - Patch file directly from the device"+os.linesep
+    mode = user_question(question, 3, 2)
 
 handle_dependencies(DEPS_PATH, mode)
+if "java" not in DEPS_PATH and "dalvikvm" in DEPS_PATH:
+    setup_tool_dalvik_cache()
+if mode == 3 or OPTIONS.low_memory:
+    enable_low_memory()
 
 SELECTED_DEVICE = "ManualMode"
 if mode == 1:
@@ -560,7 +2244,7 @@ if mode == 1:
         print_(os.linesep+"ERROR: ADB is not setup correctly.")
         exit_now(92)
 
-    SELECTED_DEVICE = select_device()
+    SELECTED_DEVICE = OPTIONS.device or select_device()
     if DEBUG_PROCESS:
         print_(" *** NOTE: Running in debug mode, WILL NOT ACTUALLY PATCH AND PUSH TO DEVICE")
 
@@ -568,191 +2252,102 @@ print_(os.linesep+" *** OS:", get_OS(), "("+sys.platform_codename+")")
 print_(" *** Python:", str(sys.version_info[0])+"."+str(sys.version_info[1])+"."+str(sys.version_info[2]), "("+str(sys.python_bits), "bit"+")")
 print_(" *** Mode:", mode)
 
-TMP_DIR = tempfile.mkdtemp("", __app__+"-")
+TMP_DIR = make_work_dir()
 os.chdir(TMP_DIR)
 print_(str(" *** Working dir: {0}").format(TMP_DIR))
 
 if mode == 1:
     print_(" *** Selected device:", SELECTED_DEVICE)
 
-OUTPUT_PATH = os.path.join(SCRIPT_DIR, "output", hashlib.md5(SELECTED_DEVICE.encode('utf-8')).hexdigest())
+import hashlib
+OUTPUT_PATH = OPTIONS.output_dir or os.path.join(SCRIPT_DIR, "output", hashlib.md5(SELECTED_DEVICE.encode('utf-8')).hexdigest())
 if not os.path.exists(OUTPUT_PATH):
     os.makedirs(OUTPUT_PATH)
+if TRACE or OPTIONS.trace:
+    TRACE_FILE = OPTIONS.trace or os.path.join(OUTPUT_PATH, "trace.json")
+TRACER.set_metadata("mode", mode)
+TRACER.set_metadata("low_memory", LOW_MEMORY)
 
-if DUMB_MODE:
+if DUMB_MODE and not NON_INTERACTIVE:
     exit_now(0)  # ToDO: Implement full test in dumb mode
 
 if mode == 1:
     adb_automount_if_needed(SELECTED_DEVICE, "/system")
 
-import patches.sig_spoof
-patch_instance = patches.sig_spoof.Patch()
-files_list = patch_instance.get_files_list()
+PATCHES = load_patches(OPTIONS.patch)
+if not PATCHES:
+    print_(os.linesep+"ERROR: There are no patches to apply.")
+    exit_now(98)
+print_(" *** Patches: "+", ".join([patch.__class__.name for patch in PATCHES]))
+files_list = get_patches_files_list(PATCHES)
+for path, filename in files_list:
+    if path+"/"+filename != "/system/framework/framework.jar":
+        print_(os.linesep+"ERROR: Only framework.jar can be patched, "+path+"/"+filename+" is not supported.")
+        exit_now(98)
 files_list.append(["/system", "build.prop"])
 
-brew_input_file(mode, files_list, SELECTED_DEVICE)
+with TRACER.stage("input"):
+    brew_input_file(mode, files_list, SELECTED_DEVICE, OPTIONS.input_dir)
 
 DEVICE_SDK = None
 if os.path.exists("build.prop"):
-    DEVICE_SDK = parse_sdk_ver("build.prop")
+    try:
+        DEVICE_SDK = parse_sdk_ver("build.prop")
+    except (EnvironmentError, ValueError):
+        print_(os.linesep+"ERROR: The build.prop cannot be read ("+str(sys.exc_info()[1])+").")
+        exit_now(99)
     print_(" *** Device SDK:", DEVICE_SDK)
-
-print_(" *** Decompressing framework...")
-decompress("framework.jar", "framework/")
-
-# Disassemble it
-print_(" *** Disassembling classes...")
-smali_folder, smali_file_path, dex_filename, dex_filename_last = find_smali("framework/", DEVICE_SDK)
-
-# Check the existence of the file to patch
-if smali_folder is None:
-    print_(os.linesep+"ERROR: The smali file to patch cannot be found, please report the problem to https://github.com/ale5000-git/tingle")
-    exit_now(82)
-to_patch = smali_folder+smali_file_path
-
-# Do the injection
-print_(" *** Patching...")
-f = open(to_patch, "r")
-old_contents = f.readlines()
-f.close()
-
-f = open(SCRIPT_DIR+"/patches/fillinsig.smali", "r")
-fillinsig = f.readlines()
-f.close()
-
-# Add fillinsig method
-i = 0
-contents = []
-already_patched = False
-in_function = False
-right_line = False
-start_of_line = None
-done_patching = False
-stored_register = "v11"
-partially_patched = False
-
-while i < len(old_contents):
-    if ";->fillinsig" in old_contents[i]:
-        already_patched = True
-    if ".method public static fillinsig" in old_contents[i]:
-        partially_patched = True
-    if ".method private protected static generatePackageInfo(Landroid/content/pm/PackageParser$Package;[IIJJLjava/util/Set;Landroid/content/pm/PackageUserState;I)Landroid/content/pm/PackageInfo;" in old_contents[i]:
-        print_(" *** Detected: Android 9.x (or LOS 16)")
-        in_function = True
-    if ".method private generatePackageInfo(Lcom/android/server/pm/PackageSetting;II)Landroid/content/pm/PackageInfo;" in old_contents[i]:
-        print_(" *** Detected: Android 8.1.x (or LOS 15.1) - NOT YET WORKING")
-        in_function = True
-    if ".method public static generatePackageInfo(Landroid/content/pm/PackageParser$Package;[IIJJLjava/util/Set;Landroid/content/pm/PackageUserState;I)Landroid/content/pm/PackageInfo;" in old_contents[i]:
-        print_(" *** Detected: Android 8.x / 7.x / 6.x (or LOS/CM 13-15)")
-        in_function = True
-    if ".method public static generatePackageInfo(Landroid/content/pm/PackageParser$Package;[IIJJLandroid/util/ArraySet;Landroid/content/pm/PackageUserState;I)Landroid/content/pm/PackageInfo;" in old_contents[i]:
-        print_(" *** Detected: Android 5.x (or CM 12)")
-        in_function = True
-    if ".method public static generatePackageInfo(Landroid/content/pm/PackageParser$Package;[IIJJLjava/util/HashSet;Landroid/content/pm/PackageUserState;I)Landroid/content/pm/PackageInfo;" in old_contents[i]:
-        print_(" *** Detected: Android 4.4.x (or CM 10-11)")
-        in_function = True
-    if ".method public static generatePackageInfo(Landroid/content/pm/PackageParser$Package;[IIJJ)Landroid/content/pm/PackageInfo;" in old_contents[i]:
-        print_(" *** Detected: CM 7-9 - UNTESTED")
-        in_function = True
-    if ".method public static generatePackageInfo(Landroid/content/pm/PackageParser$Package;[II)Landroid/content/pm/PackageInfo;" in old_contents[i]:
-        print_(" *** Detected: CM 6 - UNTESTED")
-        in_function = True
-    if ".method public static generatePackageInfo(Landroid/content/pm/PackageParser$Package;[IIJJLjava/util/HashSet;ZII)Landroid/content/pm/PackageInfo;" in old_contents[i]:
-        print_(" *** Detected: Alien Dalvik (Sailfish OS)")
-        in_function = True
-    if ".end method" in old_contents[i]:
-        in_function = False
-    if in_function and ".line" in old_contents[i]:
-        start_of_line = i + 1
-    if in_function and "arraycopy" in old_contents[i]:
-        right_line = True
-    if in_function and "Landroid/content/pm/PackageInfo;-><init>()V" in old_contents[i]:
-        stored_register = old_contents[i].split("{")[1].split("}")[0]
-    if not already_patched and in_function and right_line and not done_patching:
-        contents = contents[:start_of_line]
-        contents.append("move-object/from16 v0, p0\n")
-        contents.append("invoke-static {" + stored_register + ", v0}, Landroid/content/pm/PackageParser;->fillinsig(Landroid/content/pm/PackageInfo;Landroid/content/pm/PackageParser$Package;)V\n")
-        done_patching = True
-    else:
-        contents.append(old_contents[i])
-    i = i + 1
-
-if not DEBUG_PROCESS:
-    if already_patched:
-        print_(" *** This file has been already patched... Exiting.")
-        exit_now(0)
-    elif not done_patching:
-        print_(os.linesep+"ERROR: The function to patch cannot be found, probably your version of Android is NOT supported.")
-        exit_now(89)
-    elif partially_patched:
-        print_(os.linesep+"ERROR: The file is partially patched.")
-        exit_now(93)
-    else:
-        contents.extend(fillinsig)
-
-    f = open(to_patch, "w")
-    contents = "".join(contents)
-    f.write(contents)
-    f.close()
-print_(" *** Patching succeeded.")
-
-# Reassemble it
-print_(" *** Reassembling classes...")
-os.makedirs("out/")
-
-try:
-    assemble(smali_folder, "out/"+dex_filename, DEVICE_SDK, True)
-    if sys.platform_codename == "win":
-        subprocess.check_call(["attrib", "-a", "out/"+dex_filename])
-except subprocess.CalledProcessError:  # ToDO: Check e.cmd
-    e = sys.exc_info()[1]
-    safe_file_delete(TMP_DIR+"/out/"+dex_filename)  # Remove incomplete file
-    output = safe_output_decode(e.output)
-    if "Unsigned short value out of range: 65536" not in output:
-        print_(os.linesep+output.strip())
-        print_(os.linesep+"Return code: "+str(e.returncode))
-        exit_now(83)
-    del e
-    warning("The reassembling has failed (probably we have exceeded the 64K methods limit)")
-    warning("but do NOT worry, we will retry.", False)
-    move_methods_workaround(dex_filename, dex_filename_last, "framework/", "out/", DEVICE_SDK)
+TRACER.set_metadata("device_sdk", DEVICE_SDK)
 
 # Backup the original file
 BACKUP_FILE = os.path.join(OUTPUT_PATH, "framework.jar.backup")
-safe_copy(os.path.join(TMP_DIR, "framework.jar"), BACKUP_FILE)
+safe_link(os.path.join(TMP_DIR, "framework.jar"), BACKUP_FILE)
 
-# Put classes back in the archive
-print_(" *** Recompressing framework...")
-compress(os.path.join(os.curdir, "out"), "framework.jar")
+DEVICE_READY = False
+if mode == 1:
+    DEVICE_READY = run_with_device_writing(SELECTED_DEVICE, lambda: produce_patched_framework(PATCHES, DEVICE_SDK))
+if not DEVICE_READY:
+    produce_patched_framework(PATCHES, DEVICE_SDK)
 
 # Copy the patched file to the output folder
 print_(" *** Copying the patched file to the output folder...")
-safe_copy(os.path.join(TMP_DIR, "framework.jar"), os.path.join(OUTPUT_PATH, "framework.jar"))
+with TRACER.stage("output"):
+    safe_link(os.path.join(TMP_DIR, "framework.jar"), os.path.join(OUTPUT_PATH, "framework.jar"))
 
 if mode == 1:
-    enable_device_writing(SELECTED_DEVICE)
-    # Push to device
-    print_(" *** Pushing changes to the device...")
-    try:
-        if not DEBUG_PROCESS:
-            output = safe_subprocess_run([DEPS_PATH["adb"], "-s", SELECTED_DEVICE, "push", "framework.jar", "/system/framework/framework.jar"])
-            debug(safe_output_decode(output).rstrip())
-    except subprocess.CalledProcessError:
-        e = sys.exc_info()[1]
-        output = safe_output_decode(e.output)
-        debug(output.strip())
-        if e.returncode == 1 and "No space left on device" in output:
-            warning("Pushing has failed, we will retry from the recovery.")
-            subprocess.check_call([DEPS_PATH["adb"], "-s", SELECTED_DEVICE, "reboot", "recovery"])
-            subprocess.check_call([DEPS_PATH["adb"], "-s", SELECTED_DEVICE, "wait-for-device"])
+    if not DEBUG_PROCESS and is_device_file_equal(SELECTED_DEVICE, "/system/framework/framework.jar", "framework.jar"):
+        print_(" *** The device already has the patched file, skipping the push.")
+    else:
+        import deviceops
+
+        if not DEVICE_READY:
             enable_device_writing(SELECTED_DEVICE)
-            subprocess.check_output([DEPS_PATH["adb"], "-s", SELECTED_DEVICE, "push", "framework.jar", "/system/framework/framework.jar"])
-        else:
-            raise
-        del e
+        if not DEBUG_PROCESS:
+            if ODEX_CONTAINER is not None:
+                warning("The ROM is odexed, "+os.path.basename(ODEX_CONTAINER)+" on the device no longer matches the patched framework.jar and it should be removed (deodex).")
+            # Push to device
+            print_(" *** Pushing changes to the device...")
+            returncode, output = run_device_task(SELECTED_DEVICE, trace_device_task("push", deviceops.push("framework.jar", "/system/framework/framework.jar")))
+            debug(output.strip())
+            if returncode == 1 and "No space left on device" in output:
+                warning("Pushing has failed, we will retry from the recovery.")
+                close_adb_sessions(SELECTED_DEVICE)
+                run_device_task(SELECTED_DEVICE, trace_device_task("reboot", deviceops.reboot("recovery")))
+                enable_device_writing(SELECTED_DEVICE)
+                returncode, output = run_device_task(SELECTED_DEVICE, trace_device_task("push", deviceops.push("framework.jar", "/system/framework/framework.jar")))
+                debug(output.strip())
+            if returncode != 0:
+                print_(os.linesep+output.strip())
+                print_(os.linesep+"ERROR: Pushing has failed.")
+                exit_now(97)
     # Kill ADB server
-    subprocess.check_call([DEPS_PATH["adb"], "kill-server"])
+    if not OPTIONS.keep_adb_server:
+        close_adb_sessions()
+        subprocess.check_call([DEPS_PATH["adb"], "kill-server"])
 
+show_cache_summary()
+if LOW_MEMORY:
+    check_memory_budget()
 print_(" *** All done! :)")
 
 print_(os.linesep + "Your original file is present at "+BACKUP_FILE)
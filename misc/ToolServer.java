@@ -0,0 +1,62 @@
+import java.io.BufferedReader;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+
+/**
+ * Long-lived front-end for smali / baksmali, it avoids a new JVM start for every call.
+ *
+ * Every job is a line on stdin: tool TAB log_file TAB arg1 TAB arg2 ...
+ * The output of the tool is written to log_file and the end of the job is
+ * notified on stdout with: TINGLE-JOB-END exit_code
+ */
+public class ToolServer {
+
+    private static final String READY = "TINGLE-TOOLSERVER-READY";
+    private static final String JOB_END = "TINGLE-JOB-END ";
+
+    public static void main(String[] args) throws IOException {
+        PrintStream out = System.out;
+        PrintStream err = System.err;
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, "UTF-8"));
+
+        out.println(READY);
+        out.flush();
+
+        String line;
+        while ((line = in.readLine()) != null) {
+            if (line.length() == 0) {
+                continue;
+            }
+            String[] fields = line.split("\t", -1);
+            String[] toolArgs = new String[fields.length - 2];
+            System.arraycopy(fields, 2, toolArgs, 0, toolArgs.length);
+
+            int exitCode = 0;
+            PrintStream log = new PrintStream(new FileOutputStream(fields[1]), true, "UTF-8");
+            System.setOut(log);
+            System.setErr(log);
+            try {
+                if ("baksmali".equals(fields[0])) {
+                    org.jf.baksmali.Main.main(toolArgs);
+                } else if ("smali".equals(fields[0])) {
+                    org.jf.smali.Main.main(toolArgs);
+                } else {
+                    log.println("Unknown tool");
+                    exitCode = 2;
+                }
+            } catch (Throwable t) {
+                t.printStackTrace(log);
+                exitCode = 1;
+            } finally {
+                System.setOut(out);
+                System.setErr(err);
+                log.close();
+            }
+
+            out.println(JOB_END + exitCode);
+            out.flush();
+        }
+    }
+}
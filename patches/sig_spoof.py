@@ -2,22 +2,134 @@
 # -*- coding: utf-8 -*-
 """Signature spoofing."""
 
+import os
+import re
 import sys
 
 __author__ = "ale5000"
 __copyright__ = "Copyright (C) 2016-2017, ale5000"
 __license__ = "GPLv3"
 
+GENERATE_PACKAGE_INFO_VARIANTS = (
+    ("private protected static", "generatePackageInfo(Landroid/content/pm/PackageParser$Package;[IIJJLjava/util/Set;Landroid/content/pm/PackageUserState;I)Landroid/content/pm/PackageInfo;", "Android 9.x (or LOS 16)"),
+    ("private", "generatePackageInfo(Lcom/android/server/pm/PackageSetting;II)Landroid/content/pm/PackageInfo;", "Android 8.1.x (or LOS 15.1) - NOT YET WORKING"),
+    ("public static", "generatePackageInfo(Landroid/content/pm/PackageParser$Package;[IIJJLjava/util/Set;Landroid/content/pm/PackageUserState;I)Landroid/content/pm/PackageInfo;", "Android 8.x / 7.x / 6.x (or LOS/CM 13-15)"),
+    ("public static", "generatePackageInfo(Landroid/content/pm/PackageParser$Package;[IIJJLandroid/util/ArraySet;Landroid/content/pm/PackageUserState;I)Landroid/content/pm/PackageInfo;", "Android 5.x (or CM 12)"),
+    ("public static", "generatePackageInfo(Landroid/content/pm/PackageParser$Package;[IIJJLjava/util/HashSet;Landroid/content/pm/PackageUserState;I)Landroid/content/pm/PackageInfo;", "Android 4.4.x (or CM 10-11)"),
+    ("public static", "generatePackageInfo(Landroid/content/pm/PackageParser$Package;[IIJJ)Landroid/content/pm/PackageInfo;", "CM 7-9 - UNTESTED"),
+    ("public static", "generatePackageInfo(Landroid/content/pm/PackageParser$Package;[II)Landroid/content/pm/PackageInfo;", "CM 6 - UNTESTED"),
+    ("public static", "generatePackageInfo(Landroid/content/pm/PackageParser$Package;[IIJJLjava/util/HashSet;ZII)Landroid/content/pm/PackageInfo;", "Alien Dalvik (Sailfish OS)"),
+)
+FILLINSIG_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "fillinsig.smali")
+FILLINSIG_SIGNATURE = "fillinsig(Landroid/content/pm/PackageInfo;Landroid/content/pm/PackageParser$Package;)V"
+
+
+def read_fillinsig():
+    f = open(FILLINSIG_FILE, "r")
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def inject_fillinsig_call(lines):
+    """Return the lines of the method with the call to fillinsig injected or None if the injection point is not found."""
+    start_of_line = None
+    stored_register = "v11"
+    for i, line in enumerate(lines):
+        if ".line" in line:
+            start_of_line = i + 1
+        if "Landroid/content/pm/PackageInfo;-><init>()V" in line:
+            stored_register = line.split("{")[1].split("}")[0]
+        if "arraycopy" in line:
+            if start_of_line is None:
+                start_of_line = i
+            return lines[:start_of_line] + [
+                "move-object/from16 v0, p0\n",
+                "invoke-static {" + stored_register + ", v0}, Landroid/content/pm/PackageParser;->fillinsig(Landroid/content/pm/PackageInfo;Landroid/content/pm/PackageParser$Package;)V\n"
+            ] + lines[i + 1:]
+    return None
+
 
 class Patch(sys.BasePatch):
     """Signature spoofing patch."""
 
     name = "Signature spoofing"
     version = "0.0.1"
-    _patch_ver = 0
+    _patch_ver = 1
 
     def _initialize(self):
         pass
 
     def _set_files_list(self):
         self.files.append(["/system/framework", "framework.jar"])
+
+    def _set_classes_list(self):
+        self.classes.append("Landroid/content/pm/PackageParser;")
+        self.classes.append("Lcom/android/server/pm/PackageManagerService;")
+
+    def detect(self, descriptor, signatures):
+        for __, signature, description in GENERATE_PACKAGE_INFO_VARIANTS:
+            if signature in signatures:
+                return description
+        return None
+
+    def get_refs_delta(self):
+        text = read_fillinsig()
+        method_refs = set(re.findall(r"L[^;\s]+;->[^(:\s]+\([^)\s]*\)\S+", text))
+        field_refs = set(re.findall(r"L[^;\s]+;->[^(:\s]+:\S+", text))
+        return len(method_refs) + 1, len(field_refs)  # Plus the fillinsig method itself
+
+    def get_state(self, dex, descriptor):
+        # The same checks of apply(): a call to fillinsig means patched, the method alone means partially patched
+        invoked = dex.get_class_invoked_methods(descriptor)
+        if invoked and invoked & dex.find_methods_by_name("fillinsig"):
+            return "patched"
+        if dex.has_method("Landroid/content/pm/PackageParser;", FILLINSIG_SIGNATURE):
+            return "partially patched"
+        return None
+
+    def apply(self, smali_files, dry_run=False):
+        import smalipatcher
+
+        matcher = smalipatcher.MethodMatcher(GENERATE_PACKAGE_INFO_VARIANTS)
+        for descriptor in self.classes:
+            if descriptor not in smali_files:
+                continue
+            to_patch = smali_files[descriptor]
+            smali = smalipatcher.SmaliFile(to_patch)
+            try:
+                # Whole file searches and the method index are done without splitting the file in lines
+                if smali.contains(";->fillinsig"):
+                    print_(" *** This file has been already patched.")
+                    return []
+                partially_patched = smali.contains(".method public static fillinsig")
+                try:
+                    matches = smali.match_methods(matcher)
+                except smalipatcher.SmaliError:
+                    raise sys.PatchError(str(sys.exc_info()[1]), 89)
+
+                replacements = []
+                for method, description in matches:
+                    print_(" *** Detected: "+description)
+                    if not replacements:
+                        new_lines = inject_fillinsig_call(smali.get_lines(method))
+                        if new_lines is not None:
+                            replacements.append((method, new_lines))
+                if not replacements:
+                    continue
+                if dry_run:
+                    return [descriptor]
+                if partially_patched:
+                    raise sys.PatchError("The file is partially patched.", 93)
+                smali.write(to_patch+".tmp", replacements, read_fillinsig())
+            finally:
+                smali.close()
+
+            os.remove(to_patch)  # The file may be a hardlink to the smali cache, so it must not be overwritten in-place
+            os.rename(to_patch+".tmp", to_patch)
+            return [descriptor]
+
+        if dry_run:
+            return []
+        raise sys.PatchError("The function to patch cannot be found, probably your version of Android is NOT supported.", 89)